@@ -1,17 +1,34 @@
 from django.contrib import admin
-from qmessages.models import Message, MessageStatus, MessageStatusDesc, MessageReply, MessageReplyStatus, Note
+from qmessages.models import ArchivedMessage, ArchivedMessageReply, ArchivedNote, Message, MessageStatus, MessageStatusDesc, MessageReply, MessageReplyStatus, Note
+from qmessages.services import post_reply, send_message
 
 # Register your models here.
+class MessageAdmin(admin.ModelAdmin):
+    def save_model(self, request, obj, form, change):
+        if change:
+            return super().save_model(request, obj, form, change)
+        # New messages go through the service so they get their initial status.
+        obj.pk = send_message(obj.sender, obj.receiver, obj.subject, obj.text, obj.project, obj.app, obj.model).pk
+        obj.refresh_from_db()
+
+
 class MessageReplyAdmin(admin.ModelAdmin):
     def get_queryset(self, request):
         return MessageReply.all_objects.all()
 
+    def save_model(self, request, obj, form, change):
+        if change:
+            return super().save_model(request, obj, form, change)
+        obj.pk = post_reply(obj.message.token, obj.replier, obj.text, obj.parent_reply_id).pk
+        obj.refresh_from_db()
+
 
-admin.site.register(Message)
+admin.site.register(Message, MessageAdmin)
 admin.site.register(MessageStatus)
 admin.site.register(MessageStatusDesc)
 admin.site.register(MessageReply, MessageReplyAdmin)   
 admin.site.register(MessageReplyStatus)
 admin.site.register(Note)
-
-
+admin.site.register(ArchivedMessage)
+admin.site.register(ArchivedMessageReply)
+admin.site.register(ArchivedNote)
@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class QMessagesConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'qmessages'
+
+    def ready(self):
+        from qmessages import checks, signals  # noqa: F401
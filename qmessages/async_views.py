@@ -0,0 +1,214 @@
+"""
+Native async variants of the list, detail and reply views, built on the async
+ORM (Django 4.2+). Select them with the QMESSAGES_ASYNC_VIEWS setting; they
+keep the URL names and payloads of their sync counterparts.
+"""
+import asyncio
+import json
+import math
+
+# Django
+from asgiref.sync import sync_to_async
+from django.contrib.auth.mixins import LoginRequiredMixin
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import Http404, HttpResponseRedirect, JsonResponse, StreamingHttpResponse
+from django.shortcuts import render
+from django.urls import reverse
+from django.views import View
+
+# Qmessages
+from qmessages.conditional import not_modified_response, set_validators, thread_validators
+from qmessages.forms import MessageReplyForm
+from qmessages.models import Message, MessageReply
+from qmessages.serializers import aiter_thread_dicts, serialize_threads, summary_dict, thread_values
+from qmessages.services import post_reply
+from qmessages.threads import attach_reply_trees, build_reply_tree, find_reply
+from qmessages.utils import KendoQueryError, check_token, split_tokens
+from qmessages.views import MessageListView
+
+
+async def aget_user(request):
+    if hasattr(request, 'auser'):
+        return await request.auser()
+
+    def load_user():
+        # Touch the lazy user so the session lookup happens in the worker thread.
+        request.user.is_authenticated
+        return request.user
+
+    return await sync_to_async(load_user)()
+
+
+class AsyncLoginRequiredMixin(LoginRequiredMixin):
+
+    async def dispatch(self, request, *args, **kwargs):
+        request.user = await aget_user(request)
+        if not request.user.is_authenticated:
+            return self.handle_no_permission()
+        return await super(LoginRequiredMixin, self).dispatch(request, *args, **kwargs)
+
+
+# Messages
+
+class AsyncMessageListView(AsyncLoginRequiredMixin, MessageListView):
+
+    async def get(self, request, *args, **kwargs):
+        self.tokens = kwargs.get('tokens', None) or split_tokens(request.GET.getlist('tokens'))
+        try:
+            self.object_list = self.get_queryset(request, *args, **kwargs)
+        except KendoQueryError as e:
+            return JsonResponse({"error": str(e)}, status=400)
+
+        etag, last_modified = await sync_to_async(self.get_validators)(request)
+        response = not_modified_response(request, etag, last_modified)
+        if response is None:
+            response = await self.get_page_response(request, **kwargs)
+        return set_validators(response, etag, last_modified)
+
+    async def get_page_response(self, request, **kwargs):
+        if request.is_ajax and 'cursor' in request.GET:
+            return await sync_to_async(self.get_cursor_response)(request)
+        if request.is_ajax and 'stream' in request.GET:
+            return self.get_stream_response(request)
+
+        page_size = self.get_paginate_by(self.object_list)
+        try:
+            page_number = int(request.GET.get(self.page_kwarg) or 1)
+        except ValueError:
+            raise Http404('Invalid page')
+        if page_number < 1:
+            raise Http404('Invalid page')
+
+        # The count and the page don't depend on each other.
+        offset = (page_number - 1) * page_size
+        page = self.object_list[offset:offset + page_size]
+        summary = request.is_ajax and 'summary' in request.GET
+        if summary:
+            page = thread_values(page)
+        elif request.is_ajax:
+            page = page.values_list('pk', flat=True)
+        count, messages = await asyncio.gather(self.object_list.acount(), self.afetch(page))
+        total_pages = max(math.ceil(count / page_size), 1)
+        if page_number > total_pages:
+            if request.is_ajax:
+                return JsonResponse({"error": 'No data found for this token'}, status=404)
+            raise Http404('Invalid page')
+
+        if request.is_ajax:
+            if not messages:
+                return JsonResponse({"error": 'No data found for this token'}, status=404)
+            data = {
+                'data': [summary_dict(row) for row in messages] if summary else await sync_to_async(serialize_threads)(messages),
+                'pagination': {
+                    'page': page_number,
+                    'total_pages': total_pages,
+                    'has_next': page_number < total_pages,
+                    'has_previous': page_number > 1,
+                    'count': count,
+                }
+            }
+            return JsonResponse(data, safe=False)
+
+        context = {'object_list': attach_reply_trees(messages), 'view': self}
+        return render(request, 'message_list.html', context)
+
+    def get_stream_response(self, request):
+        """
+        Like the sync view, but the rows and their replies are read with the
+        async ORM, so ASGI sends each thread as it is encoded instead of
+        reading the whole page into memory first.
+        """
+        try:
+            page_number, page_size, rows = self.get_stream_rows(request)
+        except ValueError:
+            return JsonResponse({"error": 'Invalid page'}, status=400)
+        rows = rows.aiterator(chunk_size=self.stream_chunk_size)
+
+        async def stream():
+            yield '{"data": ['
+            has_next = False
+            position = 0
+            async for thread in aiter_thread_dicts(rows, self.stream_chunk_size):
+                if position == page_size:
+                    has_next = True
+                    break
+                yield (',' if position else '') + json.dumps(thread, cls=DjangoJSONEncoder)
+                position += 1
+            yield self.stream_tail(page_number, page_size, has_next)
+
+        return StreamingHttpResponse(stream(), content_type='application/json')
+
+    async def afetch(self, queryset):
+        return [item async for item in queryset]
+
+
+class AsyncMessageDetailView(AsyncLoginRequiredMixin, View):
+    template_name = 'message_detail.html'
+
+    async def get(self, request, *args, **kwargs):
+        token = kwargs.get('token', None) or request.GET.get('token', None)
+        uuid_token = check_token([token])
+        if not uuid_token:
+            raise Http404('Invalid token')
+        threads = Message.objects.filter(token=uuid_token[0])
+        etag, last_modified = await sync_to_async(thread_validators)(threads, request.user.pk, request.is_ajax, kwargs.get('parent_reply'))
+        response = not_modified_response(request, etag, last_modified)
+        if response is None:
+            response = await self.get_thread_response(request, uuid_token[0], **kwargs)
+        return set_validators(response, etag, last_modified)
+
+    async def get_thread_response(self, request, uuid_token, **kwargs):
+        try:
+            message = await Message.objects.aget(token=uuid_token)
+        except Message.DoesNotExist:
+            raise Http404('No data found for this token')
+
+        if request.is_ajax:
+            threads = await sync_to_async(serialize_threads)([message.pk])
+            return JsonResponse(threads[0], safe=False)
+
+        replies = MessageReply.objects.filter(message=message).select_related('replier', 'current_status').order_by('id')
+        replies = build_reply_tree([reply async for reply in replies])
+        parent_reply = kwargs.get('parent_reply', None)
+        if parent_reply is not None:
+            reply = find_reply(replies, parent_reply)
+            replies = [reply] if reply else []
+        context = {'object': message, 'message': message, 'replies': replies, 'view': self}
+        return render(request, self.template_name, context)
+
+
+class AsyncMessageReplyCreateView(AsyncLoginRequiredMixin, View):
+    form_class = MessageReplyForm
+    template_name = 'message_reply_create.html'
+    base_template = "base.html"
+
+    def get_success_url(self):
+        return reverse('qmessages:message_list_view')
+
+    async def get(self, request, *args, **kwargs):
+        context = {'form': self.form_class(), 'base_template': self.base_template, 'view': self}
+        return render(request, self.template_name, context)
+
+    async def post(self, request, *args, **kwargs):
+        form = self.form_class(data=request.POST)
+        if not form.is_valid():
+            return JsonResponse({"error": form.errors}, safe=False)
+
+        token = kwargs.get('token', None) or request.POST.get('token', None)
+        uuid_token = check_token([token])
+        if not uuid_token:
+            return JsonResponse({"error": 'Invalid token'}, status=400)
+        parent_reply_id = kwargs.get('parent_reply', None) or request.POST.get('parent_reply', None)
+        try:
+            parent_reply_id = int(parent_reply_id) if parent_reply_id else None
+        except ValueError:
+            return JsonResponse({"error": 'Invalid parent reply'}, status=400)
+
+        try:
+            reply = await sync_to_async(post_reply)(uuid_token[0], request.user, form.cleaned_data['text'], parent_reply_id)
+        except (Message.DoesNotExist, MessageReply.DoesNotExist):
+            return JsonResponse({"error": 'No data found for this token'}, status=404)
+
+        if request.is_ajax:
+            return JsonResponse({"success": str(reply.pk)}, safe=False)
+        return HttpResponseRedirect(self.get_success_url())
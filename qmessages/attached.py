@@ -0,0 +1,57 @@
+"""
+Lookup of the messages and notes attached to host app records through their
+`project`/`app`/`model` columns. A whole batch of keys is answered with one
+grouped query per kind, so a grid can badge every row with a single request.
+"""
+from django.db.models import Count, Max, OuterRef, Q, Subquery
+
+from qmessages.models import Message, Note
+from qmessages.status import UNREAD, status_registry
+
+
+def make_keys(project, app, models):
+    """The keys of several records of the same project and app."""
+    return [(project, app, model) for model in models]
+
+def _grouped(queryset, keys, **aggregates):
+    """
+    Group `queryset` by key with `aggregates` and the token of the latest row
+    of each group. The filter is on the columns separately, which the index
+    serves; rows of unrequested combinations are dropped afterwards.
+    """
+    projects, apps, models = (sorted({key[position] for key in keys}) for position in range(3))
+    scoped = queryset.filter(project__in=projects, app__in=apps, model__in=models)
+    latest = (
+        scoped.filter(project=OuterRef('project'), app=OuterRef('app'), model=OuterRef('model'))
+        .order_by('-created_at', '-id').values('token')[:1]
+    )
+    rows = (
+        scoped.order_by().values('project', 'app', 'model')
+        .annotate(count=Count('id'), latest_at=Max('created_at'), latest_token=Subquery(latest), **aggregates)
+    )
+    requested = set(keys)
+    groups = {}
+    for row in rows:
+        key = (row.pop('project'), row.pop('app'), row.pop('model'))
+        if key in requested:
+            row['latest_token'] = str(row['latest_token'])
+            groups[key] = row
+    return groups
+
+def attached_messages(user, keys):
+    """
+    Map each (project, app, model) key to the count, unread count and latest
+    token of the messages `user` sent or received for it. Keys without
+    messages are left out.
+    """
+    if not keys:
+        return {}
+    unread = status_registry.get(UNREAD)
+    queryset = Message.objects.filter(Q(sender=user) | Q(receiver=user))
+    return _grouped(queryset, keys, unread=Count('id', filter=Q(receiver=user, current_status=unread)))
+
+def attached_notes(keys):
+    """Like `attached_messages` for notes, which have no owner."""
+    if not keys:
+        return {}
+    return _grouped(Note.objects.all(), keys)
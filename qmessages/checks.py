@@ -0,0 +1,21 @@
+from django.conf import settings
+from django.core.checks import Warning, register
+
+
+# Unread counters and thread versions are kept in the default cache without
+# a timeout, so every process has to see the same cache.
+PER_PROCESS_CACHES = ['django.core.cache.backends.locmem.LocMemCache']
+
+@register()
+def check_shared_cache(app_configs, **kwargs):
+    backend = settings.CACHES.get('default', {}).get('BACKEND')
+    if backend not in PER_PROCESS_CACHES:
+        return []
+    return [Warning(
+        'The default cache is local to each process.',
+        hint=(
+            'QMessages keeps unread counters and thread cache versions in the default cache; with more '
+            'than one worker process, configure a shared cache such as Redis or Memcached.'
+        ),
+        id='qmessages.W001',
+    )]
@@ -0,0 +1,82 @@
+"""
+Validators for conditional GETs on message threads. A thread's timestamps
+move on every save, status change and soft delete; writes the timestamps
+can't show, like hard deletes, bump a global data version instead.
+"""
+import hashlib
+import math
+import time
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, Max, Sum
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+
+
+VERSION_KEY = 'qmessages:version'
+
+def get_data_version():
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        cache.add(VERSION_KEY, time.time(), None)
+        version = cache.get(VERSION_KEY)
+    return version
+
+def bump_data_version():
+    """Invalidate every validator once the current transaction commits."""
+    transaction.on_commit(lambda: cache.set(VERSION_KEY, time.time(), None))
+
+def thread_validators(queryset, *keys):
+    """
+    Return (etag, last_modified) for the threads of a Message queryset with a
+    single aggregate query. `keys` are folded into the ETag so different views
+    of the same threads don't share it.
+    """
+    stats = queryset.order_by().aggregate(
+        count=Count('id', distinct=True),
+        reply_count=Count('messagereply', distinct=True),
+        updated_at=Max('updated_at'),
+        status_at=Max('current_status_at'),
+        reply_updated_at=Max('messagereply__updated_at'),
+        reply_status_at=Max('messagereply__current_status_at'),
+    )
+    version = get_data_version()
+    timestamps = [
+        stats[name].timestamp() for name in ('updated_at', 'status_at', 'reply_updated_at', 'reply_status_at')
+        if stats[name] is not None
+    ]
+    last_modified = math.ceil(max(timestamps + [version]))
+    etag = hashlib.md5(repr((keys, sorted(stats.items()), version)).encode()).hexdigest()
+    return quote_etag(etag), last_modified
+
+def summary_validators(queryset, *keys):
+    """
+    Like `thread_validators`, for views that show the thread summary kept on
+    the messages instead of the replies themselves; the replies aren't read.
+    """
+    stats = queryset.order_by().aggregate(
+        count=Count('id'),
+        reply_count=Sum('reply_count'),
+        updated_at=Max('updated_at'),
+        status_at=Max('current_status_at'),
+        last_reply_at=Max('last_reply_at'),
+    )
+    version = get_data_version()
+    timestamps = [
+        stats[name].timestamp() for name in ('updated_at', 'status_at', 'last_reply_at')
+        if stats[name] is not None
+    ]
+    last_modified = math.ceil(max(timestamps + [version]))
+    etag = hashlib.md5(repr((keys, sorted(stats.items()), version)).encode()).hexdigest()
+    return quote_etag(etag), last_modified
+
+def not_modified_response(request, etag, last_modified):
+    """Return a 304 response when the client's copy is current, else None."""
+    return get_conditional_response(request, etag=etag, last_modified=last_modified)
+
+def set_validators(response, etag, last_modified):
+    if response.status_code in (200, 304):
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(last_modified)
+    return response
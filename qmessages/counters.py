@@ -0,0 +1,62 @@
+"""
+Per-user unread counters kept in the default cache without a timeout. Every
+process must share that cache (see the qmessages.W001 check), or a worker
+keeps counting from a badge that another worker's writes made stale.
+"""
+from django.apps import apps
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db.models import Count
+
+from qmessages.status import UNREAD, status_registry
+from qmessages.utils import chunks
+
+
+def unread_cache_key(user_id):
+    return f'qmessages:unread:{user_id}'
+
+def count_unread(user_id):
+    Message = apps.get_model('qmessages', 'Message')
+    return Message.objects.filter(receiver_id=user_id, current_status=status_registry.get(UNREAD)).count()
+
+def get_unread_count(user_id):
+    """Return the number of unread messages received by `user_id`, from the cache when possible."""
+    count = cache.get(unread_cache_key(user_id))
+    if count is None:
+        count = count_unread(user_id)
+        cache.add(unread_cache_key(user_id), count, None)
+    return count
+
+def adjust_unread_count(user_id, delta):
+    try:
+        if cache.incr(unread_cache_key(user_id), delta) < 0:
+            cache.delete(unread_cache_key(user_id))
+    except ValueError:
+        # Not cached yet; the next read counts from the database.
+        pass
+
+def track_status_change(user_id, previous_desc_id, desc_id):
+    unread_id = status_registry.get(UNREAD).id
+    if previous_desc_id != unread_id and desc_id == unread_id:
+        adjust_unread_count(user_id, 1)
+    elif previous_desc_id == unread_id and desc_id != unread_id:
+        adjust_unread_count(user_id, -1)
+
+def reset_unread_counts(user_ids):
+    cache.delete_many([unread_cache_key(user_id) for user_id in set(user_ids)])
+
+def rebuild_unread_counts(batch_size=1000):
+    """Recount every user's unread messages and store the result in the cache."""
+    Message = apps.get_model('qmessages', 'Message')
+    counts = dict(
+        Message.objects.filter(current_status=status_registry.get(UNREAD))
+        .values_list('receiver_id')
+        .annotate(count=Count('id'))
+        .order_by()
+    )
+    user_ids = get_user_model().objects.order_by('pk').values_list('pk', flat=True)
+    rebuilt = 0
+    for ids in chunks(user_ids.iterator(), batch_size):
+        cache.set_many({unread_cache_key(user_id): counts.get(user_id, 0) for user_id in ids}, None)
+        rebuilt += len(ids)
+    return rebuilt
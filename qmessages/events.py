@@ -0,0 +1,161 @@
+"""
+Events pushed to clients through the message stream. Every event gets an
+increasing id and is kept in a bounded log, so a client that reconnects with
+its last seen id gets what it missed replayed.
+
+The default bus lives in process memory and only reaches clients connected to
+the same process; set QMESSAGES_EVENT_BUS to the dotted path of another
+`EventBus` to share events between processes.
+"""
+import abc
+import asyncio
+import collections
+import threading
+import time
+
+from django.conf import settings
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+
+MESSAGE_CREATED = 'message'
+REPLY_CREATED = 'reply'
+STATUS_CHANGED = 'status'
+INBOX_CHANGED = 'inbox'  # many messages changed at once; clients reload instead of patching
+
+Event = collections.namedtuple('Event', ['id', 'type', 'user_ids', 'data'])
+
+
+# Buses
+
+class EventBus(abc.ABC):
+    last_id = 0  # id of the newest published event
+
+    @abc.abstractmethod
+    def publish(self, event_type, user_ids, data):
+        """Log an event for `user_ids` and return it."""
+
+    @abc.abstractmethod
+    def events_since(self, user_id, last_id):
+        """Return the logged events for `user_id` newer than `last_id`."""
+
+    @abc.abstractmethod
+    def is_expired(self, last_id):
+        """Whether events after `last_id` may have been dropped from the log."""
+
+    @abc.abstractmethod
+    def wait(self, user_id, last_id, timeout):
+        """Like `events_since`, but block up to `timeout` seconds until there is something."""
+
+    poll_interval = 0.25
+
+    async def await_events(self, user_id, last_id, timeout):
+        """
+        Like `wait` for async consumers. Publishers run in other threads, so
+        the log is polled every `poll_interval` seconds instead of holding a
+        thread for the whole wait.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            events = self.events_since(user_id, last_id)
+            remaining = deadline - time.monotonic()
+            if events or remaining <= 0:
+                return events
+            await asyncio.sleep(min(self.poll_interval, remaining))
+
+
+class InMemoryEventBus(EventBus):
+
+    def __init__(self, size=None):
+        self.log = collections.deque(maxlen=size or getattr(settings, 'QMESSAGES_EVENT_LOG_SIZE', 1000))
+        self.last_id = 0
+        self.condition = threading.Condition()
+
+    def publish(self, event_type, user_ids, data):
+        with self.condition:
+            self.last_id += 1
+            event = Event(self.last_id, event_type, frozenset(user_ids), data)
+            self.log.append(event)
+            self.condition.notify_all()
+        return event
+
+    def events_since(self, user_id, last_id):
+        with self.condition:
+            return [event for event in self.log if event.id > last_id and user_id in event.user_ids]
+
+    def is_expired(self, last_id):
+        with self.condition:
+            # An id from before a restart is ahead of the counter.
+            if last_id > self.last_id:
+                return True
+            return bool(self.log) and last_id < self.log[0].id - 1
+
+    def wait(self, user_id, last_id, timeout):
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while True:
+                events = [event for event in self.log if event.id > last_id and user_id in event.user_ids]
+                remaining = deadline - time.monotonic()
+                if events or remaining <= 0:
+                    return events
+                self.condition.wait(remaining)
+
+
+_event_bus = None
+_event_bus_lock = threading.Lock()
+
+def get_event_bus():
+    global _event_bus
+    with _event_bus_lock:
+        if _event_bus is None:
+            bus_path = getattr(settings, 'QMESSAGES_EVENT_BUS', None)
+            _event_bus = import_string(bus_path)() if bus_path else InMemoryEventBus()
+        return _event_bus
+
+
+# Publishing
+
+def publish(event_type, user_ids, data):
+    """Publish the event once the current transaction commits."""
+    user_ids = set(user_ids)
+    transaction.on_commit(lambda: get_event_bus().publish(event_type, user_ids, data))
+
+def message_created(message):
+    publish(MESSAGE_CREATED, [message.receiver_id], {
+        'token': str(message.token), 'subject': message.subject, 'sender': message.sender_id,
+    })
+
+def reply_created(reply):
+    message = reply.message
+    publish(REPLY_CREATED, [message.sender_id, message.receiver_id], {
+        'token': str(message.token), 'reply': reply.pk, 'parent_reply': reply.parent_reply_id, 'replier': reply.replier_id,
+    })
+
+def status_changed(token, user_ids, status):
+    publish(STATUS_CHANGED, user_ids, {'token': str(token), 'status': status})
+
+
+# Bulk writes. Past QMESSAGES_EVENT_BULK_THRESHOLD messages they publish one
+# shared INBOX_CHANGED event, so a large write can't push every other
+# client's events out of the log.
+
+def get_bulk_threshold():
+    return getattr(settings, 'QMESSAGES_EVENT_BULK_THRESHOLD', 50)
+
+def messages_created(messages):
+    if len(messages) <= get_bulk_threshold():
+        for message in messages:
+            message_created(message)
+        return
+    publish(INBOX_CHANGED, {message.receiver_id for message in messages}, {'reason': MESSAGE_CREATED})
+
+def statuses_changed(changes):
+    """Publish the (token, user_ids, status) changes of a bulk status update."""
+    if len(changes) <= get_bulk_threshold():
+        for token, user_ids, status in changes:
+            status_changed(token, user_ids, status)
+        return
+    user_ids = set()
+    for token, change_user_ids, status in changes:
+        user_ids.update(change_user_ids)
+    publish(INBOX_CHANGED, user_ids, {'reason': STATUS_CHANGED})
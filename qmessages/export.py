@@ -0,0 +1,170 @@
+"""
+Export of message history, with reply trees and status history, to NDJSON
+or CSV. Messages are read with a server-side cursor one chunk at a time and
+their replies and statuses are fetched per chunk, so memory stays bounded
+whatever the size of the export.
+"""
+import csv
+import datetime
+import io
+import json
+import zlib
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from qmessages.models import Message, MessageReply, MessageReplyStatus, MessageStatus
+from qmessages.utils import chunks
+
+
+NDJSON = 'ndjson'
+CSV = 'csv'
+FORMATS = (NDJSON, CSV)
+
+CSV_COLUMNS = [
+    'record', 'token', 'id', 'parent_reply', 'project', 'app', 'model', 'sender', 'receiver', 'replier',
+    'subject', 'text', 'status', 'deleted', 'created_at', 'updated_at',
+]
+
+MESSAGE_FIELDS = [
+    'id', 'token', 'project', 'app', 'model', 'sender__email', 'receiver__email', 'subject', 'text',
+    'deleted', 'created_at', 'updated_at',
+]
+REPLY_FIELDS = ['id', 'message_id', 'parent_reply_id', 'replier__email', 'text', 'deleted', 'created_at', 'updated_at']
+
+
+def parse_export_date(value):
+    """Parse an ISO date or datetime; naive values are taken in the current time zone."""
+    if not value:
+        return None
+    parsed = parse_datetime(value)
+    if parsed is None:
+        date = parse_date(value)
+        if date is None:
+            raise ValueError(f'Invalid date: {value!r}')
+        parsed = datetime.datetime.combine(date, datetime.time.min)
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
+
+def export_queryset(user=None, project=None, app=None, model=None, since=None, until=None, include_deleted=False):
+    """
+    Messages sent or received by `user`, in a project scope and created in
+    [since, until), oldest first.
+    """
+    queryset = Message.all_objects.all() if include_deleted else Message.objects.all()
+    if user is not None:
+        queryset = queryset.filter(Q(sender=user) | Q(receiver=user))
+    for field, value in (('project', project), ('app', app), ('model', model)):
+        if value is not None:
+            queryset = queryset.filter(**{field: value})
+    if since is not None:
+        queryset = queryset.filter(created_at__gte=since)
+    if until is not None:
+        queryset = queryset.filter(created_at__lt=until)
+    return queryset.order_by('created_at', 'id')
+
+
+# Records
+
+def status_history(queryset, key):
+    """Map each `key` value to its statuses, oldest first."""
+    statuses = {}
+    for object_id, desc, created_at in queryset.order_by('created_at', 'id').values_list(key, 'message_desc__desc', 'created_at'):
+        statuses.setdefault(object_id, []).append({'status': desc, 'created_at': created_at})
+    return statuses
+
+def iter_export_records(queryset, chunk_size=500, include_deleted=False):
+    """
+    Yield one dict per message of `queryset` with its status history and
+    full reply tree, every reply carrying its own status history.
+    """
+    reply_manager = MessageReply.all_objects if include_deleted else MessageReply.objects
+    rows = queryset.values(*MESSAGE_FIELDS).iterator(chunk_size=chunk_size)
+    for chunk in chunks(rows, chunk_size):
+        message_ids = [row['id'] for row in chunk]
+        message_statuses = status_history(MessageStatus.objects.filter(message_id__in=message_ids), 'message_id')
+        reply_rows = list(reply_manager.filter(message_id__in=message_ids).order_by('id').values(*REPLY_FIELDS))
+        reply_statuses = {}
+        for reply_ids in chunks([row['id'] for row in reply_rows]):
+            reply_statuses.update(status_history(MessageReplyStatus.objects.filter(message_reply_id__in=reply_ids), 'message_reply_id'))
+
+        replies, roots = {}, {message_id: [] for message_id in message_ids}
+        for row in reply_rows:
+            replies[row['id']] = {
+                'id': row['id'], 'parent_reply': row['parent_reply_id'], 'replier': row['replier__email'],
+                'text': row['text'], 'deleted': row['deleted'], 'created_at': row['created_at'],
+                'updated_at': row['updated_at'], 'statuses': reply_statuses.get(row['id'], []), 'replies': [],
+            }
+        for row in reply_rows:
+            reply = replies[row['id']]
+            if reply['parent_reply'] in replies:
+                replies[reply['parent_reply']]['replies'].append(reply)
+            else:
+                # Replies whose parent is left out are kept at the top level.
+                roots[row['message_id']].append(reply)
+
+        for row in chunk:
+            yield {
+                'id': row['id'], 'token': str(row['token']), 'project': row['project'], 'app': row['app'],
+                'model': row['model'], 'sender': row['sender__email'], 'receiver': row['receiver__email'],
+                'subject': row['subject'], 'text': row['text'], 'deleted': row['deleted'],
+                'created_at': row['created_at'], 'updated_at': row['updated_at'],
+                'statuses': message_statuses.get(row['id'], []), 'replies': roots[row['id']],
+            }
+
+
+# Writers
+
+def ndjson_lines(records):
+    for record in records:
+        yield json.dumps(record, cls=DjangoJSONEncoder) + '\n'
+
+def _csv_rows(record):
+    yield {
+        'record': 'message', 'token': record['token'], 'id': record['id'], 'project': record['project'],
+        'app': record['app'], 'model': record['model'], 'sender': record['sender'], 'receiver': record['receiver'],
+        'subject': record['subject'], 'text': record['text'], 'deleted': record['deleted'],
+        'created_at': record['created_at'], 'updated_at': record['updated_at'],
+    }
+    for status in record['statuses']:
+        yield {'record': 'message_status', 'token': record['token'], 'id': record['id'], **status}
+    stack = list(reversed(record['replies']))
+    while stack:
+        reply = stack.pop()
+        yield {
+            'record': 'reply', 'token': record['token'], 'id': reply['id'], 'parent_reply': reply['parent_reply'],
+            'replier': reply['replier'], 'text': reply['text'], 'deleted': reply['deleted'],
+            'created_at': reply['created_at'], 'updated_at': reply['updated_at'],
+        }
+        for status in reply['statuses']:
+            yield {'record': 'reply_status', 'token': record['token'], 'id': reply['id'], **status}
+        stack.extend(reversed(reply['replies']))
+
+def csv_lines(records):
+    """One row per message, reply and status, in thread order."""
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=CSV_COLUMNS)
+    writer.writeheader()
+    for record in records:
+        for row in _csv_rows(record):
+            writer.writerow({key: value.isoformat() if isinstance(value, datetime.datetime) else value for key, value in row.items()})
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+def export_lines(records, export_format):
+    if export_format == CSV:
+        return csv_lines(records)
+    return ndjson_lines(records)
+
+def gzip_chunks(lines, level=6):
+    """Compress an iterable of text into a gzip stream, chunk by chunk."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    for line in lines:
+        data = compressor.compress(line.encode())
+        if data:
+            yield data
+    yield compressor.flush()
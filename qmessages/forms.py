@@ -1,5 +1,5 @@
-
 from django import forms
+from django.conf import settings
 from qmessages.models import Message, MessageReply, Note
 from django.contrib.auth import get_user_model
 
@@ -32,6 +32,43 @@ class MessageForm(forms.ModelForm):
             instance.save()
         return instance
 
+class ReceiversField(forms.Field):
+    widget = forms.MultipleHiddenInput
+
+    def to_python(self, value):
+        if not value:
+            return []
+        try:
+            return [int(pk) for pk in value]
+        except (TypeError, ValueError):
+            raise forms.ValidationError('Receivers must be user ids.')
+
+class MessageBroadcastForm(forms.Form):
+    project = forms.CharField(max_length=255)
+    app = forms.CharField(max_length=255)
+    model = forms.CharField(max_length=255)
+    receivers = ReceiversField()
+    subject = forms.CharField(max_length=200)
+    text = forms.CharField(widget=forms.Textarea)
+
+    def __init__(self, *args, **kwargs):
+        self.user = kwargs.pop('user', None)
+        super(MessageBroadcastForm, self).__init__(*args, **kwargs)
+
+    def clean_receivers(self):
+        receivers = list(dict.fromkeys(self.cleaned_data.get('receivers')))
+        max_receivers = getattr(settings, 'QMESSAGES_BROADCAST_MAX_RECEIVERS', 1000)
+        if len(receivers) > max_receivers:
+            raise forms.ValidationError(f'At most {max_receivers} receivers per broadcast.')
+        users = User.objects.filter(pk__in=receivers)
+        if self.user:
+            users = users.exclude(id=self.user.id)
+        found = set(users.values_list('pk', flat=True))
+        missing = [pk for pk in receivers if pk not in found]
+        if missing:
+            raise forms.ValidationError(f'Unknown receivers: {", ".join(str(pk) for pk in missing)}')
+        return receivers
+
 class MessageReplyForm(forms.ModelForm):
     text = forms.CharField(widget=forms.Textarea)
 
@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+
+from qmessages.retention import RetentionPolicy, run_retention
+
+
+class Command(BaseCommand):
+    help = 'Move soft deleted and aged messages, replies and notes into the archive tables.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--max-batches', type=int, help='Stop after this many batches; the next run resumes.')
+        parser.add_argument('--pause', type=float, default=0, help='Seconds to sleep between batches.')
+        parser.add_argument('--dry-run', action='store_true', help='Only count the rows the policy selects.')
+
+    def handle(self, *args, **options):
+        policy = RetentionPolicy.from_settings()
+        if options['dry_run']:
+            self.stdout.write(
+                f'Would archive {policy.messages().count()} messages, '
+                f'{policy.replies().count()} deleted replies and {policy.notes().count()} notes.'
+            )
+            return
+
+        def progress(name, counts):
+            self.stdout.write(f"Archived {counts['messages']} messages, {counts['replies']} replies, {counts['notes']} notes...")
+
+        counts = run_retention(
+            policy, batch_size=options['batch_size'], max_batches=options['max_batches'], pause=options['pause'],
+            progress=progress if options['verbosity'] > 0 else None,
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f"Archived {counts['messages']} messages, {counts['replies']} replies and {counts['notes']} notes."
+        ))
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from qmessages.models import MessageReplyStatus, MessageStatus
+from qmessages.retention import compact_status_history
+
+
+class Command(BaseCommand):
+    help = 'Remove consecutive duplicate rows from the message and reply status history.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Messages or replies per batch.')
+
+    def handle(self, *args, **options):
+        def progress(model, deleted):
+            self.stdout.write(f'{model._meta.verbose_name_plural}: removed {deleted} rows...')
+
+        for model in (MessageStatus, MessageReplyStatus):
+            deleted = compact_status_history(
+                model, batch_size=options['batch_size'], progress=progress if options['verbosity'] > 1 else None,
+            )
+            self.stdout.write(self.style.SUCCESS(f'Removed {deleted} duplicate {model._meta.verbose_name_plural}.'))
@@ -0,0 +1,70 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from qmessages import export
+
+
+class Command(BaseCommand):
+    help = 'Export messages with their reply trees and status history to NDJSON or CSV.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', help='Only messages sent or received by this user id or username.')
+        parser.add_argument('--project')
+        parser.add_argument('--app')
+        parser.add_argument('--model')
+        parser.add_argument('--since', help='ISO date or datetime, inclusive.')
+        parser.add_argument('--until', help='ISO date or datetime, exclusive.')
+        parser.add_argument('--format', choices=export.FORMATS, default=export.NDJSON)
+        parser.add_argument('--gzip', action='store_true', help='Compress the output with gzip.')
+        parser.add_argument('--output', help='Write to this file instead of standard output.')
+        parser.add_argument('--include-deleted', action='store_true', help='Also export soft deleted messages and replies.')
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        if options['gzip'] and not options['output']:
+            raise CommandError('--gzip needs --output.')
+        try:
+            since = export.parse_export_date(options['since'])
+            until = export.parse_export_date(options['until'])
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        queryset = export.export_queryset(
+            user=self.get_user(options['user']), project=options['project'], app=options['app'], model=options['model'],
+            since=since, until=until, include_deleted=options['include_deleted'],
+        )
+        records = self.track_progress(
+            export.iter_export_records(queryset, chunk_size=options['batch_size'], include_deleted=options['include_deleted']),
+            options['batch_size'],
+        )
+        lines = export.export_lines(records, options['format'])
+
+        if not options['output']:
+            for line in lines:
+                self.stdout.write(line, ending='')
+        elif options['gzip']:
+            with open(options['output'], 'wb') as output:
+                for data in export.gzip_chunks(lines):
+                    output.write(data)
+        else:
+            with open(options['output'], 'w', encoding='utf-8', newline='') as output:
+                output.writelines(lines)
+        self.stderr.write(self.style.SUCCESS(f'Exported {self.exported} messages.'))
+
+    def get_user(self, value):
+        if value is None:
+            return None
+        User = get_user_model()
+        lookup = {'pk': value} if value.isdigit() else {User.USERNAME_FIELD: value}
+        try:
+            return User.objects.get(**lookup)
+        except User.DoesNotExist:
+            raise CommandError(f'No user {value!r}.')
+
+    def track_progress(self, records, every):
+        self.exported = 0
+        for record in records:
+            yield record
+            self.exported += 1
+            if self.exported % every == 0:
+                self.stderr.write(f'Exported {self.exported} messages...')
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from qmessages.counters import rebuild_unread_counts
+from qmessages.models import Message
+
+
+class Command(BaseCommand):
+    help = "Rebuild the current message status from the status history and recount every user's unread messages."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--skip-status', action='store_true', help='Keep the current status pointers and only recount.')
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        if not options['skip_status']:
+            updated = Message.rebuild_current_status()
+            self.stdout.write(f'Rebuilt the current status of {updated} messages.')
+        rebuilt = rebuild_unread_counts(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt unread counters for {rebuilt} users.'))
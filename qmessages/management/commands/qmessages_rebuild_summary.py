@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from qmessages.models import Message
+
+
+class Command(BaseCommand):
+    help = "Recompute every message's reply count and last reply from its live replies."
+
+    def handle(self, *args, **options):
+        updated = Message.rebuild_reply_summary()
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt the reply summary of {updated} messages.'))
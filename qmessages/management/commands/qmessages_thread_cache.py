@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from qmessages import thread_cache
+
+
+class Command(BaseCommand):
+    help = "Show the hit and miss counters of the serialized thread cache."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help='Reset the counters after showing them.')
+
+    def handle(self, *args, **options):
+        stats = thread_cache.get_stats()
+        ratio = 'n/a' if stats['hit_ratio'] is None else f"{stats['hit_ratio']:.1%}"
+        self.stdout.write(f"Hits: {stats['hits']}  Misses: {stats['misses']}  Hit ratio: {ratio}")
+        if options['reset']:
+            thread_cache.reset_stats()
+            self.stdout.write(self.style.SUCCESS('Counters reset.'))
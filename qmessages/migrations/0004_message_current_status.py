@@ -0,0 +1,34 @@
+# Generated by Django 5.2.18 on 2026-10-17 18:24
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('qmessages', '0003_alter_message_receiver_alter_message_sender'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='current_status',
+            field=models.ForeignKey(editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='%(class)s_current_status', to='qmessages.messagestatusdesc', verbose_name='current status'),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='current_status_at',
+            field=models.DateTimeField(editable=False, null=True, verbose_name='current status at'),
+        ),
+        migrations.AddField(
+            model_name='messagereply',
+            name='current_status',
+            field=models.ForeignKey(editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='%(class)s_current_status', to='qmessages.messagestatusdesc', verbose_name='current status'),
+        ),
+        migrations.AddField(
+            model_name='messagereply',
+            name='current_status_at',
+            field=models.DateTimeField(editable=False, null=True, verbose_name='current status at'),
+        ),
+    ]
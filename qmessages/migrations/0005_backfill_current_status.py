@@ -0,0 +1,34 @@
+# Generated by Django 5.2.18 on 2026-10-17 18:24
+
+from django.db import migrations
+from django.db.models import OuterRef, Subquery
+
+
+def backfill_current_status(apps, schema_editor):
+    Message = apps.get_model('qmessages', 'Message')
+    MessageStatus = apps.get_model('qmessages', 'MessageStatus')
+    MessageReply = apps.get_model('qmessages', 'MessageReply')
+    MessageReplyStatus = apps.get_model('qmessages', 'MessageReplyStatus')
+
+    latest_message_status = MessageStatus.objects.filter(message=OuterRef('pk')).order_by('-created_at', '-id')
+    Message.objects.update(
+        current_status_id=Subquery(latest_message_status.values('message_desc_id')[:1]),
+        current_status_at=Subquery(latest_message_status.values('created_at')[:1]),
+    )
+
+    latest_reply_status = MessageReplyStatus.objects.filter(message_reply=OuterRef('pk')).order_by('-created_at', '-id')
+    MessageReply.objects.update(
+        current_status_id=Subquery(latest_reply_status.values('message_desc_id')[:1]),
+        current_status_at=Subquery(latest_reply_status.values('created_at')[:1]),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('qmessages', '0004_message_current_status'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_current_status, migrations.RunPython.noop),
+    ]
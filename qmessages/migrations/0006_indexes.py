@@ -0,0 +1,58 @@
+# Generated by Django 5.2.18 on 2026-10-17 18:25
+
+import uuid
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('qmessages', '0005_backfill_current_status'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='message',
+            name='token',
+            field=models.UUIDField(default=uuid.uuid4, editable=False, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='note',
+            name='token',
+            field=models.UUIDField(default=uuid.uuid4, editable=False, unique=True),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['receiver', 'deleted', 'created_at'], name='qmessages_msg_receiver_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['sender', 'deleted', 'created_at'], name='qmessages_msg_sender_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(condition=models.Q(('deleted', False)), fields=['receiver', 'created_at'], name='qmessages_msg_receiver_live'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(condition=models.Q(('deleted', False)), fields=['sender', 'created_at'], name='qmessages_msg_sender_live'),
+        ),
+        migrations.AddIndex(
+            model_name='messagereply',
+            index=models.Index(condition=models.Q(('deleted', False)), fields=['message', 'parent_reply'], name='qmessages_reply_live_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='messagereplystatus',
+            index=models.Index(fields=['message_reply', 'created_at'], name='qmessages_rplstatus_rpl_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='messagestatus',
+            index=models.Index(fields=['message', 'created_at'], name='qmessages_msgstatus_msg_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='note',
+            index=models.Index(condition=models.Q(('deleted', False)), fields=['created_at'], name='qmessages_note_live_idx'),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 5.2.18 on 2026-10-17 18:26
+
+from django.db import migrations
+
+from qmessages.search import get_search_backend
+
+
+def create_search_index(apps, schema_editor):
+    get_search_backend(schema_editor.connection).create_table(schema_editor)
+
+
+def drop_search_index(apps, schema_editor):
+    get_search_backend(schema_editor.connection).drop_table(schema_editor)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('qmessages', '0006_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,64 @@
+# Generated by Django 5.2.18 on 2026-10-17 18:58
+
+import django.core.serializers.json
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('qmessages', '0007_search_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedMessage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('original_id', models.BigIntegerField(unique=True, verbose_name='original id')),
+                ('data', models.JSONField(encoder=django.core.serializers.json.DjangoJSONEncoder, verbose_name='data')),
+                ('created_at', models.DateTimeField(verbose_name='created at')),
+                ('archived_at', models.DateTimeField(auto_now_add=True, verbose_name='archived at')),
+                ('token', models.UUIDField(unique=True)),
+                ('project', models.CharField(max_length=255, null=True)),
+                ('app', models.CharField(max_length=255, null=True)),
+                ('model', models.CharField(max_length=255, null=True)),
+                ('sender_id', models.BigIntegerField(db_index=True, verbose_name='sender id')),
+                ('receiver_id', models.BigIntegerField(db_index=True, verbose_name='receiver id')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='ArchivedMessageReply',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('original_id', models.BigIntegerField(unique=True, verbose_name='original id')),
+                ('data', models.JSONField(encoder=django.core.serializers.json.DjangoJSONEncoder, verbose_name='data')),
+                ('created_at', models.DateTimeField(verbose_name='created at')),
+                ('archived_at', models.DateTimeField(auto_now_add=True, verbose_name='archived at')),
+                ('message_id', models.BigIntegerField(db_index=True, verbose_name='message id')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='ArchivedNote',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('original_id', models.BigIntegerField(unique=True, verbose_name='original id')),
+                ('data', models.JSONField(encoder=django.core.serializers.json.DjangoJSONEncoder, verbose_name='data')),
+                ('created_at', models.DateTimeField(verbose_name='created at')),
+                ('archived_at', models.DateTimeField(auto_now_add=True, verbose_name='archived at')),
+                ('token', models.UUIDField(unique=True)),
+                ('project', models.CharField(max_length=255, null=True)),
+                ('app', models.CharField(max_length=255, null=True)),
+                ('model', models.CharField(max_length=255, null=True)),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+    ]
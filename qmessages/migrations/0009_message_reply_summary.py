@@ -0,0 +1,48 @@
+# Generated by Django 5.2.18 on 2026-10-17 19:10
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def backfill_reply_summary(apps, schema_editor):
+    Message = apps.get_model('qmessages', 'Message')
+    MessageReply = apps.get_model('qmessages', 'MessageReply')
+
+    live_replies = MessageReply.objects.filter(message=OuterRef('pk'), deleted=False)
+    latest_reply = live_replies.order_by('-created_at', '-id')
+    reply_count = live_replies.order_by().values('message').annotate(count=Count('id')).values('count')
+    Message.objects.update(
+        reply_count=Coalesce(Subquery(reply_count), 0),
+        last_reply_at=Subquery(latest_reply.values('created_at')[:1]),
+        last_replier_id=Subquery(latest_reply.values('replier_id')[:1]),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('qmessages', '0008_archive'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='last_replier',
+            field=models.ForeignKey(editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='last_reply_at',
+            field=models.DateTimeField(editable=False, null=True, verbose_name='last reply at'),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='reply_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='reply count'),
+        ),
+        migrations.RunPython(backfill_reply_summary, migrations.RunPython.noop),
+    ]
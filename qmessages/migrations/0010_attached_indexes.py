@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-17 19:18
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('qmessages', '0009_message_reply_summary'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(condition=models.Q(('deleted', False)), fields=['project', 'app', 'model', 'created_at'], name='qmessages_msg_attached_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='note',
+            index=models.Index(condition=models.Q(('deleted', False)), fields=['project', 'app', 'model', 'created_at'], name='qmessages_note_attached_idx'),
+        ),
+    ]
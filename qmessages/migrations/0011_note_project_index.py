@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-17 19:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('qmessages', '0010_attached_indexes'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='note',
+            index=models.Index(condition=models.Q(('deleted', False)), fields=['project', 'created_at'], name='qmessages_note_project_idx'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-17 19:36
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('qmessages', '0011_note_project_index'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='message',
+            options={'permissions': [('broadcast_message', 'Can broadcast messages')]},
+        ),
+    ]
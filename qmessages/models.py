@@ -1,7 +1,19 @@
 import uuid
-from django.db import models
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import models, transaction
+from django.db.models import Case, Count, F, OuterRef, Q, Subquery, Value, When
+from django.db.models.functions import Coalesce
 from django.utils.translation import gettext_lazy as _
 from django.conf import settings
+from django.utils import timezone
+
+from qmessages import events
+from qmessages.conditional import bump_data_version
+from qmessages.counters import reset_unread_counts, track_status_change
+from qmessages.search import MESSAGE, REPLY, get_search_backend
+from qmessages.status import status_registry
+from qmessages.thread_cache import bump_all_thread_versions, bump_thread_versions
+from qmessages.utils import chunks
 
 
 class BaseModel(models.Model):
@@ -21,9 +33,72 @@ class BaseModel(models.Model):
 class BaseModelManager(models.Manager):
     def get_queryset(self):
         return super().get_queryset().filter(deleted=False)
-   
-class Message(BaseModel):
-    token = models.UUIDField(default=uuid.uuid4, editable=False)
+
+class StatusModel(BaseModel):
+    """
+    Keeps a pointer to the latest status row so reads don't have to sort the
+    status history. The pointer is written by the status models on save.
+    """
+    current_status = models.ForeignKey('MessageStatusDesc', related_name="%(class)s_current_status", verbose_name=_("current status"), null=True, editable=False, on_delete=models.SET_NULL)
+    current_status_at = models.DateTimeField(_("current status at"), null=True, editable=False)
+
+    # Written only with UPDATEs, so saving a stale instance can't roll them back.
+    protected_fields = ('current_status', 'current_status_at')
+
+    class Meta:
+        abstract = True
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding and not kwargs.get('force_insert') and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in self.protected_fields
+            ]
+        super().save(*args, **kwargs)
+
+    @classmethod
+    def set_current_status(cls, pk, message_desc_id, created_at):
+        # Only move forward, so an older status row saved late can't win.
+        return cls.all_objects.filter(
+            Q(pk=pk) & (Q(current_status_at__isnull=True) | Q(current_status_at__lte=created_at))
+        ).update(current_status_id=message_desc_id, current_status_at=created_at)
+
+class StatusHistoryModel(models.Model):
+    """Status row that updates the current status pointer of `status_field`."""
+    status_field = None
+
+    class Meta:
+        abstract = True
+
+    @classmethod
+    def record(cls, target, message_desc):
+        """
+        Add a `message_desc` row for `target` unless that is already its
+        current status, so repeated receipts don't grow the history. Returns
+        the new row or None.
+        """
+        with transaction.atomic():
+            related_model = cls._meta.get_field(cls.status_field).related_model
+            current_status_id = (
+                related_model.all_objects.select_for_update().filter(pk=target.pk)
+                .values_list('current_status_id', flat=True).first()
+            )
+            if current_status_id == message_desc.id:
+                return None
+            return cls.objects.create(**{cls.status_field: target, 'message_desc': message_desc})
+
+    def save(self, *args, **kwargs):
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            field = self._meta.get_field(self.status_field)
+            pk = getattr(self, field.attname)
+            if field.related_model.set_current_status(pk, self.message_desc_id, self.created_at) and field.is_cached(self):
+                target = getattr(self, self.status_field)
+                target.current_status_id = self.message_desc_id
+                target.current_status_at = self.created_at
+
+class Message(StatusModel):
+    token = models.UUIDField(default=uuid.uuid4, editable=False, unique=True)
     project = models.CharField(max_length=255, null=True)
     app = models.CharField(max_length=255, null=True)
     model = models.CharField(max_length=255, null=True)
@@ -33,10 +108,119 @@ class Message(BaseModel):
     text = models.TextField()
     created_at = models.DateTimeField(_("created at"), auto_now_add=True)
     updated_at = models.DateTimeField(_("updated at"), auto_now=True)
+    # Thread summary over the live replies, kept up to date as replies are added and deleted.
+    reply_count = models.PositiveIntegerField(_("reply count"), default=0, editable=False)
+    last_reply_at = models.DateTimeField(_("last reply at"), null=True, editable=False)
+    last_replier = models.ForeignKey(settings.AUTH_USER_MODEL, related_name="+", null=True, editable=False, on_delete=models.SET_NULL)
     
     objects = BaseModelManager()
 
-  
+    class Meta:
+        indexes = [
+            models.Index(fields=['receiver', 'deleted', 'created_at'], name='qmessages_msg_receiver_idx'),
+            models.Index(fields=['sender', 'deleted', 'created_at'], name='qmessages_msg_sender_idx'),
+            # Partial indexes are skipped on backends without support for them.
+            models.Index(fields=['receiver', 'created_at'], name='qmessages_msg_receiver_live', condition=Q(deleted=False)),
+            models.Index(fields=['sender', 'created_at'], name='qmessages_msg_sender_live', condition=Q(deleted=False)),
+            models.Index(fields=['project', 'app', 'model', 'created_at'], name='qmessages_msg_attached_idx', condition=Q(deleted=False)),
+        ]
+        permissions = [('broadcast_message', 'Can broadcast messages')]
+
+    @classmethod
+    def set_current_status(cls, pk, message_desc_id, created_at):
+        previous = (
+            cls.all_objects.select_for_update().filter(pk=pk)
+            .values('current_status_id', 'token', 'sender_id', 'receiver_id', 'deleted').first()
+        )
+        updated = super().set_current_status(pk, message_desc_id, created_at)
+        if updated and previous and not previous['deleted']:
+            transaction.on_commit(lambda: track_status_change(previous['receiver_id'], previous['current_status_id'], message_desc_id))
+            if previous['current_status_id'] != message_desc_id:
+                events.status_changed(
+                    previous['token'], [previous['sender_id'], previous['receiver_id']],
+                    status_registry.get_by_id(message_desc_id).desc,
+                )
+        return updated
+
+    @classmethod
+    def rebuild_current_status(cls):
+        """Recompute every message's current status from its status history."""
+        latest_status = MessageStatus.objects.filter(message=OuterRef('pk')).order_by('-created_at', '-id')
+        bump_data_version()
+        bump_all_thread_versions(cls.all_objects.values_list('pk', flat=True).iterator())
+        return cls.all_objects.update(
+            current_status_id=Subquery(latest_status.values('message_desc_id')[:1]),
+            current_status_at=Subquery(latest_status.values('created_at')[:1]),
+        )
+
+    summary_fields = ('reply_count', 'last_reply_at', 'last_replier')
+    protected_fields = StatusModel.protected_fields + summary_fields
+
+    @classmethod
+    def reply_added(cls, pk, created_at, replier_id):
+        """Count a new live reply; the last reply only moves forward."""
+        is_latest = Q(last_reply_at__isnull=True) | Q(last_reply_at__lte=created_at)
+        return cls.all_objects.filter(pk=pk).update(
+            reply_count=F('reply_count') + 1,
+            last_reply_at=Case(When(is_latest, then=Value(created_at)), default=F('last_reply_at')),
+            last_replier_id=Case(When(is_latest, then=Value(replier_id)), default=F('last_replier_id'), output_field=models.IntegerField()),
+        )
+
+    @classmethod
+    def replies_removed(cls, pk, count):
+        """Uncount `count` live replies and point the summary at the latest one left."""
+        latest_reply = MessageReply.objects.filter(message=OuterRef('pk')).order_by('-created_at', '-id')
+        return cls.all_objects.filter(pk=pk).update(
+            reply_count=F('reply_count') - count,
+            last_reply_at=Subquery(latest_reply.values('created_at')[:1]),
+            last_replier_id=Subquery(latest_reply.values('replier_id')[:1]),
+        )
+
+    @classmethod
+    def rebuild_reply_summary(cls):
+        """Recompute every message's reply count and last reply from its live replies."""
+        live_replies = MessageReply.objects.filter(message=OuterRef('pk'))
+        latest_reply = live_replies.order_by('-created_at', '-id')
+        reply_count = live_replies.order_by().values('message').annotate(count=Count('id')).values('count')
+        bump_data_version()
+        bump_all_thread_versions(cls.all_objects.values_list('pk', flat=True).iterator())
+        return cls.all_objects.update(
+            reply_count=Coalesce(Subquery(reply_count), 0),
+            last_reply_at=Subquery(latest_reply.values('created_at')[:1]),
+            last_replier_id=Subquery(latest_reply.values('replier_id')[:1]),
+        )
+
+    def delete(self, cascade=None):
+        """
+        Soft delete the message. With `cascade` (default: the
+        QMESSAGES_CASCADE_SOFT_DELETE setting) its replies are soft deleted
+        in the same transaction with a single UPDATE.
+        """
+        if cascade is None:
+            cascade = getattr(settings, 'QMESSAGES_CASCADE_SOFT_DELETE', False)
+        with transaction.atomic():
+            super().delete()
+            if cascade:
+                MessageReply.all_objects.filter(message=self, deleted=False).update(deleted=True, updated_at=timezone.now())
+                Message.all_objects.filter(pk=self.pk).update(reply_count=0, last_reply_at=None, last_replier=None)
+                self.reply_count, self.last_reply_at, self.last_replier_id = 0, None, None
+            transaction.on_commit(lambda: reset_unread_counts([self.receiver_id]))
+            bump_data_version()
+            bump_thread_versions([self.pk])
+
+    def hard_delete(self):
+        with transaction.atomic():
+            search_backend = get_search_backend()
+            search_backend.remove(MESSAGE, [self.pk])
+            search_backend.remove(REPLY, list(MessageReply.all_objects.filter(message=self).values_list('pk', flat=True)))
+            MessageReply.all_objects.filter(message=self).update(parent_reply=None)
+            MessageReplyStatus.objects.filter(message_reply__message=self).delete()
+            MessageReply.all_objects.filter(message=self).delete()
+            super().hard_delete()
+            transaction.on_commit(lambda: reset_unread_counts([self.receiver_id]))
+            bump_data_version()
+            bump_thread_versions([self.pk])
+
     def __str__(self):
         return f"{self.subject} - {str(self.token)}"
 
@@ -48,25 +232,29 @@ class MessageStatusDesc(models.Model):
     def __str__(self):
         return 'Desc: {}'.format(self.desc)
     
-class MessageStatus(models.Model): 
+class MessageStatus(StatusHistoryModel): 
     message_desc = models.ForeignKey(MessageStatusDesc,related_name="messagestatus_messagestatusdesc", verbose_name=_("message desc"), on_delete=models.CASCADE)
     message = models.ForeignKey(Message, related_name="message_status", verbose_name=_("message"), on_delete=models.CASCADE)
     created_at = models.DateTimeField(_("created at"), auto_now_add=True)
     updated_at = models.DateTimeField(_("updated at"), auto_now=True)
 
+    status_field = 'message'
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['message', 'created_at'], name='qmessages_msgstatus_msg_idx'),
+        ]
+
     def __str__(self):
         return 'Message Status: {} - Status Date: {} - Updated On: {}'.format(self.message_desc.desc, self.created_at, self.updated_at)
 
     def next_status(self):
-        status_list = list(MessageStatusDesc.objects.values_list('desc', flat=True))
-        current_status_index = status_list.index(self.message_desc.desc)
-        if current_status_index < len(status_list) - 1:
-            next_status_desc = status_list[current_status_index + 1]
-            next_status = MessageStatusDesc.objects.get(desc=next_status_desc)
+        next_status = status_registry.next(self.message_desc_id)
+        if next_status:
             self.message_desc = next_status
             self.save()
 
-class MessageReply(BaseModel):
+class MessageReply(StatusModel):
     message = models.ForeignKey(Message, on_delete=models.CASCADE)
     parent_reply = models.ForeignKey('self', null=True, blank=True, on_delete=models.CASCADE)
     text = models.TextField()
@@ -76,39 +264,89 @@ class MessageReply(BaseModel):
 
     objects = BaseModelManager()
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['message', 'parent_reply'], name='qmessages_reply_live_idx', condition=Q(deleted=False)),
+        ]
+
+    def get_subtree_ids(self):
+        """Return the ids of this reply and all its descendants, reading the thread once."""
+        children = {}
+        for pk, parent_reply_id in MessageReply.all_objects.filter(message_id=self.message_id).values_list('id', 'parent_reply_id'):
+            children.setdefault(parent_reply_id, []).append(pk)
+
+        subtree_ids, stack = [], [self.pk]
+        while stack:
+            pk = stack.pop()
+            subtree_ids.append(pk)
+            stack.extend(children.get(pk, []))
+        return subtree_ids
+
+    def save(self, *args, **kwargs):
+        adding = self._state.adding
+        with transaction.atomic(savepoint=False):
+            super().save(*args, **kwargs)
+            if adding and not self.deleted:
+                Message.reply_added(self.message_id, self.created_at, self.replier_id)
+
     def delete(self):
-        children = MessageReply.objects.filter(parent_reply=self)
-        for child in children:
-            child.delete()
-        super().delete()
+        now = timezone.now()
+        subtree_ids = self.get_subtree_ids()
+        with transaction.atomic():
+            removed = 0
+            for ids in chunks(subtree_ids):
+                removed += MessageReply.all_objects.filter(id__in=ids, deleted=False).update(deleted=True, updated_at=now)
+            if removed:
+                Message.replies_removed(self.message_id, removed)
+            get_search_backend().remove(REPLY, subtree_ids)
+            bump_thread_versions([self.message_id])
+        self.deleted = True
+        self.updated_at = now
 
     def hard_delete(self):
-        MessageReply.objects.filter(parent_reply=self).delete()
-        super().hard_delete()
+        subtree_ids = self.get_subtree_ids()
+        with transaction.atomic():
+            removed = 0
+            # Detach the subtree first so deleting it doesn't walk parent_reply level by level.
+            for ids in chunks(subtree_ids):
+                removed += MessageReply.objects.filter(id__in=ids).count()
+                MessageReply.all_objects.filter(id__in=ids).update(parent_reply=None)
+            for ids in chunks(subtree_ids):
+                MessageReplyStatus.objects.filter(message_reply_id__in=ids).delete()
+                MessageReply.all_objects.filter(id__in=ids).delete()
+            if removed:
+                Message.replies_removed(self.message_id, removed)
+            get_search_backend().remove(REPLY, subtree_ids)
+            bump_data_version()
+            bump_thread_versions([self.message_id])
 
     def __str__(self):
         return f"Id: {self.id} {self.text} - {str(self.message.token)}"
 
-class MessageReplyStatus(models.Model): 
+class MessageReplyStatus(StatusHistoryModel): 
     message_desc = models.ForeignKey(MessageStatusDesc,related_name="messagereplystatus_messagestatusdesc", verbose_name=_("message desc"), on_delete=models.CASCADE)
     message_reply = models.ForeignKey(MessageReply, related_name="message_reply_status", verbose_name=_("message reply"), on_delete=models.CASCADE)
     created_at = models.DateTimeField(_("created at"), auto_now_add=True)
     updated_at = models.DateTimeField(_("updated at"), auto_now=True)
 
+    status_field = 'message_reply'
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['message_reply', 'created_at'], name='qmessages_rplstatus_rpl_idx'),
+        ]
+
     def __str__(self):
         return 'Message Status: {} - Status Date: {} - Updated On: {}'.format(self.message_desc.desc, self.created_at, self.updated_at)
 
     def next_status(self):
-        status_list = list(MessageStatusDesc.objects.values_list('desc', flat=True))
-        current_status_index = status_list.index(self.message_desc.desc)
-        if current_status_index < len(status_list) - 1:
-            next_status_desc = status_list[current_status_index + 1]
-            next_status = MessageStatusDesc.objects.get(desc=next_status_desc)
+        next_status = status_registry.next(self.message_desc_id)
+        if next_status:
             self.message_desc = next_status
             self.save()
 
 class Note(BaseModel):
-    token = models.UUIDField(default=uuid.uuid4, editable=False)
+    token = models.UUIDField(default=uuid.uuid4, editable=False, unique=True)
     project = models.CharField(max_length=255, null=True)
     app = models.CharField(max_length=255, null=True)
     model = models.CharField(max_length=255, null=True)
@@ -118,5 +356,55 @@ class Note(BaseModel):
     
     objects = BaseModelManager()
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['created_at'], name='qmessages_note_live_idx', condition=Q(deleted=False)),
+            models.Index(fields=['project', 'app', 'model', 'created_at'], name='qmessages_note_attached_idx', condition=Q(deleted=False)),
+            models.Index(fields=['project', 'created_at'], name='qmessages_note_project_idx', condition=Q(deleted=False)),
+        ]
+
+    def __str__(self):
+        return f"{self.text[:50]} - {str(self.token)}"
+
+
+# Archive
+
+class ArchivedRecord(models.Model):
+    """
+    Row moved out of a hot table by the retention job. `data` holds the
+    original fields and status history; ids are kept as plain values so
+    the archive outlives the rows it points to.
+    """
+    original_id = models.BigIntegerField(_("original id"), unique=True)
+    data = models.JSONField(_("data"), encoder=DjangoJSONEncoder)
+    created_at = models.DateTimeField(_("created at"))
+    archived_at = models.DateTimeField(_("archived at"), auto_now_add=True)
+
+    class Meta:
+        abstract = True
+
+class ArchivedMessage(ArchivedRecord):
+    token = models.UUIDField(unique=True)
+    project = models.CharField(max_length=255, null=True)
+    app = models.CharField(max_length=255, null=True)
+    model = models.CharField(max_length=255, null=True)
+    sender_id = models.BigIntegerField(_("sender id"), db_index=True)
+    receiver_id = models.BigIntegerField(_("receiver id"), db_index=True)
+
+    def __str__(self):
+        return f"Archived message {self.original_id} - {str(self.token)}"
+
+class ArchivedMessageReply(ArchivedRecord):
+    message_id = models.BigIntegerField(_("message id"), db_index=True)
+
+    def __str__(self):
+        return f"Archived reply {self.original_id} - message {self.message_id}"
+
+class ArchivedNote(ArchivedRecord):
+    token = models.UUIDField(unique=True)
+    project = models.CharField(max_length=255, null=True)
+    app = models.CharField(max_length=255, null=True)
+    model = models.CharField(max_length=255, null=True)
+
     def __str__(self):
-        return f"{self.text[:50]} - {str(self.token)}"
\ No newline at end of file
+        return f"Archived note {self.original_id} - {str(self.token)}"
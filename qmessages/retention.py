@@ -0,0 +1,233 @@
+"""
+Retention of messages, replies and notes. Rows the policy selects are copied
+with their status history into the archive tables and deleted from the hot
+tables, one short transaction per batch of at most `batch_size` messages,
+replies or notes. Archived rows leave the candidate set, so an interrupted
+run picks up where it stopped when run again.
+"""
+import datetime
+import functools
+import time
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from qmessages.conditional import bump_data_version
+from qmessages.counters import reset_unread_counts
+from qmessages.export import status_history
+from qmessages.models import (
+    ArchivedMessage, ArchivedMessageReply, ArchivedNote, Message, MessageReply, MessageReplyStatus, MessageStatus, Note,
+)
+from qmessages.search import MESSAGE, NOTE, REPLY, get_search_backend
+from qmessages.thread_cache import bump_thread_versions
+from qmessages.utils import chunks
+
+
+class RetentionPolicy:
+    """
+    Which rows to archive: soft deleted ones when `archive_deleted` is set,
+    and messages or notes older than `max_age_days` / `note_max_age_days`.
+    Configured with the QMESSAGES_RETENTION setting.
+    """
+
+    def __init__(self, archive_deleted=True, max_age_days=None, note_max_age_days=None):
+        self.archive_deleted = archive_deleted
+        self.max_age_days = max_age_days
+        self.note_max_age_days = note_max_age_days
+
+    @classmethod
+    def from_settings(cls):
+        return cls(**getattr(settings, 'QMESSAGES_RETENTION', {}))
+
+    def _expired(self, model, max_age_days, now):
+        queryset = model.all_objects.none()
+        if self.archive_deleted:
+            queryset = model.all_objects.filter(deleted=True)
+        if max_age_days is not None:
+            cutoff = (now or timezone.now()) - datetime.timedelta(days=max_age_days)
+            queryset = queryset | model.all_objects.filter(created_at__lt=cutoff)
+        return queryset
+
+    def messages(self, now=None):
+        return self._expired(Message, self.max_age_days, now)
+
+    def replies(self):
+        """Soft deleted replies of messages that are kept."""
+        if not self.archive_deleted:
+            return MessageReply.all_objects.none()
+        return MessageReply.all_objects.filter(deleted=True)
+
+    def notes(self, now=None):
+        return self._expired(Note, self.note_max_age_days, now)
+
+
+# Batches
+
+def _rows(queryset):
+    fields = [field.attname for field in queryset.model._meta.concrete_fields]
+    return list(queryset.values(*fields))
+
+def _archived_replies(reply_rows):
+    statuses = {}
+    for ids in chunks([row['id'] for row in reply_rows]):
+        statuses.update(status_history(MessageReplyStatus.objects.filter(message_reply_id__in=ids), 'message_reply_id'))
+    return [
+        ArchivedMessageReply(
+            original_id=row['id'], message_id=row['message_id'], created_at=row['created_at'],
+            data={**row, 'statuses': statuses.get(row['id'], [])},
+        )
+        for row in reply_rows
+    ]
+
+def _delete_replies(reply_ids):
+    for ids in chunks(reply_ids):
+        # Detach first so the deletes don't cascade through parent_reply.
+        MessageReply.all_objects.filter(parent_reply_id__in=ids).update(parent_reply=None)
+    for ids in chunks(reply_ids):
+        MessageReplyStatus.objects.filter(message_reply_id__in=ids).delete()
+        MessageReply.all_objects.filter(id__in=ids).delete()
+
+def _archive_reply_rows(reply_rows):
+    ArchivedMessageReply.objects.bulk_create(_archived_replies(reply_rows), ignore_conflicts=True)
+    reply_ids = [row['id'] for row in reply_rows]
+    get_search_backend().remove(REPLY, reply_ids)
+    _delete_replies(reply_ids)
+
+def _archive_replies_in_batches(queryset, batch_size):
+    """
+    Archive and delete the replies of `queryset` with their status history,
+    at most `batch_size` replies per transaction. Newest first, so a reply's
+    parent is still there when it is archived. Returns the number of replies.
+    """
+    archived = 0
+    for reply_ids in iter_id_batches(queryset, 'id', batch_size, descending=True):
+        with transaction.atomic():
+            reply_rows = _rows(MessageReply.all_objects.select_for_update().filter(id__in=reply_ids).order_by('id'))
+            _archive_reply_rows(reply_rows)
+            message_ids = {row['message_id'] for row in reply_rows}
+            transaction.on_commit(lambda: bump_thread_versions(message_ids))
+            bump_data_version()
+        archived += len(reply_rows)
+    return archived
+
+def archive_messages(message_ids, batch_size=500):
+    """
+    Archive and delete the messages `message_ids` with all their replies.
+    The replies go first, `batch_size` per transaction, so a long thread
+    can't hold the locks of one huge transaction. Returns (messages, replies).
+    """
+    replies = _archive_replies_in_batches(MessageReply.all_objects.filter(message_id__in=message_ids), batch_size)
+    with transaction.atomic():
+        message_rows = _rows(Message.all_objects.select_for_update().filter(pk__in=message_ids))
+        message_ids = [row['id'] for row in message_rows]
+        statuses = status_history(MessageStatus.objects.filter(message_id__in=message_ids), 'message_id')
+        # Replies posted since the batches above; the lock keeps out any more.
+        reply_rows = _rows(MessageReply.all_objects.filter(message_id__in=message_ids).order_by('id'))
+
+        ArchivedMessage.objects.bulk_create([
+            ArchivedMessage(
+                original_id=row['id'], token=row['token'], project=row['project'], app=row['app'], model=row['model'],
+                sender_id=row['sender_id'], receiver_id=row['receiver_id'], created_at=row['created_at'],
+                data={**row, 'statuses': statuses.get(row['id'], [])},
+            )
+            for row in message_rows
+        ], ignore_conflicts=True)
+        _archive_reply_rows(reply_rows)
+        get_search_backend().remove(MESSAGE, message_ids)
+        MessageStatus.objects.filter(message_id__in=message_ids).delete()
+        Message.all_objects.filter(pk__in=message_ids).delete()
+
+        receiver_ids = [row['receiver_id'] for row in message_rows]
+        transaction.on_commit(lambda: reset_unread_counts(receiver_ids))
+        transaction.on_commit(lambda: bump_thread_versions(message_ids))
+        bump_data_version()
+    return len(message_rows), replies + len(reply_rows)
+
+def archive_replies(message_ids, batch_size=500):
+    """Archive and delete the soft deleted replies of `message_ids`, `batch_size` per transaction. Returns the number of replies."""
+    return _archive_replies_in_batches(MessageReply.all_objects.filter(message_id__in=message_ids, deleted=True), batch_size)
+
+def archive_notes(note_ids):
+    """Archive and delete the notes `note_ids`. Returns the number of notes."""
+    with transaction.atomic():
+        note_rows = _rows(Note.all_objects.select_for_update().filter(pk__in=note_ids))
+        ArchivedNote.objects.bulk_create([
+            ArchivedNote(
+                original_id=row['id'], token=row['token'], project=row['project'], app=row['app'], model=row['model'],
+                created_at=row['created_at'], data=row,
+            )
+            for row in note_rows
+        ], ignore_conflicts=True)
+        get_search_backend().remove(NOTE, [row['id'] for row in note_rows])
+        Note.all_objects.filter(pk__in=[row['id'] for row in note_rows]).delete()
+    return len(note_rows)
+
+def iter_id_batches(queryset, field, batch_size, descending=False):
+    """Walk the distinct values of `field` in `queryset` in ascending (or descending) batches."""
+    values = queryset.values_list(field, flat=True).order_by(f'-{field}' if descending else field).distinct()
+    lookup = f'{field}__lt' if descending else f'{field}__gt'
+    last = None
+    while True:
+        batch = list((values if last is None else values.filter(**{lookup: last}))[:batch_size])
+        if not batch:
+            return
+        yield batch
+        last = batch[-1]
+
+def run_retention(policy=None, batch_size=500, max_batches=None, pause=0, now=None, progress=None):
+    """
+    Apply `policy` (default: from settings) and return the archived counts.
+    `max_batches` bounds the run, `pause` sleeps between batches to leave
+    room for other writers and `progress` is called after every batch.
+    """
+    policy = policy or RetentionPolicy.from_settings()
+    counts = {'messages': 0, 'replies': 0, 'notes': 0}
+    sources = (
+        ('messages', policy.messages(now), 'id', functools.partial(archive_messages, batch_size=batch_size)),
+        ('replies', policy.replies(), 'message_id', functools.partial(archive_replies, batch_size=batch_size)),
+        ('notes', policy.notes(now), 'id', archive_notes),
+    )
+    batches = 0
+    for name, queryset, field, archive in sources:
+        for ids in iter_id_batches(queryset, field, batch_size):
+            if max_batches is not None and batches >= max_batches:
+                return counts
+            archived = archive(ids)
+            if name == 'messages':
+                counts['messages'] += archived[0]
+                counts['replies'] += archived[1]
+            else:
+                counts[name] += archived
+            batches += 1
+            if progress:
+                progress(name, counts)
+            if pause:
+                time.sleep(pause)
+    return counts
+
+
+# Status history
+
+def compact_status_history(model, batch_size=1000, progress=None):
+    """
+    Delete the rows of a status history model that repeat the status right
+    before them for the same target, keeping the first row of every run.
+    Targets are handled `batch_size` at a time. Returns the number deleted.
+    """
+    key = model._meta.get_field(model.status_field).attname
+    deleted = 0
+    for targets in iter_id_batches(model.objects.all(), key, batch_size):
+        duplicates, previous = [], None
+        rows = model.objects.filter(**{f'{key}__in': targets}).order_by(key, 'created_at', 'id').values_list('id', key, 'message_desc_id')
+        for pk, target, message_desc_id in rows:
+            if (target, message_desc_id) == previous:
+                duplicates.append(pk)
+            previous = (target, message_desc_id)
+        with transaction.atomic():
+            for ids in chunks(duplicates):
+                model.objects.filter(id__in=ids).delete()
+        deleted += len(duplicates)
+        if progress:
+            progress(model, deleted)
+    return deleted
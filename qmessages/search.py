@@ -0,0 +1,264 @@
+import abc
+
+from django.apps import apps
+from django.conf import settings
+from django.db import connection
+from django.utils.module_loading import import_string
+
+
+MESSAGE = 'message'
+REPLY = 'reply'
+NOTE = 'note'
+
+KINDS = {MESSAGE: 1, REPLY: 2, NOTE: 3}
+
+COLUMNS = ['id', 'kind', 'object_id', 'token', 'message_id', 'sender_id', 'receiver_id', 'project', 'app', 'model', 'title', 'body']
+
+
+def document_id(kind, object_id):
+    # One row per object; the kind is folded into the id so updates and
+    # deletes are primary key lookups on every backend.
+    return object_id * len(KINDS) + KINDS[kind]
+
+
+# Documents
+
+def message_document(message):
+    return {
+        'kind': MESSAGE, 'object_id': message.pk, 'token': str(message.token), 'message_id': message.pk,
+        'sender_id': message.sender_id, 'receiver_id': message.receiver_id,
+        'project': message.project, 'app': message.app, 'model': message.model,
+        'title': message.subject, 'body': message.text,
+    }
+
+def reply_document(reply):
+    message = reply.message
+    return {
+        'kind': REPLY, 'object_id': reply.pk, 'token': str(message.token), 'message_id': message.pk,
+        'sender_id': message.sender_id, 'receiver_id': message.receiver_id,
+        'project': message.project, 'app': message.app, 'model': message.model,
+        'title': '', 'body': reply.text,
+    }
+
+def note_document(note):
+    return {
+        'kind': NOTE, 'object_id': note.pk, 'token': str(note.token), 'message_id': None,
+        'sender_id': None, 'receiver_id': None,
+        'project': note.project, 'app': note.app, 'model': note.model,
+        'title': '', 'body': note.text,
+    }
+
+
+# Backends
+
+class SearchBackend(abc.ABC):
+    """
+    Keeps one row per message, reply and note in `table` and answers ranked
+    queries over it. Subclasses provide the table definition and the match
+    and rank SQL for their database.
+    """
+    table = 'qmessages_searchindex'
+    id_column = 'id'
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    @abc.abstractmethod
+    def create_table(self, schema_editor):
+        """Create `table` with `schema_editor`."""
+
+    def drop_table(self, schema_editor):
+        schema_editor.execute(f'DROP TABLE IF EXISTS {self.table}')
+
+    @abc.abstractmethod
+    def match_sql(self, query):
+        """
+        Return (where, where_params, rank, rank_params) for `query`. Rows with
+        a higher rank sort first.
+        """
+
+    def index(self, documents):
+        documents = list(documents)
+        if not documents:
+            return
+        self.remove_ids([document_id(d['kind'], d['object_id']) for d in documents])
+        columns = [self.id_column] + COLUMNS[1:]
+        rows = [[document_id(d['kind'], d['object_id'])] + [d[column] for column in COLUMNS[1:]] for d in documents]
+        with self.connection.cursor() as cursor:
+            cursor.executemany(
+                f'INSERT INTO {self.table} ({", ".join(columns)}) VALUES ({", ".join(["%s"] * len(columns))})', rows
+            )
+
+    def remove(self, kind, object_ids):
+        self.remove_ids([document_id(kind, object_id) for object_id in object_ids])
+
+    def remove_ids(self, ids):
+        with self.connection.cursor() as cursor:
+            for start in range(0, len(ids), 500):
+                chunk = ids[start:start + 500]
+                cursor.execute(f'DELETE FROM {self.table} WHERE {self.id_column} IN ({", ".join(["%s"] * len(chunk))})', chunk)
+
+    def clear(self):
+        with self.connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {self.table}')
+
+    def search(self, query, user_id=None, kinds=None, project=None, app=None, model=None, offset=0, limit=20):
+        """
+        Return (results, count) for `query`, best match first. With `user_id`
+        only the messages and replies the user sent or received are searched,
+        while notes, which have no owner, are left to the other filters.
+        """
+        if not query.split():
+            return [], 0
+        where, where_params, rank, rank_params = self.match_sql(query)
+        conditions, filter_params = [where], list(where_params)
+        if user_id is not None:
+            conditions.append('(sender_id = %s OR receiver_id = %s OR kind = %s)')
+            filter_params += [user_id, user_id, NOTE]
+        if kinds:
+            conditions.append(f'kind IN ({", ".join(["%s"] * len(kinds))})')
+            filter_params += list(kinds)
+        for column, value in (('project', project), ('app', app), ('model', model)):
+            if value is not None:
+                conditions.append(f'{column} = %s')
+                filter_params.append(value)
+        where_sql = ' AND '.join(conditions)
+
+        with self.connection.cursor() as cursor:
+            cursor.execute(f'SELECT COUNT(*) FROM {self.table} WHERE {where_sql}', filter_params)
+            count = cursor.fetchone()[0]
+            cursor.execute(
+                f'SELECT kind, object_id, token, title, body, {rank} AS score FROM {self.table} '
+                f'WHERE {where_sql} ORDER BY score DESC, {self.id_column} DESC LIMIT %s OFFSET %s',
+                list(rank_params) + filter_params + [limit, offset],
+            )
+            columns = [column[0] for column in cursor.description]
+            results = [dict(zip(columns, row)) for row in cursor.fetchall()]
+        return results, count
+
+
+class SQLiteSearchBackend(SearchBackend):
+    """FTS5 virtual table ranked with bm25(). The rowid doubles as the document id."""
+    id_column = 'rowid'
+
+    def create_table(self, schema_editor):
+        unindexed = ', '.join(f'{column} UNINDEXED' for column in COLUMNS[1:-2])
+        schema_editor.execute(f'CREATE VIRTUAL TABLE {self.table} USING fts5({unindexed}, title, body)')
+
+    def match_sql(self, query):
+        # Quote every term so user input can't be parsed as FTS5 syntax.
+        terms = ' '.join('"{}"'.format(term.replace('"', '""')) for term in query.split())
+        weights = ', '.join(['0'] * (len(COLUMNS) - 3) + ['2.0', '1.0'])
+        return f'{self.table} MATCH %s', [terms], f'-bm25({self.table}, {weights})', []
+
+
+class PostgreSQLSearchBackend(SearchBackend):
+    """Table with a generated, GIN-indexed tsvector ranked with ts_rank()."""
+
+    @property
+    def config(self):
+        return getattr(settings, 'QMESSAGES_SEARCH_CONFIG', 'simple')
+
+    def create_table(self, schema_editor):
+        config = schema_editor.quote_value(self.config)
+        schema_editor.execute(
+            f'CREATE TABLE {self.table} ('
+            'id bigint PRIMARY KEY, kind varchar(16) NOT NULL, object_id bigint NOT NULL, token varchar(36) NOT NULL, '
+            'message_id bigint NULL, sender_id bigint NULL, receiver_id bigint NULL, '
+            'project varchar(255) NULL, app varchar(255) NULL, model varchar(255) NULL, title text NOT NULL, body text NOT NULL, '
+            f"document tsvector GENERATED ALWAYS AS (setweight(to_tsvector({config}::regconfig, title), 'A') || "
+            f"setweight(to_tsvector({config}::regconfig, body), 'B')) STORED)"
+        )
+        schema_editor.execute(f'CREATE INDEX {self.table}_document_idx ON {self.table} USING GIN (document)')
+        schema_editor.execute(f'CREATE INDEX {self.table}_sender_idx ON {self.table} (sender_id)')
+        schema_editor.execute(f'CREATE INDEX {self.table}_receiver_idx ON {self.table} (receiver_id)')
+
+    def match_sql(self, query):
+        params = [self.config, query]
+        return (
+            'document @@ websearch_to_tsquery(%s::regconfig, %s)', params,
+            'ts_rank(document, websearch_to_tsquery(%s::regconfig, %s))', params,
+        )
+
+
+class BasicSearchBackend(SearchBackend):
+    """Plain table scanned with LIKE, for databases without full-text support."""
+
+    def create_table(self, schema_editor):
+        schema_editor.execute(
+            f'CREATE TABLE {self.table} ('
+            'id bigint PRIMARY KEY, kind varchar(16) NOT NULL, object_id bigint NOT NULL, token varchar(36) NOT NULL, '
+            'message_id bigint NULL, sender_id bigint NULL, receiver_id bigint NULL, '
+            'project varchar(255) NULL, app varchar(255) NULL, model varchar(255) NULL, title text NOT NULL, body text NOT NULL)'
+        )
+
+    def match_sql(self, query):
+        conditions, params = [], []
+        for term in query.split():
+            conditions.append('(LOWER(title) LIKE %s OR LOWER(body) LIKE %s)')
+            pattern = '%{}%'.format(term.lower())
+            params += [pattern, pattern]
+        return ' AND '.join(conditions), params, '0', []
+
+
+BACKENDS = {
+    'sqlite': SQLiteSearchBackend,
+    'postgresql': PostgreSQLSearchBackend,
+}
+
+def get_search_backend(using_connection=None):
+    using_connection = using_connection or connection
+    backend_path = getattr(settings, 'QMESSAGES_SEARCH_BACKEND', None)
+    backend_class = import_string(backend_path) if backend_path else BACKENDS.get(using_connection.vendor, BasicSearchBackend)
+    return backend_class(using_connection)
+
+
+# Indexing
+
+def index_message(message):
+    backend = get_search_backend()
+    if message.deleted:
+        MessageReply = apps.get_model('qmessages', 'MessageReply')
+        backend.remove(MESSAGE, [message.pk])
+        backend.remove(REPLY, list(MessageReply.all_objects.filter(message=message).values_list('pk', flat=True)))
+    else:
+        backend.index([message_document(message)])
+
+def index_reply(reply):
+    backend = get_search_backend()
+    if reply.deleted:
+        backend.remove(REPLY, [reply.pk])
+    else:
+        backend.index([reply_document(reply)])
+
+def index_note(note):
+    backend = get_search_backend()
+    if note.deleted:
+        backend.remove(NOTE, [note.pk])
+    else:
+        backend.index([note_document(note)])
+
+def rebuild_index(batch_size=500):
+    """Replace the whole index with the live messages, replies and notes. Returns the number indexed."""
+    Message = apps.get_model('qmessages', 'Message')
+    MessageReply = apps.get_model('qmessages', 'MessageReply')
+    Note = apps.get_model('qmessages', 'Note')
+    backend = get_search_backend()
+    backend.clear()
+    indexed = 0
+    sources = (
+        (Message.objects.order_by('pk'), message_document),
+        (MessageReply.objects.filter(message__deleted=False).select_related('message').order_by('pk'), reply_document),
+        (Note.objects.order_by('pk'), note_document),
+    )
+    for queryset, to_document in sources:
+        batch = []
+        for obj in queryset.iterator(chunk_size=batch_size):
+            batch.append(to_document(obj))
+            if len(batch) >= batch_size:
+                backend.index(batch)
+                indexed += len(batch)
+                batch = []
+        backend.index(batch)
+        indexed += len(batch)
+    return indexed
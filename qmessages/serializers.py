@@ -0,0 +1,183 @@
+from django.db.models import Prefetch
+from django.db.models.functions import Substr
+from django.forms import model_to_dict
+
+from qmessages import thread_cache
+from qmessages.models import Message, MessageReply
+from qmessages.threads import build_reply_tree
+from qmessages.utils import chunks
+
+
+# Querysets
+
+def thread_queryset(queryset):
+    """
+    Prepare a Message queryset so a whole page of threads can be serialized
+    with a fixed number of queries: the sender and the current status come
+    with the page itself and every reply of the page comes in one prefetch.
+    """
+    replies = MessageReply.objects.select_related('replier', 'current_status').order_by('id')
+    return (
+        queryset.select_related('sender', 'current_status')
+        .prefetch_related(Prefetch('messagereply_set', queryset=replies, to_attr='thread_replies'))
+    )
+
+def note_preview_queryset(queryset, preview_length):
+    """Load notes without `text`; the database cuts the `preview` instead."""
+    return queryset.defer('text').annotate(preview=Substr('text', 1, preview_length))
+
+MESSAGE_VALUES = {
+    'id': 'id', 'deleted': 'deleted', 'project': 'project', 'app': 'app', 'model': 'model',
+    'sender': 'sender__email', 'receiver': 'receiver_id', 'subject': 'subject', 'text': 'text', 'token': 'token',
+    'created_at': 'created_at', 'updated_at': 'updated_at', 'reply_count': 'reply_count',
+    'last_reply_at': 'last_reply_at', 'last_replier': 'last_replier_id', 'status': 'current_status__desc',
+}
+
+REPLY_VALUES = {
+    'id': 'id', 'deleted': 'deleted', 'message': 'message_id', 'parent_reply': 'parent_reply_id', 'text': 'text',
+    'replier': 'replier__email', 'created_at': 'created_at', 'updated_at': 'updated_at', 'status': 'current_status__desc',
+}
+
+
+# Serializers
+
+def serialize_reply(reply):
+    reply_dict = model_to_dict(reply)
+    reply_dict['created_at'] = reply.created_at
+    reply_dict['updated_at'] = reply.updated_at
+    reply_dict['replier'] = reply.replier.email
+    if reply.current_status:
+        reply_dict['status'] = reply.current_status.desc
+    return reply_dict
+
+def serialize_message(message):
+    message_dict = model_to_dict(message)
+    message_dict['token'] = str(message.token)
+    message_dict['sender'] = message.sender.email
+    message_dict['created_at'] = message.created_at
+    message_dict['updated_at'] = message.updated_at
+    message_dict['reply_count'] = message.reply_count
+    message_dict['last_reply_at'] = message.last_reply_at
+    message_dict['last_replier'] = message.last_replier_id
+    if message.current_status:
+        message_dict['status'] = message.current_status.desc
+
+    # Walk the tree without recursion so deep threads can't hit the stack limit.
+    reply_list = []
+    stack = [(reply_list, build_reply_tree(message.thread_replies))]
+    while stack:
+        target, replies = stack.pop()
+        for reply in replies:
+            reply_dict = serialize_reply(reply)
+            reply_dict['replies'] = []
+            target.append(reply_dict)
+            stack.append((reply_dict['replies'], reply.children))
+
+    message_dict['replies'] = reply_list
+    return message_dict
+
+def serialize_note(note, preview=False):
+    """Serialize a note; with `preview`, one loaded through `note_preview_queryset`."""
+    note_dict = {
+        'token': str(note.token), 'project': note.project, 'app': note.app, 'model': note.model,
+        'created_at': note.created_at, 'updated_at': note.updated_at,
+    }
+    if preview:
+        note_dict['preview'] = note.preview
+    else:
+        note_dict['text'] = note.text
+    return note_dict
+
+def serialize_messages(messages):
+    """Serialize messages fetched through `thread_queryset`."""
+    return [serialize_message(message) for message in messages]
+
+def serialize_threads(message_ids):
+    """
+    Serialize the threads of `message_ids` in order. Cached threads are read
+    in one batch; the rest are fetched together through `thread_queryset`
+    and cached for the next reader.
+    """
+    threads, missing_keys = thread_cache.get_threads(message_ids)
+    if missing_keys:
+        fresh = {
+            message.pk: serialize_message(message)
+            for message in thread_queryset(Message.objects.filter(pk__in=list(missing_keys)))
+        }
+        thread_cache.set_threads(fresh, missing_keys)
+        threads.update(fresh)
+    return [threads[message_id] for message_id in message_ids if message_id in threads]
+
+def _values_dict(row, fields):
+    # Same keys, in the same order, as the model-based serializers.
+    values = {key: row[lookup] for key, lookup in fields.items()}
+    if values['status'] is None:
+        del values['status']
+    return values
+
+def _reply_rows(chunk):
+    return (
+        MessageReply.objects.filter(message_id__in=[row['id'] for row in chunk])
+        .order_by('id').values(*REPLY_VALUES.values())
+    )
+
+def _chunk_thread_dicts(chunk, reply_rows):
+    replies = {}
+    for row in reply_rows:
+        reply_dict = _values_dict(row, REPLY_VALUES)
+        reply_dict['replies'] = []
+        replies[reply_dict['id']] = reply_dict
+
+    roots = {row['id']: [] for row in chunk}
+    for reply_dict in replies.values():
+        if reply_dict['parent_reply'] is None:
+            roots[reply_dict['message']].append(reply_dict)
+        elif reply_dict['parent_reply'] in replies:
+            replies[reply_dict['parent_reply']]['replies'].append(reply_dict)
+
+    for row in chunk:
+        message_dict = _values_dict(row, MESSAGE_VALUES)
+        message_dict['token'] = str(message_dict['token'])
+        message_dict['replies'] = roots[row['id']]
+        yield message_dict
+
+def iter_thread_dicts(rows, chunk_size=500):
+    """
+    Yield the serialized thread of every Message values() row in `rows`,
+    built without model instances. Replies are fetched one chunk of
+    messages at a time, so memory follows `chunk_size`, not the row count.
+    """
+    for chunk in chunks(rows, chunk_size):
+        yield from _chunk_thread_dicts(chunk, _reply_rows(chunk))
+
+async def aiter_thread_dicts(rows, chunk_size=500):
+    """`iter_thread_dicts` for an async iterator of rows, reading replies with the async ORM."""
+    chunk = []
+    async for row in rows:
+        chunk.append(row)
+        if len(chunk) == chunk_size:
+            reply_rows = [reply_row async for reply_row in _reply_rows(chunk)]
+            for message_dict in _chunk_thread_dicts(chunk, reply_rows):
+                yield message_dict
+            chunk = []
+    if chunk:
+        reply_rows = [reply_row async for reply_row in _reply_rows(chunk)]
+        for message_dict in _chunk_thread_dicts(chunk, reply_rows):
+            yield message_dict
+
+def thread_values(queryset):
+    """The values() rows `iter_thread_dicts` needs from a Message queryset."""
+    return queryset.select_related(None).prefetch_related(None).values(*MESSAGE_VALUES.values())
+
+def summary_dict(row):
+    """Serialize a `thread_values` row without its replies."""
+    message_dict = _values_dict(row, MESSAGE_VALUES)
+    message_dict['token'] = str(message_dict['token'])
+    return message_dict
+
+def serialize_summaries(queryset):
+    """
+    Serialize the messages of `queryset` without their replies, from a single
+    values() query; `reply_count` and `last_reply_at` stand in for the thread.
+    """
+    return [summary_dict(row) for row in thread_values(queryset)]
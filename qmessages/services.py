@@ -0,0 +1,225 @@
+import uuid
+
+from django.db import transaction
+from django.db.models import Q, QuerySet
+from django.utils import timezone
+
+from qmessages import events
+from qmessages.counters import reset_unread_counts, track_status_change
+from qmessages.models import Message, MessageReply, MessageReplyStatus, MessageStatus
+from qmessages.search import get_search_backend, message_document
+from qmessages.serializers import summary_dict, thread_values
+from qmessages.status import REPLIED, UNREAD, status_registry
+from qmessages.thread_cache import bump_thread_versions
+from qmessages.utils import check_token, chunks
+
+
+def send_message(sender, receiver, subject, text, project=None, app=None, model=None):
+    """
+    Create a message with its initial "Unread" status in one transaction.
+    The current status is written with the message, so the status row is
+    a plain insert.
+    """
+    status_desc = status_registry.get(UNREAD)
+    with transaction.atomic():
+        message = Message(
+            sender=sender, receiver=receiver, subject=subject, text=text, project=project, app=app, model=model,
+            current_status=status_desc, current_status_at=timezone.now(),
+        )
+        message.save()
+        MessageStatus.objects.bulk_create([MessageStatus(message=message, message_desc=status_desc)])
+        transaction.on_commit(lambda: track_status_change(message.receiver_id, None, status_desc.id))
+        events.message_created(message)
+    return message
+
+def post_reply(token, replier, text, parent_reply_id=None):
+    """
+    Reply to the message `token`, under `parent_reply_id` if given, and
+    record the statuses a reply implies: the parent reply becomes "Replied",
+    the new reply "Unread", and the message moves between "Unread" and
+    "Replied". The message row is locked first, so concurrent replies to the
+    same thread see each other's status. Raises Message.DoesNotExist or
+    MessageReply.DoesNotExist for unknown ids.
+    """
+    unread = status_registry.get(UNREAD)
+    replied = status_registry.get(REPLIED)
+    with transaction.atomic():
+        message = Message.objects.select_for_update().get(token=token)
+        parent_reply = None
+        if parent_reply_id is not None and parent_reply_id != '':
+            parent_reply = MessageReply.objects.get(pk=parent_reply_id, message=message)
+        previous_status_id = message.current_status_id
+
+        reply = MessageReply(
+            message=message, parent_reply=parent_reply, replier=replier, text=text,
+            current_status=unread, current_status_at=timezone.now(),
+        )
+        reply.save()
+
+        reply_statuses = [MessageReplyStatus(message_reply=reply, message_desc=unread)]
+        if parent_reply:
+            reply_statuses.insert(0, MessageReplyStatus(message_reply=parent_reply, message_desc=replied))
+            message_descs = [replied if previous_status_id == unread.id else unread]
+        else:
+            # A top level reply marks the message unread, which the reply itself then answers.
+            message_descs = [unread, replied]
+        message_statuses = [MessageStatus(message=message, message_desc=desc) for desc in message_descs]
+        MessageReplyStatus.objects.bulk_create(reply_statuses)
+        MessageStatus.objects.bulk_create(message_statuses)
+
+        if parent_reply:
+            parent_status = reply_statuses[0]
+            MessageReply.all_objects.filter(pk=parent_reply.pk).update(
+                current_status=replied, current_status_at=parent_status.created_at,
+            )
+            parent_reply.current_status, parent_reply.current_status_at = replied, parent_status.created_at
+        message.current_status, message.current_status_at = message_descs[-1], message_statuses[-1].created_at
+        Message.all_objects.filter(pk=message.pk).update(
+            current_status=message.current_status, current_status_at=message.current_status_at,
+        )
+
+        final_status_id = message.current_status_id
+        transaction.on_commit(lambda: track_status_change(message.receiver_id, previous_status_id, final_status_id))
+        events.reply_created(reply)
+        if final_status_id != previous_status_id:
+            events.status_changed(message.token, [message.sender_id, message.receiver_id], message.current_status.desc)
+    return reply
+
+def broadcast_message(sender, receivers, subject, text, project=None, app=None, model=None, batch_size=500):
+    """
+    Send the same message from `sender` to every user in `receivers`, which
+    may be a user queryset or a list of users or user ids. Messages and their
+    initial "Unread" status are written with batched bulk inserts in a single
+    transaction. Returns the created tokens in receiver order.
+    """
+    if isinstance(receivers, QuerySet):
+        receiver_ids = receivers.values_list('pk', flat=True)
+    else:
+        receiver_ids = [getattr(receiver, 'pk', receiver) for receiver in receivers]
+
+    status_desc = status_registry.get(UNREAD)
+    now = timezone.now()
+    search_backend = get_search_backend()
+    tokens, created = [], []
+    with transaction.atomic():
+        for ids in chunks(receiver_ids, batch_size):
+            messages = [
+                Message(
+                    token=uuid.uuid4(), sender=sender, receiver_id=receiver_id, subject=subject, text=text,
+                    project=project, app=app, model=model, current_status=status_desc, current_status_at=now,
+                )
+                for receiver_id in ids
+            ]
+            Message.objects.bulk_create(messages, batch_size=batch_size)
+            if messages[0].pk is None:
+                # Backends that can't return ids from bulk inserts.
+                pks = dict(Message.objects.filter(token__in=[m.token for m in messages]).values_list('token', 'pk'))
+                for message in messages:
+                    message.pk = pks[message.token]
+            MessageStatus.objects.bulk_create(
+                [MessageStatus(message_desc=status_desc, message=message) for message in messages],
+                batch_size=batch_size,
+            )
+            search_backend.index(message_document(message) for message in messages)
+            created.extend(messages)
+            tokens.extend(message.token for message in messages)
+            transaction.on_commit(lambda ids=ids: reset_unread_counts(ids))
+        events.messages_created(created)
+    return tokens
+
+
+UPDATED = 'updated'
+UNCHANGED = 'unchanged'
+NO_STATUS = 'no_status'
+NOT_FOUND = 'not_found'
+INVALID = 'invalid'
+
+def bulk_set_status(user, tokens=None, status_desc=None, batch_size=500):
+    """
+    Move the messages of `tokens` that `user` sent or received to
+    `status_desc`, or each to its next status when `status_desc` is None.
+    With `tokens=None` every message the user received is moved ("mark all").
+    The messages are locked with one scoped query per batch of tokens, the
+    status rows are written with one bulk insert and the current status
+    pointers with one UPDATE per target status, all in one transaction.
+
+    Returns {token: result}, the result being one of UPDATED, UNCHANGED,
+    NO_STATUS, NOT_FOUND or INVALID. "Mark all" only reports updated tokens.
+    """
+    results = {}
+    if tokens is None:
+        querysets = [Message.objects.filter(receiver=user)]
+        if status_desc is not None:
+            querysets = [querysets[0].exclude(current_status=status_desc)]
+    else:
+        valid_tokens = {}
+        for token in tokens:
+            uuid_token = check_token([token])
+            if uuid_token:
+                valid_tokens[uuid_token[0]] = token
+            else:
+                results[token] = INVALID
+        querysets = [
+            Message.objects.filter(Q(sender=user) | Q(receiver=user), token__in=batch)
+            for batch in chunks(valid_tokens, batch_size)
+        ]
+
+    with transaction.atomic():
+        statuses, targets, changed = [], {}, []
+        for queryset in querysets:
+            rows = queryset.select_for_update().values_list('pk', 'token', 'current_status_id', 'sender_id', 'receiver_id')
+            for pk, token, current_status_id, sender_id, receiver_id in rows:
+                key = valid_tokens[token] if tokens is not None else str(token)
+                if status_desc is None and current_status_id is None:
+                    results[key] = NO_STATUS
+                    continue
+                target = status_desc or status_registry.next(current_status_id)
+                if target is None or target.id == current_status_id:
+                    results[key] = UNCHANGED
+                    continue
+                results[key] = UPDATED
+                statuses.append(MessageStatus(message_id=pk, message_desc=target))
+                targets.setdefault(target, []).append(pk)
+                changed.append((pk, token, sender_id, receiver_id, target.desc))
+
+        if statuses:
+            MessageStatus.objects.bulk_create(statuses, batch_size=batch_size)
+            created_at = statuses[0].created_at
+            for target, pks in targets.items():
+                for ids in chunks(pks, batch_size):
+                    Message.all_objects.filter(pk__in=ids).update(current_status=target, current_status_at=created_at)
+
+            receiver_ids = [receiver_id for pk, token, sender_id, receiver_id, desc in changed]
+            transaction.on_commit(lambda: reset_unread_counts(receiver_ids))
+            bump_thread_versions([pk for pk, token, sender_id, receiver_id, desc in changed])
+            events.statuses_changed([(token, [sender_id, receiver_id], desc) for pk, token, sender_id, receiver_id, desc in changed])
+
+    if tokens is not None:
+        for token in valid_tokens.values():
+            results.setdefault(token, NOT_FOUND)
+    return results
+
+
+def resolve_tokens(user, uuid_tokens, batch_size=500):
+    """
+    Resolve `uuid_tokens` to message summaries with one `token__in` query
+    per batch. Returns (found, missing, forbidden): the summaries of the
+    messages `user` sent or received keyed by token, then the tokens that
+    match no live message and those of messages that belong to others.
+    Only the tokens left unresolved are looked up a second time.
+    """
+    found = {}
+    for batch in chunks(uuid_tokens, batch_size):
+        for row in thread_values(Message.objects.filter(Q(sender=user) | Q(receiver=user), token__in=batch)):
+            found[row['token']] = summary_dict(row)
+
+    unresolved = [token for token in uuid_tokens if token not in found]
+    existing = set()
+    for batch in chunks(unresolved, batch_size):
+        existing.update(Message.objects.filter(token__in=batch).values_list('token', flat=True))
+
+    return (
+        {str(token): found[token] for token in uuid_tokens if token in found},
+        [str(token) for token in unresolved if token not in existing],
+        [str(token) for token in unresolved if token in existing],
+    )
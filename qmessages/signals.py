@@ -0,0 +1,57 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from qmessages.models import Message, MessageReply, MessageReplyStatus, MessageStatus, MessageStatusDesc, Note
+from qmessages.search import index_message, index_note, index_reply
+from qmessages.status import status_registry
+from qmessages.thread_cache import bump_thread_versions
+
+
+@receiver(post_save, sender=MessageStatusDesc)
+@receiver(post_delete, sender=MessageStatusDesc)
+def clear_status_registry(sender, **kwargs):
+    status_registry.clear()
+
+
+# Hard deletes are removed from the search index by the models' hard_delete
+# methods, so the bulk delete paths stay free of per-row signals.
+
+@receiver(post_save, sender=Message)
+def update_message_search_index(sender, instance, **kwargs):
+    index_message(instance)
+
+
+@receiver(post_save, sender=MessageReply)
+def update_reply_search_index(sender, instance, **kwargs):
+    index_reply(instance)
+
+
+@receiver(post_save, sender=Note)
+def update_note_search_index(sender, instance, **kwargs):
+    index_note(instance)
+
+
+# Bulk updates and hard deletes bump the thread versions in the models.
+
+@receiver(post_save, sender=Message)
+def bump_message_thread(sender, instance, **kwargs):
+    bump_thread_versions([instance.pk])
+
+
+@receiver(post_save, sender=MessageReply)
+def bump_reply_thread(sender, instance, **kwargs):
+    bump_thread_versions([instance.message_id])
+
+
+@receiver(post_save, sender=MessageStatus)
+def bump_message_status_thread(sender, instance, **kwargs):
+    bump_thread_versions([instance.message_id])
+
+
+@receiver(post_save, sender=MessageReplyStatus)
+def bump_reply_status_thread(sender, instance, **kwargs):
+    if sender.message_reply.is_cached(instance):
+        message_id = instance.message_reply.message_id
+    else:
+        message_id = MessageReply.all_objects.filter(pk=instance.message_reply_id).values_list('message_id', flat=True).first()
+    bump_thread_versions([message_id])
@@ -0,0 +1,68 @@
+import threading
+
+from django.apps import apps
+
+
+UNREAD = 'Unread'
+READ = 'Read'
+REPLIED = 'Replied'
+
+# The status a row moves to on `next_status()`. Statuses missing from the
+# table are final.
+TRANSITIONS = {
+    UNREAD: READ,
+    READ: REPLIED,
+}
+
+
+class StatusRegistry:
+    """
+    Process-level cache of MessageStatusDesc rows. It is loaded on first use
+    and cleared by the save/delete signals of MessageStatusDesc.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._by_desc = None
+        self._by_id = None
+
+    def _load(self):
+        with self._lock:
+            if self._by_desc is None:
+                MessageStatusDesc = apps.get_model('qmessages', 'MessageStatusDesc')
+                by_desc, by_id = {}, {}
+                for status_desc in MessageStatusDesc.objects.order_by('id'):
+                    by_desc.setdefault(status_desc.desc, status_desc)
+                    by_id[status_desc.id] = status_desc
+                self._by_id = by_id
+                self._by_desc = by_desc
+        return self._by_desc, self._by_id
+
+    def clear(self):
+        with self._lock:
+            self._by_desc = None
+            self._by_id = None
+
+    def get(self, desc):
+        by_desc, by_id = self._load()
+        try:
+            return by_desc[desc]
+        except KeyError:
+            raise apps.get_model('qmessages', 'MessageStatusDesc').DoesNotExist(f'No status named {desc!r}')
+
+    def get_by_id(self, pk):
+        by_desc, by_id = self._load()
+        try:
+            return by_id[pk]
+        except KeyError:
+            raise apps.get_model('qmessages', 'MessageStatusDesc').DoesNotExist(f'No status with id {pk!r}')
+
+    def next(self, pk):
+        """Return the status that follows status `pk`, or None if it is final."""
+        next_desc = TRANSITIONS.get(self.get_by_id(pk).desc)
+        if next_desc is None:
+            return None
+        return self.get(next_desc)
+
+
+status_registry = StatusRegistry()
@@ -1,7 +1,37 @@
-from django.test import TestCase, RequestFactory
-from django.contrib.auth.models import User
-from qmessages.models import Message, MessageStatus, MessageStatusDesc, Note
-from qmessages.views import MessageCreateView, MessageStatusUpdateView, NoteCreateView
+import asyncio
+import base64
+import datetime
+import gzip
+import json
+import math
+import uuid
+from io import StringIO
+from unittest import mock, skipUnless
+
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.http import QueryDict
+from django.test import AsyncRequestFactory, TestCase, RequestFactory, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.contrib.auth.models import Permission, User
+from qmessages.attached import attached_messages, attached_notes
+from qmessages.checks import check_shared_cache
+from qmessages.async_views import AsyncMessageDetailView, AsyncMessageListView, AsyncMessageReplyCreateView
+from qmessages.conditional import get_data_version
+from qmessages.counters import unread_cache_key
+from qmessages.events import EventBus, InMemoryEventBus, get_event_bus
+from qmessages.models import ArchivedMessage, ArchivedMessageReply, ArchivedNote, Message, MessageReply, MessageReplyStatus, MessageStatus, MessageStatusDesc, Note
+from qmessages.retention import RetentionPolicy, run_retention
+from qmessages.search import SearchBackend
+from qmessages.services import broadcast_message, bulk_set_status, post_reply, resolve_tokens, send_message
+from qmessages.status import READ, REPLIED, UNREAD, status_registry
+from qmessages import thread_cache
+from qmessages.threads import get_reply_tree
+from qmessages.utils import KendoQueryError, compile_kendo_query
+from qmessages.views import AttachedView, MessageBroadcastView, MessageCreateView, MessageDetailView, MessageExportView, MessageListView, MessageReplyCreateView, MessageResolveView, MessageStatusUpdateView, MessageStreamView, NoteCreateView, NoteDetailView, NoteListView, SearchView, UnreadCountView
 
 class NoteCreateViewTest(TestCase):
     def setUp(self):
@@ -87,45 +117,1292 @@ class MessageStatusUpdateViewTests(TestCase):
     def setUp(self):
         self.factory = RequestFactory()
         self.user = User.objects.create_user(username='testuser', password='testpassword')
-        message = Message.objects.create(
-            project='Test Project',
-            app='Test App',
-            model='Test Model',
-            sender='test_sender@test.com',
-            receiver='test_receiver@test.com',
-            subject='Test Subject',
-            text='Test Text')
-        message.save()
+        self.sender = User.objects.create_user(username='sender', password='testpassword')
+        self.stranger = User.objects.create_user(username='stranger', password='testpassword')
         status_desc = MessageStatusDesc.objects.get(desc='Unread')
-        MessageStatus.objects.create(message_desc=status_desc, message=message)
-        self.message = message
+        self.messages = []
+        for i in range(3):
+            message = Message.objects.create(
+                project='Test Project',
+                app='Test App',
+                model='Test Model',
+                sender=self.sender,
+                receiver=self.user,
+                subject=f'Test Subject {i}',
+                text='Test Text')
+            MessageStatus.objects.create(message_desc=status_desc, message=message)
+            self.messages.append(message)
+        self.message = self.messages[0]
         self.view = MessageStatusUpdateView.as_view()
 
     def test_get_with_valid_token(self):
-        request = self.factory.get('/message/update/', {'token': {self.message.token}})
+        request = self.factory.get('/message/update/', {'token': str(self.message.token)})
         request.user = self.user
-        response = self.view(request)
-        message_status = self.message.message_status.order_by('-created_on').first()
-        self.assertEqual(response['success'], f'Message received a new status: {message_status.message_desc.desc}')
-    
+        response = json.loads(self.view(request).content)
+        self.assertEqual(response['success'], {str(self.message.token): 'updated'})
+        self.message.refresh_from_db()
+        self.assertEqual(self.message.current_status.desc, READ)
+
     def test_get_with_invalid_token(self):
         request = self.factory.get('/message/update/', {'token': 'invalid_token'})
         request.user = self.user
         response = self.view(request)
-        self.assertEqual(response['error'], 'Invalid token')
+        self.assertEqual(json.loads(response.content)['error'], 'Invalid token')
 
     def test_post_with_valid_token(self):
-        request = self.factory.post('/message/update/', {'token': {self.message.token}})
+        request = self.factory.post('/message/update/', {'token': str(self.message.token)})
         request.user = self.user
-        response = self.view(request)
-        message_status = self.message.message_status.order_by('-created_on').first()
-        self.assertEqual(response['success'], f'Message received a new status: {message_status.message_desc.desc}')
+        response = json.loads(self.view(request).content)
+        self.assertEqual(response['updated'], 1)
+        self.assertEqual(self.message.message_status.order_by('-created_at', '-id').first().message_desc.desc, READ)
 
     def test_post_with_invalid_token(self):
         request = self.factory.post('/message/update/', {'token': 'invalid_token'})
         request.user = self.user
         response = self.view(request) 
-        self.assertEqual(response['error'], 'Invalid token')
+        self.assertEqual(json.loads(response.content)['error'], 'Invalid token')
+
+    def test_bulk_update_reports_per_token_results(self):
+        foreign = Message.objects.create(sender=self.sender, receiver=self.stranger, subject='Foreign', text='Test Text')
+        MessageStatus.objects.create(message_desc=status_registry.get(READ), message=self.messages[1])
+        tokens = [str(message.token) for message in self.messages] + [str(foreign.token), 'invalid_token']
+        request = self.factory.post('/message/update/status/', {'tokens': tokens, 'status': READ})
+        request.user = self.user
+        with CaptureQueriesContext(connection) as queries:
+            response = json.loads(self.view(request).content)
+        self.assertEqual(response['success'], {
+            tokens[0]: 'updated', tokens[1]: 'unchanged', tokens[2]: 'updated', tokens[3]: 'not_found', tokens[4]: 'invalid',
+        })
+        self.assertEqual(response['updated'], 2)
+        self.assertEqual(len([query for query in queries if query['sql'].startswith('INSERT')]), 1)
+        self.assertEqual(Message.objects.filter(receiver=self.user, current_status__desc=READ).count(), 3)
+
+    def test_mark_all(self):
+        request = self.factory.post('/message/update/status/', {'all': 1, 'status': READ})
+        request.user = self.user
+        self.assertEqual(json.loads(self.view(request).content)['updated'], 3)
+        request = self.factory.post('/message/update/status/', {'all': 1, 'status': 'Archived'})
+        request.user = self.user
+        self.assertEqual(self.view(request).status_code, 400)
+
+    def test_bulk_update_publishes_one_inbox_event(self):
+        bus = get_event_bus()
+        last_id = bus.last_id
+        request = self.factory.post('/message/update/status/', {'all': 1, 'status': READ})
+        request.user = self.user
+        with override_settings(QMESSAGES_EVENT_BULK_THRESHOLD=2), self.captureOnCommitCallbacks(execute=True):
+            self.view(request)
+        published = bus.events_since(self.user.pk, last_id)
+        self.assertEqual([(event.type, event.data) for event in published], [('inbox', {'reason': 'status'})])
+        self.assertEqual(published[0].user_ids, {self.user.pk, self.sender.pk})
+
+class MessageListViewQueryCountTests(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.sender = User.objects.create_user(username='sender', email='sender@test.com', password='testpassword')
+        self.receiver = User.objects.create_user(username='receiver', email='receiver@test.com', password='testpassword')
+        self.view = MessageListView.as_view()
+        self.unread = MessageStatusDesc.objects.get(desc='Unread')
+
+    def create_thread(self, subject):
+        message = Message.objects.create(sender=self.sender, receiver=self.receiver, subject=subject, text='Test Text')
+        MessageStatus.objects.create(message_desc=self.unread, message=message)
+        reply = MessageReply.objects.create(message=message, text='Reply', replier=self.receiver)
+        MessageReplyStatus.objects.create(message_desc=self.unread, message_reply=reply)
+        MessageReply.objects.create(message=message, parent_reply=reply, text='Nested', replier=self.sender)
+        return message
+
+    def get_response(self, tokens):
+        request = self.factory.get('/message/list/')
+        request.user = self.sender
+        request.is_ajax = True
+        return self.view(request, tokens=[str(token) for token in tokens])
+
+    def test_query_count_is_constant(self):
+        tokens = [self.create_thread('Subject 0').token]
+        with self.assertNumQueries(5):
+            self.get_response(tokens)
+        tokens += [self.create_thread(f'Subject {i}').token for i in range(1, 10)]
+        with self.assertNumQueries(5):
+            response = self.get_response(tokens)
+        self.assertEqual(len(json.loads(response.content)['data']), 10)
+
+    def test_payload(self):
+        message = self.create_thread('Subject')
+        data = json.loads(self.get_response([message.token]).content)
+        message_dict = data['data'][0]
+        self.assertEqual(list(message_dict), ['id', 'deleted', 'project', 'app', 'model', 'sender', 'receiver', 'subject', 'text', 'token', 'created_at', 'updated_at', 'reply_count', 'last_reply_at', 'last_replier', 'status', 'replies'])
+        self.assertEqual(message_dict['sender'], 'sender@test.com')
+        self.assertEqual(message_dict['status'], 'Unread')
+        reply_dict = message_dict['replies'][0]
+        self.assertEqual(list(reply_dict), ['id', 'deleted', 'message', 'parent_reply', 'text', 'replier', 'created_at', 'updated_at', 'status', 'replies'])
+        self.assertEqual(reply_dict['replier'], 'receiver@test.com')
+        self.assertEqual(reply_dict['replies'][0]['replier'], 'sender@test.com')
+        self.assertNotIn('status', reply_dict['replies'][0])
+        self.assertEqual(data['pagination'], {'page': 1, 'total_pages': 1, 'has_next': False, 'has_previous': False, 'count': 1})
+
+
+class CurrentStatusTests(TestCase):
+    def setUp(self):
+        self.sender = User.objects.create_user(username='sender', email='sender@test.com', password='testpassword')
+        self.receiver = User.objects.create_user(username='receiver', email='receiver@test.com', password='testpassword')
+        self.message = Message.objects.create(sender=self.sender, receiver=self.receiver, subject='Test Subject', text='Test Text')
+        self.unread = MessageStatusDesc.objects.get(desc='Unread')
+        self.read = MessageStatusDesc.objects.get(desc='Read')
+
+    def test_status_write_updates_pointer(self):
+        MessageStatus.objects.create(message_desc=self.unread, message=self.message)
+        self.assertEqual(self.message.current_status, self.unread)
+        status = MessageStatus.objects.create(message_desc=self.read, message=self.message)
+        self.message.refresh_from_db()
+        self.assertEqual(self.message.current_status, self.read)
+        self.assertEqual(self.message.current_status_at, status.created_at)
+
+    def test_older_status_does_not_win(self):
+        older = MessageStatus.objects.create(message_desc=self.unread, message=self.message)
+        MessageStatus.objects.create(message_desc=self.read, message=self.message)
+        older.save()
+        self.message.refresh_from_db()
+        self.assertEqual(self.message.current_status, self.read)
+
+    def test_reply_status_updates_pointer(self):
+        reply = MessageReply.objects.create(message=self.message, text='Reply', replier=self.receiver)
+        MessageReplyStatus.objects.create(message_desc=self.read, message_reply=reply)
+        reply.refresh_from_db()
+        self.assertEqual(reply.current_status, self.read)
+
+    def test_stale_save_keeps_the_pointer(self):
+        stale = Message.objects.get(pk=self.message.pk)
+        reply = MessageReply.objects.create(message=self.message, text='Reply', replier=self.receiver)
+        stale_reply = MessageReply.objects.get(pk=reply.pk)
+        MessageStatus.objects.create(message_desc=self.read, message=self.message)
+        MessageReplyStatus.objects.create(message_desc=self.read, message_reply=reply)
+        stale.subject = 'Edited'
+        stale.save()
+        stale_reply.text = 'Edited'
+        stale_reply.save()
+        self.message.refresh_from_db()
+        reply.refresh_from_db()
+        self.assertEqual((self.message.subject, self.message.current_status), ('Edited', self.read))
+        self.assertEqual((reply.text, reply.current_status), ('Edited', self.read))
+
+
+@skipUnless(connection.vendor == 'sqlite', 'Query plan assertions are written for SQLite')
+class IndexUsageTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='testpassword')
+
+    def assertUsesIndex(self, queryset, *index_names):
+        plan = queryset.explain()
+        self.assertTrue(any(f'USING INDEX {name}' in plan or f'USING COVERING INDEX {name}' in plan for name in index_names), plan)
+
+    def test_token_lookups(self):
+        self.assertUsesIndex(Message.objects.filter(token=uuid.uuid4()), 'sqlite_autoindex_qmessages_message_1')
+        self.assertUsesIndex(Note.objects.filter(token=uuid.uuid4()), 'sqlite_autoindex_qmessages_note_1')
+
+    def test_inbox_lookups(self):
+        self.assertUsesIndex(Message.objects.filter(receiver=self.user).order_by('-created_at'), 'qmessages_msg_receiver_live', 'qmessages_msg_receiver_idx')
+        self.assertUsesIndex(Message.objects.filter(sender=self.user).order_by('-created_at'), 'qmessages_msg_sender_live', 'qmessages_msg_sender_idx')
+
+    def test_status_history_lookups(self):
+        self.assertUsesIndex(MessageStatus.objects.filter(message_id=1).order_by('-created_at'), 'qmessages_msgstatus_msg_idx')
+        self.assertUsesIndex(MessageReplyStatus.objects.filter(message_reply_id=1).order_by('-created_at'), 'qmessages_rplstatus_rpl_idx')
+
+
+class MessageListViewCursorTests(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.sender = User.objects.create_user(username='sender', email='sender@test.com', password='testpassword')
+        self.receiver = User.objects.create_user(username='receiver', email='receiver@test.com', password='testpassword')
+        self.view = MessageListView.as_view()
+        self.messages = [
+            Message.objects.create(sender=self.sender, receiver=self.receiver, subject=f'Subject {i}', text='Test Text')
+            for i in range(7)
+        ]
+        self.tokens = [str(message.token) for message in self.messages]
+
+    def get_data(self, **params):
+        request = self.factory.get('/message/list/', params)
+        request.user = self.receiver
+        request.is_ajax = True
+        return json.loads(self.view(request, tokens=self.tokens).content)
+
+    def test_walk_forward_and_back(self):
+        first = self.get_data(cursor='', pageSize=3)
+        self.assertEqual([m['subject'] for m in first['data']], ['Subject 6', 'Subject 5', 'Subject 4'])
+        self.assertFalse(first['pagination']['has_previous'])
+        self.assertIsNone(first['pagination']['count'])
+
+        second = self.get_data(cursor=first['pagination']['next'], pageSize=3)
+        self.assertEqual([m['subject'] for m in second['data']], ['Subject 3', 'Subject 2', 'Subject 1'])
+
+        last = self.get_data(cursor=second['pagination']['next'], pageSize=3)
+        self.assertEqual([m['subject'] for m in last['data']], ['Subject 0'])
+        self.assertFalse(last['pagination']['has_next'])
+        self.assertIsNone(last['pagination']['next'])
+
+        back = self.get_data(cursor=last['pagination']['previous'], pageSize=3)
+        self.assertEqual(back['data'], second['data'])
+
+    def test_counts(self):
+        self.assertEqual(self.get_data(cursor='', count='exact')['pagination']['count'], 7)
+        self.assertGreater(self.get_data(cursor='', count='estimate')['pagination']['count'], 0)
+
+    def test_invalid_cursor(self):
+        self.assertEqual(self.get_data(cursor='not-a-cursor'), {'error': 'Invalid cursor'})
+
+    def test_page_mode_still_works(self):
+        data = self.get_data(page=2, pageSize=3)
+        self.assertEqual(data['pagination']['page'], 2)
+        self.assertEqual(data['pagination']['count'], 7)
+
+
+class StatusRegistryTests(TestCase):
+    def setUp(self):
+        status_registry.clear()
+        self.addCleanup(status_registry.clear)
+        self.sender = User.objects.create_user(username='sender', password='testpassword')
+        self.receiver = User.objects.create_user(username='receiver', password='testpassword')
+        self.message = Message.objects.create(sender=self.sender, receiver=self.receiver, subject='Test Subject', text='Test Text')
+
+    def test_lookups_are_cached(self):
+        status_registry.get(UNREAD)
+        with self.assertNumQueries(0):
+            self.assertEqual(status_registry.get(READ).desc, READ)
+            self.assertEqual(status_registry.next(status_registry.get(UNREAD).id).desc, READ)
+
+    def test_save_clears_registry(self):
+        status_registry.get(UNREAD)
+        MessageStatusDesc.objects.create(desc='Archived')
+        self.assertEqual(status_registry.get('Archived').desc, 'Archived')
+
+    def test_next_status_follows_transition_table(self):
+        status = MessageStatus.objects.create(message_desc=status_registry.get(UNREAD), message=self.message)
+        status.next_status()
+        self.assertEqual(status.message_desc.desc, READ)
+        status.next_status()
+        self.assertEqual(status.message_desc.desc, REPLIED)
+        status.next_status()
+        self.assertEqual(status.message_desc.desc, REPLIED)
+        self.message.refresh_from_db()
+        self.assertEqual(self.message.current_status.desc, REPLIED)
+
+
+class ReplyTreeTests(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.sender = User.objects.create_user(username='sender', email='sender@test.com', password='testpassword')
+        self.receiver = User.objects.create_user(username='receiver', email='receiver@test.com', password='testpassword')
+        self.message = Message.objects.create(sender=self.sender, receiver=self.receiver, subject='Test Subject', text='Test Text')
+        parent = None
+        for depth in range(6):
+            parent = MessageReply.objects.create(message=self.message, parent_reply=parent, text=f'Depth {depth}', replier=self.sender)
+        MessageReply.objects.create(message=self.message, text='Second root', replier=self.receiver)
+
+    def test_single_query_any_depth(self):
+        with self.assertNumQueries(1):
+            tree = get_reply_tree(self.message)
+        self.assertEqual([reply.text for reply in tree], ['Depth 0', 'Second root'])
+        depth, node = 0, tree[0]
+        while node.children:
+            depth, node = depth + 1, node.children[0]
+        self.assertEqual(depth, 5)
+
+    def test_list_view_serializes_full_depth(self):
+        request = self.factory.get('/message/list/')
+        request.user = self.sender
+        request.is_ajax = True
+        response = MessageListView.as_view()(request, tokens=[str(self.message.token)])
+        node = json.loads(response.content)['data'][0]['replies'][0]
+        texts = []
+        while node:
+            texts.append(node['text'])
+            node = node['replies'][0] if node['replies'] else None
+        self.assertEqual(texts, [f'Depth {depth}' for depth in range(6)])
+
+
+class SubtreeDeleteTests(TestCase):
+    def setUp(self):
+        self.sender = User.objects.create_user(username='sender', password='testpassword')
+        self.receiver = User.objects.create_user(username='receiver', password='testpassword')
+        self.message = Message.objects.create(sender=self.sender, receiver=self.receiver, subject='Test Subject', text='Test Text')
+        self.unread = status_registry.get(UNREAD)
+
+    def create_chain(self, depth):
+        replies, parent = [], None
+        for i in range(depth):
+            parent = MessageReply.objects.create(message=self.message, parent_reply=parent, text=f'Reply {i}', replier=self.sender)
+            MessageReplyStatus.objects.create(message_desc=self.unread, message_reply=parent)
+            replies.append(parent)
+        return replies
+
+    def test_soft_delete_subtree(self):
+        replies = self.create_chain(5)
+        sibling = MessageReply.objects.create(message=self.message, text='Sibling', replier=self.receiver)
+        self.assertEqual(sorted(replies[1].get_subtree_ids()), [reply.id for reply in replies[1:]])
+        replies[1].delete()
+        self.assertEqual(list(MessageReply.objects.order_by('id')), [replies[0], sibling])
+
+    def test_soft_delete_query_count_does_not_grow_with_depth(self):
+        shallow = self.create_chain(2)
+        with CaptureQueriesContext(connection) as shallow_queries:
+            shallow[0].delete()
+        deep = self.create_chain(30)
+        with CaptureQueriesContext(connection) as deep_queries:
+            deep[0].delete()
+        self.assertEqual(len(shallow_queries), len(deep_queries))
+        self.assertFalse(MessageReply.objects.exists())
+
+    def test_hard_delete_query_count_does_not_grow_with_depth(self):
+        shallow = self.create_chain(2)
+        with CaptureQueriesContext(connection) as shallow_queries:
+            shallow[0].hard_delete()
+        deep = self.create_chain(30)
+        with CaptureQueriesContext(connection) as deep_queries:
+            deep[0].hard_delete()
+        self.assertEqual(len(shallow_queries), len(deep_queries))
+        self.assertFalse(MessageReply.all_objects.exists())
+        self.assertFalse(MessageReplyStatus.objects.exists())
+
+    def test_message_soft_delete_cascade(self):
+        self.create_chain(3)
+        self.message.delete()
+        self.assertEqual(MessageReply.objects.count(), 3)
+        self.message.delete(cascade=True)
+        self.assertEqual(MessageReply.objects.count(), 0)
+
+    def test_message_hard_delete(self):
+        self.create_chain(10)
+        MessageStatus.objects.create(message_desc=self.unread, message=self.message)
+        self.message.hard_delete()
+        self.assertFalse(Message.all_objects.exists())
+        self.assertFalse(MessageReply.all_objects.exists())
+        self.assertFalse(MessageStatus.objects.exists())
+
+
+class BroadcastTests(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.sender = User.objects.create_user(username='sender', password='testpassword')
+        self.sender.user_permissions.add(Permission.objects.get(codename='broadcast_message'))
+        User.objects.bulk_create([User(username=f'receiver{i}') for i in range(1000)])
+        self.receivers = User.objects.exclude(pk=self.sender.pk)
+
+    def inserts_per_batch(self, model, batch_size):
+        # The backend may split a batch further to fit its parameter limit.
+        fields = [field for field in model._meta.concrete_fields if not field.primary_key]
+        return math.ceil(batch_size / min(batch_size, connection.ops.bulk_batch_size(fields, [None] * batch_size)))
+
+    def test_broadcast_throughput(self):
+        status_registry.get(UNREAD)
+        with CaptureQueriesContext(connection) as queries:
+            tokens = broadcast_message(self.sender, self.receivers, 'Notice', 'Test Text', batch_size=250)
+        self.assertEqual(len(tokens), 1000)
+        inserts = [query['sql'] for query in queries if query['sql'].startswith('INSERT')]
+        self.assertEqual(len([sql for sql in inserts if 'qmessages_messagestatus' in sql]), 4 * self.inserts_per_batch(MessageStatus, 250))
+        self.assertEqual(len([sql for sql in inserts if '"qmessages_message" ' in sql]), 4 * self.inserts_per_batch(Message, 250))
+        self.assertEqual(Message.objects.filter(token__in=tokens, current_status__desc=UNREAD).count(), 1000)
+        self.assertEqual(MessageStatus.objects.filter(message__token__in=tokens).count(), 1000)
+
+    def test_large_broadcast_publishes_one_inbox_event(self):
+        bus = get_event_bus()
+        last_id = bus.last_id
+        with self.captureOnCommitCallbacks(execute=True):
+            broadcast_message(self.sender, self.receivers, 'Notice', 'Test Text')
+        self.assertEqual(bus.last_id, last_id + 1)
+        event = bus.events_since(self.receivers[0].pk, last_id)[0]
+        self.assertEqual((event.type, len(event.user_ids)), ('inbox', 1000))
+
+    def test_broadcast_view(self):
+        receiver_ids = list(self.receivers.values_list('pk', flat=True)[:3])
+        request = self.factory.post('/message/broadcast/', data={
+            'project': 'Test Project',
+            'app': 'Test App',
+            'model': 'Test Model',
+            'receivers': receiver_ids,
+            'subject': 'Notice',
+            'text': 'Test Text',
+        })
+        request.user = self.sender
+        response = json.loads(MessageBroadcastView.as_view()(request).content)
+        self.assertEqual(len(response['success']), 3)
+        self.assertEqual(sorted(Message.objects.values_list('receiver_id', flat=True)), sorted(receiver_ids))
+
+    def test_broadcast_view_unknown_receiver(self):
+        request = self.factory.post('/message/broadcast/', data={
+            'project': 'Test Project', 'app': 'Test App', 'model': 'Test Model',
+            'receivers': [self.sender.pk], 'subject': 'Notice', 'text': 'Test Text',
+        })
+        request.user = self.sender
+        response = json.loads(MessageBroadcastView.as_view()(request).content)
+        self.assertIn('receivers', response['error'])
+        self.assertFalse(Message.objects.exists())
+
+    def test_broadcast_view_needs_permission_and_caps_receivers(self):
+        data = {
+            'project': 'Test Project', 'app': 'Test App', 'model': 'Test Model',
+            'receivers': list(self.receivers.values_list('pk', flat=True)[:3]), 'subject': 'Notice', 'text': 'Test Text',
+        }
+        request = self.factory.post('/message/broadcast/', data=data)
+        request.user = self.receivers[0]
+        self.assertEqual(MessageBroadcastView.as_view()(request).status_code, 403)
+        request = self.factory.post('/message/broadcast/', data=data)
+        request.user = self.sender
+        with override_settings(QMESSAGES_BROADCAST_MAX_RECEIVERS=2):
+            response = json.loads(MessageBroadcastView.as_view()(request).content)
+        self.assertIn('receivers', response['error'])
+        self.assertFalse(Message.objects.exists())
+
+
+class UnreadCounterTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.factory = RequestFactory()
+        self.sender = User.objects.create_user(username='sender', password='testpassword')
+        self.receiver = User.objects.create_user(username='receiver', password='testpassword')
+        self.unread = status_registry.get(UNREAD)
+        self.read = status_registry.get(READ)
+
+    def send(self):
+        message = Message.objects.create(sender=self.sender, receiver=self.receiver, subject='Test Subject', text='Test Text')
+        with self.captureOnCommitCallbacks(execute=True):
+            MessageStatus.objects.create(message_desc=self.unread, message=message)
+        return message
+
+    def get_count(self):
+        request = self.factory.get('/message/unread/')
+        request.user = self.receiver
+        return json.loads(UnreadCountView.as_view()(request).content)['unread']
+
+    def test_counter_follows_transitions(self):
+        message = self.send()
+        self.assertEqual(self.get_count(), 1)
+        other = self.send()
+        with self.assertNumQueries(0):
+            self.assertEqual(self.get_count(), 2)
+        with self.captureOnCommitCallbacks(execute=True):
+            MessageStatus.objects.create(message_desc=self.read, message=message)
+        self.assertEqual(self.get_count(), 1)
+        with self.captureOnCommitCallbacks(execute=True):
+            other.delete()
+        self.assertEqual(self.get_count(), 0)
+
+    def test_rebuild_command(self):
+        message = self.send()
+        Message.objects.filter(pk=message.pk).update(current_status=None)
+        cache.set(unread_cache_key(self.receiver.pk), 42)
+        call_command('qmessages_rebuild_counters', stdout=StringIO())
+        self.assertEqual(cache.get(unread_cache_key(self.receiver.pk)), 1)
+        self.assertEqual(cache.get(unread_cache_key(self.sender.pk)), 0)
+
+
+class SearchTests(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.sender = User.objects.create_user(username='sender', password='testpassword')
+        self.receiver = User.objects.create_user(username='receiver', password='testpassword')
+        self.other = User.objects.create_user(username='other', password='testpassword')
+        self.message = Message.objects.create(sender=self.sender, receiver=self.receiver, subject='Invoice overdue', text='Please pay the invoice')
+        self.reply = MessageReply.objects.create(message=self.message, text='The invoice was paid yesterday', replier=self.receiver)
+        Message.objects.create(sender=self.other, receiver=self.sender, subject='Lunch', text='No invoice here, just lunch')
+        Message.objects.create(sender=self.other, receiver=self.other, subject='Private invoice', text='Not yours')
+        Note.objects.create(project='Billing', app='App', model='Model', text='Invoice note')
+
+    def search(self, user, **params):
+        request = self.factory.get('/message/search/', params)
+        request.user = user
+        return json.loads(SearchView.as_view()(request).content)
+
+    def test_results_are_scoped_and_ranked(self):
+        data = self.search(self.sender, q='invoice')
+        self.assertEqual(data['pagination']['count'], 3)
+        self.assertEqual(data['data'][0]['title'], 'Invoice overdue')
+        self.assertEqual({result['kind'] for result in data['data']}, {'message', 'reply'})
+        self.assertEqual(self.search(self.receiver, q='lunch')['data'], [])
+
+    def test_notes_need_a_project_scope(self):
+        data = self.search(self.sender, q='invoice', project='Billing')
+        self.assertEqual([result['kind'] for result in data['data']], ['note'])
+
+    def test_index_follows_updates_and_deletes(self):
+        self.message.text = 'Please pay the bill'
+        self.message.save()
+        self.assertEqual(self.search(self.sender, q='bill')['pagination']['count'], 1)
+        self.reply.delete()
+        self.assertEqual([result['kind'] for result in self.search(self.sender, q='paid')['data']], [])
+        self.message.hard_delete()
+        self.assertEqual(self.search(self.sender, q='bill')['data'], [])
+
+    def test_pagination_and_reindex(self):
+        call_command('qmessages_search_reindex', stdout=StringIO())
+        data = self.search(self.sender, q='invoice', pageSize=2, page=2)
+        self.assertEqual(len(data['data']), 1)
+        self.assertEqual(data['pagination'], {'page': 2, 'total_pages': 2, 'has_next': False, 'has_previous': True, 'count': 3})
+
+    def test_incomplete_backend_fails_on_instantiation(self):
+        class NoMatchBackend(SearchBackend):
+            def create_table(self, schema_editor):
+                pass
+
+        with self.assertRaises(TypeError):
+            NoMatchBackend(connection)
+
+
+class KendoQueryTests(TestCase):
+    fields = {'subject': 'subject', 'status': 'current_status__desc', 'created_at': 'created_at'}
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.sender = User.objects.create_user(username='sender', password='testpassword')
+        self.receiver = User.objects.create_user(username='receiver', password='testpassword')
+        self.messages = [
+            Message.objects.create(sender=self.sender, receiver=self.receiver, subject=subject, text='Test Text')
+            for subject in ('Alpha report', 'Beta report', 'Gamma memo', 'Delta memo')
+        ]
+        MessageStatus.objects.create(message_desc=status_registry.get(READ), message=self.messages[0])
+
+    def test_compile_nested_groups(self):
+        params = QueryDict(mutable=True)
+        params.update({
+            'filter[logic]': 'or',
+            'filter[filters][0][field]': 'subject',
+            'filter[filters][0][operator]': 'startswith',
+            'filter[filters][0][value]': 'gamma',
+            'filter[filters][1][logic]': 'and',
+            'filter[filters][1][filters][0][field]': 'subject',
+            'filter[filters][1][filters][0][operator]': 'contains',
+            'filter[filters][1][filters][0][value]': 'report',
+            'filter[filters][1][filters][1][field]': 'status',
+            'filter[filters][1][filters][1][operator]': 'isnull',
+            'sort[0][field]': 'subject',
+            'sort[0][dir]': 'desc',
+        })
+        query, ordering = compile_kendo_query(params, self.fields)
+        self.assertEqual(ordering, ['-subject'])
+        subjects = list(Message.objects.filter(query).order_by(*ordering).values_list('subject', flat=True))
+        self.assertEqual(subjects, ['Gamma memo', 'Beta report'])
+
+    def test_rejects_unknown_fields_and_operators(self):
+        with self.assertRaises(KendoQueryError):
+            compile_kendo_query({'filter[filters][0][field]': 'sender__password', 'filter[filters][0][operator]': 'eq', 'filter[filters][0][value]': 'x'}, self.fields)
+        with self.assertRaises(KendoQueryError):
+            compile_kendo_query({'filter[filters][0][field]': 'subject', 'filter[filters][0][operator]': 'regex', 'filter[filters][0][value]': 'x'}, self.fields)
+        with self.assertRaises(KendoQueryError):
+            compile_kendo_query({'sort[0][field]': 'text', 'sort[0][dir]': 'asc'}, self.fields)
+
+    def test_list_view_applies_filter_sort_and_group(self):
+        request = self.factory.get('/message/list/', {
+            'filter[logic]': 'and',
+            'filter[filters][0][field]': 'subject',
+            'filter[filters][0][operator]': 'doesnotcontain',
+            'filter[filters][0][value]': 'delta',
+            'group[0][field]': 'status',
+            'group[0][dir]': 'desc',
+            'sort[0][field]': 'subject',
+            'sort[0][dir]': 'asc',
+            'pageSize': 2,
+        })
+        request.user = self.sender
+        request.is_ajax = True
+        response = MessageListView.as_view()(request, tokens=[str(message.token) for message in self.messages])
+        data = json.loads(response.content)
+        self.assertEqual([message['subject'] for message in data['data']], ['Alpha report', 'Beta report'])
+        self.assertEqual(data['pagination']['count'], 3)
+
+    def test_list_view_rejects_bad_query(self):
+        request = self.factory.get('/message/list/', {'sort[0][field]': 'sender__password'})
+        request.user = self.sender
+        request.is_ajax = True
+        response = MessageListView.as_view()(request, tokens=[str(self.messages[0].token)])
+        self.assertEqual(response.status_code, 400)
+
+    def test_list_view_filters_receiver_by_id_only(self):
+        tokens = [str(message.token) for message in self.messages]
+        for operator, value, status in (('eq', self.receiver.pk, 200), ('contains', 'rec', 400), ('eq', 'receiver', 400)):
+            request = self.factory.get('/message/list/', {
+                'filter[filters][0][field]': 'receiver',
+                'filter[filters][0][operator]': operator,
+                'filter[filters][0][value]': value,
+            })
+            request.user = self.sender
+            request.is_ajax = True
+            self.assertEqual(MessageListView.as_view()(request, tokens=tokens).status_code, status)
+
+
+class AsyncViewTests(TestCase):
+    def setUp(self):
+        self.factory = AsyncRequestFactory()
+        self.sender = User.objects.create_user(username='sender', email='sender@test.com', password='testpassword')
+        self.receiver = User.objects.create_user(username='receiver', email='receiver@test.com', password='testpassword')
+        self.message = Message.objects.create(sender=self.sender, receiver=self.receiver, subject='Subject', text='Test Text')
+        MessageStatus.objects.create(message_desc=status_registry.get(UNREAD), message=self.message)
+        self.reply = MessageReply.objects.create(message=self.message, text='Reply', replier=self.receiver)
+
+    def ajax_request(self, method, path, data=None):
+        request = getattr(self.factory, method)(path, data or {})
+        request.user = self.sender
+        request.is_ajax = True
+        return request
+
+    async def test_list_matches_sync_payload(self):
+        request = self.ajax_request('get', '/message/list/')
+        response = await AsyncMessageListView.as_view()(request, tokens=[str(self.message.token)])
+        data = json.loads(response.content)
+        self.assertEqual(data['data'][0]['subject'], 'Subject')
+        self.assertEqual(data['data'][0]['status'], 'Unread')
+        self.assertEqual(data['data'][0]['replies'][0]['text'], 'Reply')
+        self.assertEqual(data['pagination']['count'], 1)
+
+    async def test_list_streams_through_the_async_orm(self):
+        request = self.ajax_request('get', '/message/list/', {'stream': 1})
+        response = await AsyncMessageListView.as_view()(request, tokens=[str(self.message.token)])
+        self.assertTrue(response.is_async)
+        data = json.loads(b''.join([chunk async for chunk in response.streaming_content]))
+        self.assertEqual(data['data'][0]['replies'][0]['text'], 'Reply')
+        self.assertEqual(data['pagination'], {'page': 1, 'page_size': 100, 'has_next': False, 'has_previous': False})
+
+    async def test_detail(self):
+        request = self.ajax_request('get', '/message/detail/')
+        response = await AsyncMessageDetailView.as_view()(request, token=str(self.message.token))
+        self.assertEqual(json.loads(response.content)['token'], str(self.message.token))
+
+    async def test_reply_create(self):
+        request = self.ajax_request('post', '/message/reply/create/', {'text': 'Nested reply'})
+        response = await AsyncMessageReplyCreateView.as_view()(request, token=str(self.message.token), parent_reply=self.reply.pk)
+        reply = await MessageReply.objects.select_related('parent_reply').aget(pk=json.loads(response.content)['success'])
+        self.assertEqual(reply.parent_reply, self.reply)
+        message = await Message.objects.select_related('current_status').aget(pk=self.message.pk)
+        self.assertEqual(message.current_status.desc, REPLIED)
+
+
+class EventStreamTests(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.sender = User.objects.create_user(username='sender', password='testpassword')
+        self.receiver = User.objects.create_user(username='receiver', password='testpassword')
+        self.other = User.objects.create_user(username='other', password='testpassword')
+        self.message = Message.objects.create(sender=self.sender, receiver=self.receiver, subject='Subject', text='Test Text')
+        MessageStatus.objects.create(message_desc=status_registry.get(UNREAD), message=self.message)
+        self.last_id = get_event_bus().last_id
+
+    def stream_request(self, user, **headers):
+        request = self.factory.get('/message/stream/', headers=headers)
+        request.user = user
+        request.is_ajax = True
+        return MessageStreamView.as_view()(request)
+
+    def test_bus_log_is_bounded_and_filtered(self):
+        bus = InMemoryEventBus(size=2)
+        for i in range(3):
+            bus.publish('message', [i % 2], {'n': i})
+        self.assertEqual([event.data['n'] for event in bus.events_since(0, 0)], [2])
+        self.assertTrue(bus.is_expired(0))
+        self.assertFalse(bus.is_expired(1))
+        self.assertTrue(bus.is_expired(4))
+        self.assertEqual(bus.wait(1, 3, timeout=0.01), [])
+
+    def test_incomplete_bus_fails_on_instantiation(self):
+        class PublishOnlyBus(EventBus):
+            def publish(self, event_type, user_ids, data):
+                pass
+
+        with self.assertRaises(TypeError):
+            PublishOnlyBus()
+
+    def test_reply_publishes_after_commit(self):
+        request = self.factory.post('/message/reply/create/', {'text': 'Reply'})
+        request.user = self.receiver
+        request.is_ajax = False
+        with self.captureOnCommitCallbacks(execute=True):
+            MessageReplyCreateView.as_view()(request, token=str(self.message.token))
+
+        with override_settings(QMESSAGES_POLL_TIMEOUT=0):
+            data = json.loads(self.stream_request(self.sender, last_event_id=str(self.last_id)).content)
+            self.assertEqual(json.loads(self.stream_request(self.other, last_event_id=str(self.last_id)).content)['events'], [])
+        self.assertEqual([event['type'] for event in data['events']], ['reply', 'status'])
+        self.assertEqual(data['events'][0]['data']['token'], str(self.message.token))
+        self.assertEqual(data['events'][1]['data']['status'], REPLIED)
+        self.assertEqual(data['last_event_id'], data['events'][-1]['id'])
+
+    def test_sse_resumes_from_last_event_id(self):
+        bus = get_event_bus()
+        bus.publish('message', [self.receiver.pk], {'token': 'a'})
+        bus.publish('message', [self.receiver.pk], {'token': 'b'})
+        with override_settings(QMESSAGES_STREAM_TIMEOUT=0.01):
+            response = self.stream_request(self.receiver, accept='text/event-stream', last_event_id=str(self.last_id + 1))
+            body = b''.join(response.streaming_content).decode()
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        self.assertEqual(body.replace(': keepalive\n\n', ''), f'id: {self.last_id + 2}\nevent: message\ndata: {{"token": "b"}}\n\n')
+
+    async def test_asgi_stream_sends_events_as_they_arrive(self):
+        request = AsyncRequestFactory().get('/message/stream/', headers={'accept': 'text/event-stream', 'last_event_id': str(self.last_id)})
+        request.user = self.receiver
+        request.is_ajax = True
+        with override_settings(QMESSAGES_STREAM_TIMEOUT=30):
+            response = await sync_to_async(MessageStreamView.as_view())(request)
+            self.assertTrue(response.is_async)
+            content = aiter(response.streaming_content)
+            get_event_bus().publish('message', [self.receiver.pk], {'token': 'a'})
+            first = await asyncio.wait_for(anext(content), timeout=5)
+            await content.aclose()
+        self.assertEqual(first, f'id: {self.last_id + 1}\nevent: message\ndata: {{"token": "a"}}\n\n'.encode())
+
+    async def test_asgi_long_poll_waits_without_blocking(self):
+        request = AsyncRequestFactory().get('/message/stream/', {'last_event_id': str(self.last_id)})
+        request.user = self.receiver
+        request.is_ajax = True
+        with override_settings(QMESSAGES_POLL_TIMEOUT=30):
+            response = await sync_to_async(MessageStreamView.as_view())(request)
+            self.assertTrue(response.is_async)
+            content = aiter(response.streaming_content)
+            get_event_bus().publish('message', [self.receiver.pk], {'token': 'a'})
+            data = json.loads(await asyncio.wait_for(anext(content), timeout=5))
+            await content.aclose()
+        self.assertEqual(response['Content-Type'], 'application/json')
+        self.assertEqual([event['data'] for event in data['events']], [{'token': 'a'}])
+        self.assertEqual(data['last_event_id'], self.last_id + 1)
+
+
+class ConditionalGetTests(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.sender = User.objects.create_user(username='sender', email='sender@test.com', password='testpassword')
+        self.receiver = User.objects.create_user(username='receiver', email='receiver@test.com', password='testpassword')
+        self.message = Message.objects.create(sender=self.sender, receiver=self.receiver, subject='Subject', text='Test Text')
+        MessageStatus.objects.create(message_desc=status_registry.get(UNREAD), message=self.message)
+        self.reply = MessageReply.objects.create(message=self.message, text='Reply', replier=self.receiver)
+
+    def get_list(self, **headers):
+        request = self.factory.get('/message/list/', headers=headers)
+        request.user = self.sender
+        request.is_ajax = True
+        return MessageListView.as_view()(request, tokens=[str(self.message.token)])
+
+    def test_list_not_modified_costs_one_query(self):
+        etag = self.get_list()['ETag']
+        with self.assertNumQueries(1):
+            response = self.get_list(if_none_match=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+        MessageReplyStatus.objects.create(message_desc=status_registry.get(READ), message_reply=self.reply)
+        response = self.get_list(if_none_match=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_hard_delete_changes_validators(self):
+        response = self.get_list()
+        child = MessageReply.objects.create(message=self.message, parent_reply=self.reply, text='Nested', replier=self.sender)
+        etag = self.get_list()['ETag']
+        self.assertNotEqual(response['ETag'], etag)
+        version = get_data_version()
+        with mock.patch('qmessages.conditional.time.time', return_value=version + 1):
+            with self.captureOnCommitCallbacks(execute=True):
+                child.hard_delete()
+        self.assertEqual(get_data_version(), version + 1)
+        response = self.get_list(if_none_match=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_detail_honours_if_modified_since(self):
+        request = self.factory.get('/message/detail/')
+        request.user = self.sender
+        request.is_ajax = True
+        response = MessageDetailView.as_view()(request, token=str(self.message.token))
+        request = self.factory.get('/message/detail/', headers={'if_modified_since': response['Last-Modified']})
+        request.user = self.sender
+        request.is_ajax = True
+        self.assertEqual(MessageDetailView.as_view()(request, token=str(self.message.token)).status_code, 304)
+
+
+class SharedCacheCheckTests(TestCase):
+
+    def test_warns_about_a_per_process_cache(self):
+        locmem = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+        shared = {'default': {'BACKEND': 'django.core.cache.backends.db.DatabaseCache', 'LOCATION': 'qmessages_cache'}}
+        with override_settings(CACHES=locmem):
+            self.assertEqual([warning.id for warning in check_shared_cache(None)], ['qmessages.W001'])
+        with override_settings(CACHES=shared):
+            self.assertEqual(check_shared_cache(None), [])
+
+
+class ThreadCacheTests(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.sender = User.objects.create_user(username='sender', email='sender@test.com', password='testpassword')
+        self.receiver = User.objects.create_user(username='receiver', email='receiver@test.com', password='testpassword')
+        self.message = Message.objects.create(sender=self.sender, receiver=self.receiver, subject='Subject', text='Test Text')
+        MessageStatus.objects.create(message_desc=status_registry.get(UNREAD), message=self.message)
+        thread_cache.reset_stats()
+
+    def get_list(self):
+        request = self.factory.get('/message/list/')
+        request.user = self.sender
+        request.is_ajax = True
+        return json.loads(MessageListView.as_view()(request, tokens=[str(self.message.token)]).content)
+
+    def test_cached_threads_skip_serialization_queries(self):
+        self.get_list()
+        with self.assertNumQueries(3):
+            data = self.get_list()
+        self.assertEqual(data['data'][0]['subject'], 'Subject')
+        self.assertEqual(thread_cache.get_stats(), {'hits': 1, 'misses': 1, 'hit_ratio': 0.5})
+
+    def test_writes_bump_the_thread_version(self):
+        self.get_list()
+        reply = MessageReply.objects.create(message=self.message, text='Reply', replier=self.receiver)
+        self.assertEqual(self.get_list()['data'][0]['replies'][0]['text'], 'Reply')
+
+        MessageReplyStatus.objects.create(message_desc=status_registry.get(READ), message_reply=reply)
+        self.assertEqual(self.get_list()['data'][0]['replies'][0]['status'], READ)
+
+        reply.delete()
+        self.assertEqual(self.get_list()['data'][0]['replies'], [])
+
+    def test_reply_status_uses_the_loaded_reply(self):
+        reply = MessageReply.objects.create(message=self.message, text='Reply', replier=self.receiver)
+        read = status_registry.get(READ)
+        with CaptureQueriesContext(connection) as queries:
+            MessageReplyStatus.objects.create(message_desc=read, message_reply=reply)
+        self.assertFalse([query for query in queries.captured_queries if query['sql'].startswith('SELECT')])
+        with CaptureQueriesContext(connection) as queries:
+            MessageReplyStatus.objects.create(message_desc=read, message_reply_id=reply.pk)
+        selects = [query['sql'] for query in queries.captured_queries if query['sql'].startswith('SELECT')]
+        self.assertEqual(len(selects), 1)
+        # Only the message id, not the whole reply row.
+        self.assertTrue(selects[0].startswith('SELECT "qmessages_messagereply"."message_id" AS "message_id" FROM'))
+
+    def test_deletes_only_invalidate_their_own_thread(self):
+        other = Message.objects.create(sender=self.sender, receiver=self.receiver, subject='Other', text='Test Text')
+        self.get_list()
+        other.delete()
+        other.hard_delete()
+        thread_cache.reset_stats()
+        self.get_list()
+        self.assertEqual(thread_cache.get_stats()['hits'], 1)
+
+    def test_detail_uses_the_cached_thread(self):
+        list_data = self.get_list()
+        request = self.factory.get('/message/detail/')
+        request.user = self.sender
+        request.is_ajax = True
+        response = MessageDetailView.as_view()(request, token=str(self.message.token))
+        self.assertEqual(json.loads(response.content), list_data['data'][0])
+        self.assertEqual(thread_cache.get_stats()['hits'], 1)
+
+
+class StreamingListTests(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.sender = User.objects.create_user(username='sender', email='sender@test.com', password='testpassword')
+        self.receiver = User.objects.create_user(username='receiver', email='receiver@test.com', password='testpassword')
+        self.messages = []
+        for i in range(5):
+            message = Message.objects.create(sender=self.sender, receiver=self.receiver, subject=f'Subject {i}', text='Test Text')
+            MessageStatus.objects.create(message_desc=status_registry.get(UNREAD), message=message)
+            reply = MessageReply.objects.create(message=message, text='Reply', replier=self.receiver)
+            MessageReply.objects.create(message=message, parent_reply=reply, text='Nested', replier=self.sender)
+            self.messages.append(message)
+
+    def get_response(self, **params):
+        request = self.factory.get('/message/list/', params)
+        request.user = self.sender
+        request.is_ajax = True
+        return MessageListView.as_view()(request, tokens=[str(message.token) for message in self.messages])
+
+    def test_stream_matches_page_payload(self):
+        page = json.loads(self.get_response(pageSize=3).content)
+        response = self.get_response(pageSize=3, stream=1)
+        self.assertTrue(response.streaming)
+        streamed = json.loads(b''.join(response.streaming_content))
+        self.assertEqual(streamed['data'], page['data'])
+        self.assertEqual(streamed['pagination'], {'page': 1, 'page_size': 3, 'has_next': True, 'has_previous': False})
+
+        response = self.get_response(pageSize=3, page=2, stream=1)
+        streamed = json.loads(b''.join(response.streaming_content))
+        self.assertEqual(len(streamed['data']), 2)
+        self.assertFalse(streamed['pagination']['has_next'])
+
+    def test_stream_fetches_replies_per_chunk(self):
+        view = MessageListView()
+        view.stream_chunk_size = 2
+        request = self.factory.get('/message/list/', {'stream': 1, 'pageSize': 5})
+        request.user = self.sender
+        request.is_ajax = True
+        view.setup(request)
+        view.tokens = [str(message.token) for message in self.messages]
+        view.object_list = view.get_queryset(request)
+        with CaptureQueriesContext(connection) as queries:
+            b''.join(view.get_stream_response(request).streaming_content)
+        self.assertEqual(len([query for query in queries if 'qmessages_messagereply' in query['sql']]), 3)
+
+    def test_page_size_is_clamped(self):
+        request = self.factory.get('/message/list/', {'pageSize': '100000'})
+        view = MessageListView()
+        view.setup(request)
+        self.assertEqual(view.get_paginate_by(None), 100)
+        view.setup(self.factory.get('/message/list/', {'pageSize': 'abc'}))
+        self.assertEqual(view.get_paginate_by(None), 100)
+        view.setup(self.factory.get('/message/list/', {'pageSize': '0'}))
+        self.assertEqual(view.get_paginate_by(None), 1)
+
+
+class ExportTests(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.sender = User.objects.create_user(username='sender', email='sender@test.com', password='testpassword')
+        self.receiver = User.objects.create_user(username='receiver', email='receiver@test.com', password='testpassword')
+        self.other = User.objects.create_user(username='other', email='other@test.com', password='testpassword')
+        self.message = Message.objects.create(sender=self.sender, receiver=self.receiver, subject='Subject', text='Test Text', project='crm')
+        MessageStatus.objects.create(message_desc=status_registry.get(UNREAD), message=self.message)
+        reply = MessageReply.objects.create(message=self.message, text='Reply', replier=self.receiver)
+        MessageReplyStatus.objects.create(message_desc=status_registry.get(UNREAD), message_reply=reply)
+        MessageReply.objects.create(message=self.message, parent_reply=reply, text='Nested', replier=self.sender)
+        Message.objects.create(sender=self.other, receiver=self.receiver, subject='Other', text='Test Text', project='hr')
+
+    def test_command_exports_ndjson_threads(self):
+        out, err = StringIO(), StringIO()
+        call_command('qmessages_export', user='sender', stdout=out, stderr=err)
+        records = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual([record['subject'] for record in records], ['Subject'])
+        self.assertEqual([status['status'] for status in records[0]['statuses']], [UNREAD])
+        reply = records[0]['replies'][0]
+        self.assertEqual(reply['statuses'][0]['status'], UNREAD)
+        self.assertEqual(reply['replies'][0]['text'], 'Nested')
+        self.assertIn('Exported 1 messages.', err.getvalue())
+
+    def test_view_streams_gzipped_csv(self):
+        request = self.factory.get('/message/export/', {'format': 'csv', 'gzip': 1, 'project': 'crm'})
+        request.user = self.receiver
+        response = MessageExportView.as_view()(request)
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="messages.csv.gz"')
+        lines = gzip.decompress(b''.join(response.streaming_content)).decode().splitlines()
+        self.assertEqual([line.split(',')[0] for line in lines], ['record', 'message', 'message_status', 'reply', 'reply_status', 'reply'])
+
+    def test_view_scopes_to_the_user(self):
+        request = self.factory.get('/message/export/', {'user': self.sender.pk})
+        request.user = self.other
+        response = MessageExportView.as_view()(request)
+        records = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual([record['subject'] for record in records], ['Other'])
+
+
+class RetentionTests(TestCase):
+    def setUp(self):
+        self.sender = User.objects.create_user(username='sender', password='testpassword')
+        self.receiver = User.objects.create_user(username='receiver', password='testpassword')
+        self.unread = status_registry.get(UNREAD)
+
+    def create_thread(self, subject):
+        message = Message.objects.create(sender=self.sender, receiver=self.receiver, subject=subject, text='Test Text')
+        MessageStatus.objects.create(message_desc=self.unread, message=message)
+        reply = MessageReply.objects.create(message=message, text='Reply', replier=self.receiver)
+        MessageReplyStatus.objects.create(message_desc=self.unread, message_reply=reply)
+        MessageReply.objects.create(message=message, parent_reply=reply, text='Nested', replier=self.sender)
+        return message, reply
+
+    def test_archives_deleted_rows_in_batches(self):
+        deleted = [self.create_thread(f'Deleted {i}')[0] for i in range(3)]
+        for message in deleted:
+            message.delete()
+        kept, reply = self.create_thread('Kept')
+        reply.delete()
+        note = Note.objects.create(text='Note')
+        note.delete()
+
+        batches = []
+        counts = run_retention(RetentionPolicy(), batch_size=2, progress=lambda name, counts: batches.append(name))
+        self.assertEqual(counts, {'messages': 3, 'replies': 8, 'notes': 1})
+        self.assertEqual(batches, ['messages', 'messages', 'replies', 'notes'])
+        self.assertEqual(list(Message.all_objects.all()), [kept])
+        self.assertFalse(MessageReply.all_objects.exists())
+        self.assertFalse(MessageStatus.objects.exclude(message=kept).exists())
+        self.assertFalse(MessageReplyStatus.objects.exists())
+
+        archived = ArchivedMessage.objects.get(original_id=deleted[0].pk)
+        self.assertEqual(archived.data['subject'], 'Deleted 0')
+        self.assertEqual(archived.data['statuses'][0]['status'], UNREAD)
+        self.assertEqual(ArchivedMessageReply.objects.filter(message_id=kept.pk).count(), 2)
+        self.assertEqual(ArchivedNote.objects.get().token, note.token)
+
+    def test_replies_are_archived_in_capped_batches(self):
+        message, reply = self.create_thread('Long')
+        for i in range(3):
+            MessageReply.objects.create(message=message, text=f'More {i}', replier=self.receiver)
+        message.delete()
+        with CaptureQueriesContext(connection) as queries:
+            counts = run_retention(RetentionPolicy(), batch_size=2)
+        self.assertEqual(counts['replies'], 5)
+        # Three transactions of replies, then the message itself.
+        self.assertEqual(sum(query['sql'].startswith('SAVEPOINT') for query in queries.captured_queries), 4)
+        nested = ArchivedMessageReply.objects.get(data__text='Nested')
+        self.assertEqual(nested.data['parent_reply_id'], reply.pk)
+
+    def test_max_batches_resumes_on_next_run(self):
+        for i in range(3):
+            self.create_thread(f'Old {i}')
+        Message.all_objects.update(created_at=timezone.now() - datetime.timedelta(days=40))
+        self.create_thread('New')
+        policy = RetentionPolicy(archive_deleted=False, max_age_days=30)
+        self.assertEqual(run_retention(policy, batch_size=2, max_batches=1)['messages'], 2)
+        self.assertEqual(run_retention(policy, batch_size=2)['messages'], 1)
+        self.assertEqual(list(Message.objects.values_list('subject', flat=True)), ['New'])
+
+    def test_command_dry_run(self):
+        self.create_thread('Deleted')[0].delete()
+        out = StringIO()
+        call_command('qmessages_archive', dry_run=True, stdout=out)
+        self.assertIn('Would archive 1 messages', out.getvalue())
+        self.assertEqual(Message.all_objects.count(), 1)
+
+
+class StatusHistoryTests(TestCase):
+    def setUp(self):
+        self.sender = User.objects.create_user(username='sender', password='testpassword')
+        self.receiver = User.objects.create_user(username='receiver', password='testpassword')
+        self.message = Message.objects.create(sender=self.sender, receiver=self.receiver, subject='Subject', text='Test Text')
+        self.reply = MessageReply.objects.create(message=self.message, text='Reply', replier=self.receiver)
+
+    def test_read_receipts_are_idempotent(self):
+        read = status_registry.get(READ)
+        self.assertIsNotNone(MessageReplyStatus.record(self.reply, read))
+        for _ in range(3):
+            self.assertIsNone(MessageReplyStatus.record(self.reply, read))
+        MessageReplyStatus.record(self.reply, status_registry.get(REPLIED))
+        MessageReplyStatus.record(self.reply, read)
+        self.assertEqual(MessageReplyStatus.objects.filter(message_reply=self.reply).count(), 3)
+
+    def test_compaction_keeps_the_first_row_of_each_run(self):
+        descs = [UNREAD, UNREAD, READ, READ, READ, UNREAD]
+        rows = [MessageStatus.objects.create(message=self.message, message_desc=status_registry.get(desc)) for desc in descs]
+        for desc in (READ, READ):
+            MessageReplyStatus.objects.create(message_reply=self.reply, message_desc=status_registry.get(desc))
+        out = StringIO()
+        call_command('qmessages_compact_status', batch_size=1, stdout=out)
+        kept = list(MessageStatus.objects.order_by('created_at', 'id').values_list('id', flat=True))
+        self.assertEqual(kept, [rows[0].pk, rows[2].pk, rows[5].pk])
+        self.assertEqual(MessageReplyStatus.objects.count(), 1)
+        self.assertIn('Removed 3 duplicate', out.getvalue())
+
+class ServiceTests(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.sender = User.objects.create_user(username='sender', password='testpassword')
+        self.receiver = User.objects.create_user(username='receiver', password='testpassword')
+        self.message = send_message(self.sender, self.receiver, 'Subject', 'Test Text')
+        status_registry.get(UNREAD), status_registry.get(REPLIED)
+
+    def test_send_message_records_unread(self):
+        self.assertEqual(self.message.current_status_id, status_registry.get(UNREAD).id)
+        self.assertEqual(MessageStatus.objects.filter(message=self.message).count(), 1)
+
+    def test_post_reply_query_budget(self):
+        # Savepoints, the thread lock, the reply, its search index rows and thread summary, one insert per status table and the pointer.
+        with self.assertNumQueries(10):
+            reply = post_reply(self.message.token, self.receiver, 'Reply')
+        with self.assertNumQueries(12):
+            post_reply(self.message.token, self.sender, 'Nested', parent_reply_id=reply.pk)
+
+    def test_post_reply_statuses(self):
+        reply = post_reply(self.message.token, self.receiver, 'Reply')
+        self.message.refresh_from_db()
+        self.assertEqual(self.message.current_status_id, status_registry.get(REPLIED).id)
+        nested = post_reply(self.message.token, self.sender, 'Nested', parent_reply_id=reply.pk)
+        reply.refresh_from_db()
+        self.message.refresh_from_db()
+        self.assertEqual(reply.current_status_id, status_registry.get(REPLIED).id)
+        self.assertEqual(nested.current_status_id, status_registry.get(UNREAD).id)
+        self.assertEqual(self.message.current_status_id, status_registry.get(UNREAD).id)
+        post_reply(self.message.token, self.receiver, 'Second')
+        self.message.refresh_from_db()
+        self.assertEqual(self.message.current_status_id, status_registry.get(REPLIED).id)
+        post_reply(self.message.token, self.sender, 'Third')
+        self.message.refresh_from_db()
+        self.assertEqual(self.message.current_status_id, status_registry.get(REPLIED).id)
+        with self.assertRaises(MessageReply.DoesNotExist):
+            post_reply(self.message.token, self.sender, 'Orphan', parent_reply_id=0)
+
+    def test_reply_view_returns_reply_id(self):
+        request = self.factory.post('/message/reply/create/', data={'token': str(self.message.token), 'text': 'Reply'})
+        request.user = self.receiver
+        request.is_ajax = True
+        response = MessageReplyCreateView.as_view()(request)
+        reply = MessageReply.objects.get()
+        self.assertEqual(json.loads(response.content), {'success': str(reply.pk)})
+
+    def test_reply_view_rejects_bad_input(self):
+        cases = [
+            ({'token': 'not-a-token'}, 400),
+            ({'token': str(self.message.token), 'parent_reply': 'x'}, 400),
+            ({'token': str(uuid.uuid4())}, 404),
+            ({'token': str(self.message.token), 'parent_reply': '0'}, 404),
+        ]
+        for data, status in cases:
+            request = self.factory.post('/message/reply/create/', data={'text': 'Reply', **data})
+            request.user = self.receiver
+            request.is_ajax = True
+            response = MessageReplyCreateView.as_view()(request)
+            self.assertEqual(response.status_code, status, data)
+            self.assertIn('error', json.loads(response.content))
+        self.assertFalse(MessageReply.objects.exists())
+
+class ThreadSummaryTests(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.sender = User.objects.create_user(username='sender', password='testpassword')
+        self.receiver = User.objects.create_user(username='receiver', password='testpassword')
+        self.quiet = send_message(self.sender, self.receiver, 'Quiet', 'Test Text')
+        self.busy = send_message(self.sender, self.receiver, 'Busy', 'Test Text')
+        self.reply = post_reply(self.quiet.token, self.receiver, 'Reply')
+        self.nested = post_reply(self.quiet.token, self.sender, 'Nested', parent_reply_id=self.reply.pk)
+
+    def summary(self, message):
+        return Message.objects.values_list('reply_count', 'last_reply_at', 'last_replier_id').get(pk=message.pk)
+
+    def test_replies_update_the_summary(self):
+        self.assertEqual(self.summary(self.quiet), (2, self.nested.created_at, self.sender.pk))
+        self.quiet.save()
+        self.assertEqual(self.summary(self.quiet)[0], 2)
+        self.nested.delete()
+        self.assertEqual(self.summary(self.quiet), (1, self.reply.created_at, self.receiver.pk))
+        self.reply.hard_delete()
+        self.assertEqual(self.summary(self.quiet), (0, None, None))
+
+    def test_rebuild_command(self):
+        Message.all_objects.update(reply_count=0, last_reply_at=None, last_replier=None)
+        call_command('qmessages_rebuild_summary', stdout=StringIO())
+        self.assertEqual(self.summary(self.quiet), (2, self.nested.created_at, self.sender.pk))
+        self.assertEqual(self.summary(self.busy), (0, None, None))
+
+    def test_list_orders_by_last_activity_without_reading_replies(self):
+        request = self.factory.get('/message/list/', {'summary': '1', 'sort[0][field]': 'last_activity', 'sort[0][dir]': 'desc'})
+        request.user = self.sender
+        request.is_ajax = True
+        with CaptureQueriesContext(connection) as queries:
+            response = MessageListView.as_view()(request, tokens=[str(self.quiet.token), str(self.busy.token)])
+        data = json.loads(response.content)
+        self.assertEqual([(message['subject'], message['reply_count']) for message in data['data']], [('Quiet', 2), ('Busy', 0)])
+        self.assertNotIn('replies', data['data'][0])
+        self.assertFalse(any('qmessages_messagereply' in query['sql'] for query in queries.captured_queries))
+
+class AttachedTests(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.sender = User.objects.create_user(username='sender', password='testpassword')
+        self.receiver = User.objects.create_user(username='receiver', password='testpassword')
+        self.other = User.objects.create_user(username='other', password='testpassword')
+        self.first = send_message(self.sender, self.receiver, 'First', 'Test Text', 'Billing', 'Invoices', '1')
+        self.latest = send_message(self.sender, self.receiver, 'Latest', 'Test Text', 'Billing', 'Invoices', '1')
+        send_message(self.other, self.other, 'Private', 'Test Text', 'Billing', 'Invoices', '1')
+        send_message(self.sender, self.receiver, 'Other app', 'Test Text', 'Billing', 'Orders', '2')
+        Note.objects.create(project='Billing', app='Invoices', model='2', text='Invoice note')
+        bulk_set_status(self.receiver, [str(self.first.token)], status_registry.get(READ))
+
+    def lookup(self, **kwargs):
+        request = self.factory.post('/message/attached/', **kwargs)
+        request.user = self.receiver
+        return json.loads(AttachedView.as_view()(request).content)
+
+    def test_counts_in_one_query_per_kind(self):
+        keys = [('Billing', 'Invoices', '1'), ('Billing', 'Invoices', '2'), ('Billing', 'Orders', '1')]
+        with self.assertNumQueries(2):
+            messages, notes = attached_messages(self.receiver, keys), attached_notes(keys)
+        self.assertEqual(list(messages), [keys[0]])
+        self.assertEqual(messages[keys[0]]['count'], 2)
+        self.assertEqual(messages[keys[0]]['unread'], 1)
+        self.assertEqual(messages[keys[0]]['latest_token'], str(self.latest.token))
+        self.assertEqual(notes[keys[1]]['count'], 1)
+
+    def test_endpoint_returns_every_key_in_order(self):
+        data = self.lookup(data={'project': 'Billing', 'app': 'Invoices', 'model': ['2', '1']})['success']
+        self.assertEqual([(row['model'], row['messages']['count'], row['notes']['count']) for row in data], [('2', 0, 1), ('1', 2, 0)])
+        body = json.dumps({'keys': [['Billing', 'Orders', '2']]})
+        data = self.lookup(data=body, content_type='application/json')['success']
+        self.assertEqual(data[0]['messages']['count'], 1)
+        self.assertIn('error', self.lookup(data={'app': 'Invoices', 'model': '1'}))
+
+class NoteListTests(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.user = User.objects.create_user(username='testuser', password='testpassword')
+        self.notes = [
+            Note.objects.create(project='Billing', app='Invoices', model=str(i % 2), text=f'Note {i} ' + 'x' * 300)
+            for i in range(5)
+        ]
+        Note.objects.create(project='Sales', app='Invoices', model='0', text='Other project')
+
+    def get_data(self, view, token=None, **params):
+        request = self.factory.get('/note/', params)
+        request.user = self.user
+        return json.loads(view.as_view()(request, token=token).content)
+
+    def test_list_pages_previews(self):
+        with CaptureQueriesContext(connection) as queries:
+            first = self.get_data(NoteListView, project='Billing', pageSize=3)
+        # Only the preview reads the text column.
+        self.assertEqual(queries.captured_queries[0]['sql'].count('"text"'), 1)
+        self.assertEqual([note['preview'][:6] for note in first['data']], ['Note 4', 'Note 3', 'Note 2'])
+        self.assertEqual(len(first['data'][0]['preview']), NoteListView.preview_length)
+        self.assertNotIn('text', first['data'][0])
+        rest = self.get_data(NoteListView, project='Billing', pageSize=3, cursor=first['pagination']['next'])
+        self.assertEqual([note['preview'][:6] for note in rest['data']], ['Note 1', 'Note 0'])
+        scoped = self.get_data(NoteListView, project='Billing', model='1')
+        self.assertEqual([note['preview'][:6] for note in scoped['data']], ['Note 3', 'Note 1'])
+        self.assertIn('error', self.get_data(NoteListView))
+
+    def test_detail_and_batch_retrieval(self):
+        note = self.get_data(NoteDetailView, str(self.notes[0].token), project='Billing')
+        self.assertEqual(note['text'], self.notes[0].text)
+        self.assertIn('error', self.get_data(NoteDetailView, str(self.notes[0].token), project='Sales'))
+        tokens = [str(self.notes[3].token), str(uuid.uuid4()), str(self.notes[1].token)]
+        with self.assertNumQueries(1):
+            data = self.get_data(NoteDetailView, project='Billing', tokens=tokens)['data']
+        self.assertEqual([note['token'] for note in data], [tokens[0], tokens[2]])
+        data = self.get_data(NoteDetailView, project='Billing', tokens=','.join(tokens))['data']
+        self.assertEqual([note['token'] for note in data], [tokens[0], tokens[2]])
+
+class ResolveTokensTests(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.sender = User.objects.create_user(username='sender', password='testpassword')
+        self.receiver = User.objects.create_user(username='receiver', password='testpassword')
+        self.other = User.objects.create_user(username='other', password='testpassword')
+        self.messages = [send_message(self.sender, self.receiver, f'Subject {i}', 'Test Text') for i in range(3)]
+        self.private = send_message(self.other, self.other, 'Private', 'Test Text')
+        self.unknown = uuid.uuid4()
+
+    def resolve(self, data, content_type):
+        request = self.factory.post('/message/resolve/', data=data, content_type=content_type)
+        request.user = self.receiver
+        return json.loads(MessageResolveView.as_view()(request).content)
+
+    def test_resolves_json_tokens(self):
+        tokens = [str(message.token) for message in self.messages] + [str(self.private.token), str(self.unknown), 'nope']
+        data = self.resolve(json.dumps({'tokens': tokens}), 'application/json')
+        self.assertEqual(list(data['success']), tokens[:3])
+        self.assertEqual(data['success'][tokens[0]]['subject'], 'Subject 0')
+        self.assertEqual(data['forbidden'], [tokens[3]])
+        self.assertEqual(data['missing'], [tokens[4]])
+        self.assertEqual(data['invalid'], ['nope'])
+
+    def test_resolves_binary_tokens(self):
+        packed = b''.join(message.token.bytes for message in self.messages)
+        data = self.resolve(packed, 'application/octet-stream')
+        self.assertEqual(len(data['success']), 3)
+        data = self.resolve(json.dumps({'tokens_b64': base64.b64encode(packed[:16]).decode()}), 'application/json')
+        self.assertEqual(list(data['success']), [str(self.messages[0].token)])
+        self.assertIn('error', self.resolve(packed[:10], 'application/octet-stream'))
 
+    def test_resolves_in_chunks(self):
+        tokens = [message.token for message in self.messages] + [self.unknown]
+        with self.assertNumQueries(3):
+            found, missing, forbidden = resolve_tokens(self.receiver, tokens, batch_size=2)
+        self.assertEqual((len(found), missing, forbidden), (3, [str(self.unknown)], []))
 
-    
\ No newline at end of file
+    def test_list_view_reads_token_lists_from_the_query_string(self):
+        tokens = [str(message.token) for message in self.messages]
+        request = self.factory.get('/message/list/', {'tokens': [','.join(tokens[:2]), tokens[2]], 'summary': '1'})
+        request.user = self.receiver
+        request.is_ajax = True
+        data = json.loads(MessageListView.as_view()(request).content)
+        self.assertEqual(data['pagination']['count'], 3)
@@ -0,0 +1,94 @@
+"""
+Cache of serialized message threads. Each fragment is stored under the
+thread's current version, so a write only has to replace the version for
+readers to stop seeing the old fragment; the stale one expires on its own.
+Every write path bumps the versions of the threads it touches, and only
+those. The versions never expire, so the default cache has to be shared by
+every process (see the qmessages.W001 check); with a per-process cache a
+worker keeps serving threads another worker has changed.
+"""
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from qmessages.utils import chunks
+
+
+HITS_KEY = 'qmessages:thread-cache:hits'
+MISSES_KEY = 'qmessages:thread-cache:misses'
+
+def version_key(message_id):
+    return f'qmessages:thread-version:{message_id}'
+
+def thread_key(message_id, version):
+    return f'qmessages:thread:{message_id}:{version}'
+
+def get_timeout():
+    return getattr(settings, 'QMESSAGES_THREAD_CACHE_TIMEOUT', 3600)
+
+
+# Versions
+
+def _new_versions(message_ids):
+    cache.set_many({version_key(message_id): uuid.uuid4().hex for message_id in message_ids}, None)
+
+def bump_thread_versions(message_ids):
+    """
+    Invalidate the cached threads of `message_ids`. The versions are replaced
+    now and again on commit, so a reader that caches the thread while the
+    transaction is still open can't keep serving what it read.
+    """
+    message_ids = set(message_ids)
+    _new_versions(message_ids)
+    transaction.on_commit(lambda: _new_versions(message_ids))
+
+def bump_all_thread_versions(message_ids, batch_size=1000):
+    """Invalidate the threads of an iterable of message ids of any size, a batch at a time."""
+    for ids in chunks(message_ids, batch_size):
+        bump_thread_versions(ids)
+
+
+# Fragments
+
+def get_threads(message_ids):
+    """
+    Return (threads, keys): the cached thread dicts by message id, and the
+    key each missing thread should be stored under with `set_threads`.
+    """
+    versions = cache.get_many([version_key(message_id) for message_id in message_ids])
+    missing = [message_id for message_id in message_ids if version_key(message_id) not in versions]
+    if missing:
+        _new_versions(missing)
+        versions.update(cache.get_many([version_key(message_id) for message_id in missing]))
+
+    keys = {message_id: thread_key(message_id, versions.get(version_key(message_id))) for message_id in message_ids}
+    fragments = cache.get_many(keys.values())
+    threads = {message_id: fragments[key] for message_id, key in keys.items() if key in fragments}
+    _count(HITS_KEY, len(threads))
+    _count(MISSES_KEY, len(keys) - len(threads))
+    return threads, {message_id: key for message_id, key in keys.items() if message_id not in threads}
+
+def set_threads(threads, keys):
+    cache.set_many({keys[message_id]: thread for message_id, thread in threads.items()}, get_timeout())
+
+
+# Stats
+
+def _count(key, amount):
+    if not amount:
+        return
+    try:
+        cache.incr(key, amount)
+    except ValueError:
+        if not cache.add(key, amount, None):
+            cache.incr(key, amount)
+
+def get_stats():
+    counts = cache.get_many([HITS_KEY, MISSES_KEY])
+    hits, misses = counts.get(HITS_KEY, 0), counts.get(MISSES_KEY, 0)
+    return {'hits': hits, 'misses': misses, 'hit_ratio': hits / (hits + misses) if hits + misses else None}
+
+def reset_stats():
+    cache.delete_many([HITS_KEY, MISSES_KEY])
@@ -0,0 +1,42 @@
+from qmessages.models import MessageReply
+
+
+def build_reply_tree(replies):
+    """
+    Link `replies` of one message into a tree in O(n). Each reply gets a
+    `children` list and the top-level replies are returned in input order.
+    Replies whose parent isn't in `replies` (e.g. soft-deleted) are dropped
+    along with their subtree, as they were when walking the tree level by level.
+    """
+    by_id = {}
+    for reply in replies:
+        reply.children = []
+        by_id[reply.id] = reply
+
+    roots = []
+    for reply in replies:
+        if reply.parent_reply_id is None:
+            roots.append(reply)
+        elif reply.parent_reply_id in by_id:
+            by_id[reply.parent_reply_id].children.append(reply)
+    return roots
+
+def get_reply_tree(message):
+    """Fetch every live reply of `message` in one query and return the top-level replies."""
+    replies = MessageReply.objects.filter(message=message).select_related('replier', 'current_status').order_by('id')
+    return build_reply_tree(list(replies))
+
+def attach_reply_trees(messages):
+    """Set `reply_tree` on messages fetched through `thread_queryset`."""
+    for message in messages:
+        message.reply_tree = build_reply_tree(message.thread_replies)
+    return messages
+
+def find_reply(tree, reply_id):
+    stack = list(tree)
+    while stack:
+        reply = stack.pop()
+        if reply.id == reply_id:
+            return reply
+        stack.extend(reply.children)
+    return None
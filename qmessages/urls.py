@@ -1,24 +1,45 @@
+from django.conf import settings
 from django.urls import path
 from qmessages import views
 
+if getattr(settings, 'QMESSAGES_ASYNC_VIEWS', False):
+    from qmessages import async_views
+    MessageListView = async_views.AsyncMessageListView
+    MessageDetailView = async_views.AsyncMessageDetailView
+    MessageReplyCreateView = async_views.AsyncMessageReplyCreateView
+else:
+    MessageListView = views.MessageListView
+    MessageDetailView = views.MessageDetailView
+    MessageReplyCreateView = views.MessageReplyCreateView
+
 app_name = "qmessages"
 
 urlpatterns = [
 
     path('message/create/', views.MessageCreateView.as_view(), name='message_create_view'),
-    path('message/list/', views.MessageListView.as_view(), name='message_list_view'),
-    path('message/detail/', views.MessageDetailView.as_view(), name='message_detail_view'),
-    path('message/detail/<str:token>/', views.MessageDetailView.as_view(), name='message_detail_view_with_token'),
-    path('message/detail/<str:token>/<int:parent_reply>/', views.MessageDetailView.as_view(), name='message_detail_view_with_token_and_parent_reply'),
+    path('message/broadcast/', views.MessageBroadcastView.as_view(), name='message_broadcast_view'),
+    path('message/list/', MessageListView.as_view(), name='message_list_view'),
+    path('message/search/', views.SearchView.as_view(), name='message_search_view'),
+    path('message/export/', views.MessageExportView.as_view(), name='message_export_view'),
+    path('message/stream/', views.MessageStreamView.as_view(), name='message_stream_view'),
+    path('message/attached/', views.AttachedView.as_view(), name='message_attached_view'),
+    path('message/resolve/', views.MessageResolveView.as_view(), name='message_resolve_view'),
+    path('message/unread/', views.UnreadCountView.as_view(), name='message_unread_count_view'),
+    path('message/detail/', MessageDetailView.as_view(), name='message_detail_view'),
+    path('message/detail/<str:token>/', MessageDetailView.as_view(), name='message_detail_view_with_token'),
+    path('message/detail/<str:token>/<int:parent_reply>/', MessageDetailView.as_view(), name='message_detail_view_with_token_and_parent_reply'),
     path('message/update/', views.MessageUpdateView.as_view(), name='message_update_view'),
     path('message/update/<str:token>/', views.MessageUpdateView.as_view(), name='message_update_view_with_token'),
     path('message/update/status/', views.MessageStatusUpdateView.as_view(), name='message_status_update_view'),
     path('message/delete/<str:token>/', views.MessageDeleteView.as_view(), name='message_delete_view'),
-    path('message/reply/create/', views.MessageReplyCreateView.as_view(), name='message_reply_create_view'),
-    path('message/reply/create/<str:token>/', views.MessageReplyCreateView.as_view(), name='message_reply_create_view_with_token'),
-    path('message/reply/create/<str:token>/<int:parent_reply>/', views.MessageReplyCreateView.as_view(), name='message_reply_create_view_with_token'),
+    path('message/reply/create/', MessageReplyCreateView.as_view(), name='message_reply_create_view'),
+    path('message/reply/create/<str:token>/', MessageReplyCreateView.as_view(), name='message_reply_create_view_with_token'),
+    path('message/reply/create/<str:token>/<int:parent_reply>/', MessageReplyCreateView.as_view(), name='message_reply_create_view_with_token'),
     path('message/reply/update/<int:pk>/', views.MessageReplyUpdateView.as_view(), name='message_reply_update_view'),
     path('message/reply/detail/<int:pk>/', views.MessageReplyDetailView.as_view(), name='message_reply_detail_view'),
     path('message/reply/delete/<int:pk>/', views.MessageReplyDeleteView.as_view(), name='message_reply_delete_view'),
     path('note/create/', views.NoteCreateView.as_view(), name='note_create_view'),
+    path('note/list/', views.NoteListView.as_view(), name='note_list_view'),
+    path('note/detail/', views.NoteDetailView.as_view(), name='note_detail_view'),
+    path('note/detail/<str:token>/', views.NoteDetailView.as_view(), name='note_detail_view_with_token'),
 ]
\ No newline at end of file
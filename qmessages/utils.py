@@ -1,5 +1,13 @@
+import base64
+import itertools
+import json
+import re
 import uuid
 
+from django.db import connections
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
 
 # Django Utils
 
@@ -7,6 +15,8 @@ def check_token(tokens):
     uuid_tokens = []
     if not tokens:
         return []
+    if isinstance(tokens, str):
+        tokens = [tokens]
     for token in tokens:
         try:
             uuid_token = uuid.UUID(token)
@@ -16,30 +26,198 @@ def check_token(tokens):
         
     return uuid_tokens
 
-# Kendo Utils Integration
+def split_tokens(values):
+    """Flatten token parameters, each of which may hold a comma separated list."""
+    return [token.strip() for value in values for token in value.split(',') if token.strip()]
+
+def decode_binary_tokens(data):
+    """Decode UUIDs packed as consecutive 16 byte values."""
+    if len(data) % 16:
+        raise ValueError('Invalid binary token list')
+    return [uuid.UUID(bytes=bytes(data[start:start + 16])) for start in range(0, len(data), 16)]
+
+def chunks(items, size=500):
+    """Split `items` into lists of at most `size` to stay under backend parameter limits."""
+    iterator = iter(items)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+def clamp_page_size(value, default, maximum):
+    """Parse a page size from the query string, capped at `maximum`. Missing or invalid values give `default`."""
+    try:
+        return min(max(int(value), 1), maximum)
+    except (TypeError, ValueError):
+        return default
+
+# Keyset Pagination
 
-def map_kendo_operator_to_django(kendo_operator):
-    operator_mapping = {
-        'eq': 'exact',
-        'neq': 'exclude_exact',
-        'isnull': 'isnull',
-        'isnotnull': 'exclude_isnull',
-        'isempty': 'exact',
-        'isnotempty': 'exclude_exact',
-        'startswith': 'istartswith',
-        'doesnotstartwith': 'exclude_istartswith',
-        'contains': 'icontains',
-        'doesnotcontain': 'exclude_icontains',
-        'endswith': 'iendswith',
-        'doesnotendwith': 'exclude_iendswith'
+def encode_cursor(created_at, pk, reverse=False):
+    payload = json.dumps([created_at.isoformat(), pk, reverse], separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    """Return (created_at, pk, reverse) or raise ValueError for a malformed cursor."""
+    try:
+        payload = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        created_at, pk, reverse = json.loads(payload)
+        created_at = parse_datetime(created_at)
+    except (TypeError, ValueError):
+        raise ValueError('Invalid cursor')
+    if created_at is None or not isinstance(pk, int) or not isinstance(reverse, bool):
+        raise ValueError('Invalid cursor')
+    return created_at, pk, reverse
+
+def paginate_by_cursor(queryset, cursor, page_size):
+    """
+    Return one page of `queryset`, newest first, keyed on (created_at, id)
+    together with the cursors of its neighbouring pages. An empty cursor
+    returns the first page.
+    """
+    reverse = False
+    if cursor:
+        created_at, pk, reverse = decode_cursor(cursor)
+        if reverse:
+            queryset = queryset.filter(Q(created_at__gt=created_at) | Q(created_at=created_at, pk__gt=pk))
+        else:
+            queryset = queryset.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, pk__lt=pk))
+
+    if reverse:
+        items = list(queryset.order_by('created_at', 'id')[:page_size + 1])
+        has_more = len(items) > page_size
+        items = items[:page_size][::-1]
+        has_next, has_previous = True, has_more
+    else:
+        items = list(queryset.order_by('-created_at', '-id')[:page_size + 1])
+        has_more = len(items) > page_size
+        items = items[:page_size]
+        has_next, has_previous = has_more, bool(cursor)
+
+    pagination = {
+        'next': encode_cursor(items[-1].created_at, items[-1].pk) if items and has_next else None,
+        'previous': encode_cursor(items[0].created_at, items[0].pk, reverse=True) if items and has_previous else None,
+        'has_next': has_next,
+        'has_previous': has_previous,
     }
-    return operator_mapping.get(kendo_operator)
-
-def get_filters_from_request(request):
-    field = request.GET.get('filter[filters][0][field]')
-    operator = request.GET.get('filter[filters][0][operator]')
-    value = request.GET.get('filter[filters][0][value]')
-    operator = map_kendo_operator_to_django(operator)
-    
-    return {f'{field}__{operator}': value}
-        
\ No newline at end of file
+    return items, pagination
+
+def estimate_count(queryset):
+    """
+    Return the planner's row estimate for `queryset` on PostgreSQL and fall
+    back to an exact count on backends that don't expose one.
+    """
+    if connections[queryset.db].vendor == 'postgresql':
+        plan = json.loads(queryset.order_by().explain(format='json'))
+        return int(plan[0]['Plan']['Plan Rows'])
+    return queryset.count()
+
+# Kendo Utils Integration
+
+class KendoQueryError(ValueError):
+    pass
+
+KENDO_OPERATORS = {
+    'eq': ('exact', False, None),
+    'neq': ('exact', True, None),
+    'isnull': ('isnull', False, True),
+    'isnotnull': ('isnull', True, True),
+    'isempty': ('exact', False, ''),
+    'isnotempty': ('exact', True, ''),
+    'startswith': ('istartswith', False, None),
+    'doesnotstartwith': ('istartswith', True, None),
+    'contains': ('icontains', False, None),
+    'doesnotcontain': ('icontains', True, None),
+    'endswith': ('iendswith', False, None),
+    'doesnotendwith': ('iendswith', True, None),
+    'gt': ('gt', False, None),
+    'gte': ('gte', False, None),
+    'lt': ('lt', False, None),
+    'lte': ('lte', False, None),
+}
+
+KENDO_PARAM_RE = re.compile(r'^(filter|sort|group)((?:\[[A-Za-z0-9_]+\])+)$')
+
+def parse_kendo_params(params):
+    """
+    Turn Kendo DataSource query string keys such as
+    `filter[filters][0][field]` into nested dicts and lists.
+    """
+    tree = {}
+    for key in params:
+        match = KENDO_PARAM_RE.match(key)
+        if not match:
+            continue
+        path = [match.group(1)] + re.findall(r'\[([A-Za-z0-9_]+)\]', match.group(2))
+        node = tree
+        for part in path[:-1]:
+            node = node.setdefault(part, {})
+            if not isinstance(node, dict):
+                raise KendoQueryError(f'Invalid parameter {key}')
+        node[path[-1]] = params.get(key)
+    return _kendo_lists(tree)
+
+def _kendo_lists(node):
+    if not isinstance(node, dict):
+        return node
+    node = {key: _kendo_lists(value) for key, value in node.items()}
+    if node and all(key.isdigit() for key in node):
+        return [node[key] for key in sorted(node, key=int)]
+    return node
+
+def compile_kendo_filter(node, fields):
+    """Compile a Kendo filter (a condition or a logic group) into a Q object."""
+    if not isinstance(node, dict):
+        raise KendoQueryError('Invalid filter')
+    if 'filters' in node:
+        filters = node['filters']
+        if not isinstance(filters, list):
+            raise KendoQueryError('Invalid filter group')
+        logic = node.get('logic', 'and')
+        if logic not in ('and', 'or'):
+            raise KendoQueryError(f'Unsupported filter logic {logic}')
+        query = Q()
+        for child in filters:
+            child_query = compile_kendo_filter(child, fields)
+            query = query | child_query if logic == 'or' else query & child_query
+        return query
+
+    field, operator = node.get('field'), node.get('operator')
+    if field not in fields:
+        raise KendoQueryError(f'Filtering on {field} is not allowed')
+    if operator not in KENDO_OPERATORS:
+        raise KendoQueryError(f'Unsupported filter operator {operator}')
+    lookup, negate, value = KENDO_OPERATORS[operator]
+    query = Q(**{f'{fields[field]}__{lookup}': node.get('value') if value is None else value})
+    return ~query if negate else query
+
+def compile_kendo_ordering(node, fields, kind='sort'):
+    if not isinstance(node, list):
+        raise KendoQueryError(f'Invalid {kind}')
+    ordering = []
+    for item in node:
+        if not isinstance(item, dict) or item.get('field') not in fields:
+            raise KendoQueryError(f'Sorting on {item.get("field") if isinstance(item, dict) else item} is not allowed')
+        direction = item.get('dir') or 'asc'
+        if direction not in ('asc', 'desc'):
+            raise KendoQueryError(f'Unsupported {kind} direction {direction}')
+        ordering.append(('-' if direction == 'desc' else '') + fields[item['field']])
+    return ordering
+
+def compile_kendo_query(params, fields):
+    """
+    Compile a complete Kendo DataSource request (`filter`, `sort` and
+    `group`) into a Q object and an ordering list. `fields` maps the grid
+    field names to the model paths they may touch; anything else raises
+    KendoQueryError. Groups sort before the explicit sort, as the grid
+    expects rows of one group to be contiguous.
+    """
+    tree = parse_kendo_params(params)
+    query = compile_kendo_filter(tree['filter'], fields) if 'filter' in tree else Q()
+    ordering = []
+    if 'group' in tree:
+        ordering += compile_kendo_ordering(tree['group'], fields, kind='group')
+    if 'sort' in tree:
+        ordering += compile_kendo_ordering(tree['sort'], fields)
+    return query, ordering
@@ -1,5 +1,12 @@
 
 
+import base64
+import binascii
+import json
+import math
+import time
+import uuid
+
 # Django
 from django.forms import model_to_dict
 from django.shortcuts import get_object_or_404, render
@@ -7,15 +14,32 @@ from django.urls import reverse
 from django.views import View
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.views.generic import ListView
-from django.http import HttpResponse, JsonResponse
+from django.http import HttpResponse, HttpResponseRedirect, JsonResponse, StreamingHttpResponse
 from django.views.generic.detail import DetailView
 from django.views.generic.edit import CreateView, UpdateView, DeleteView
+from django.conf import settings
+from django.core.exceptions import FieldError, ValidationError
+from django.core.handlers.asgi import ASGIRequest
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db.models import Q
+from django.db.models.functions import Coalesce
 
 # Qmessages
-from qmessages.forms import MessageForm, MessageReplyForm, NoteForm
-from qmessages.models import Message, MessageReply, MessageReplyStatus, MessageStatus, MessageStatusDesc, Note
-from qmessages.utils import check_token, get_filters_from_request
+from qmessages import attached, events, export, search, services
+from qmessages.conditional import not_modified_response, set_validators, summary_validators, thread_validators
+from qmessages.counters import get_unread_count
+from qmessages.forms import MessageBroadcastForm, MessageForm, MessageReplyForm, NoteForm
+from qmessages.models import Message, MessageReply, MessageReplyStatus, MessageStatusDesc, Note
+from qmessages.serializers import (
+    iter_thread_dicts, note_preview_queryset, serialize_note, serialize_summaries, serialize_threads, thread_queryset, thread_values,
+)
+from qmessages.services import broadcast_message, bulk_set_status, post_reply, send_message
+from qmessages.status import READ, status_registry
+from qmessages.threads import attach_reply_trees, find_reply, get_reply_tree
+from qmessages.utils import (
+    KendoQueryError, check_token, clamp_page_size, compile_kendo_query, decode_binary_tokens, estimate_count, paginate_by_cursor,
+    split_tokens,
+)
 
 
 # Messages
@@ -40,18 +64,13 @@ class MessageCreateView(LoginRequiredMixin, CreateView):
         return context
     
     def form_valid(self, form):
-        self.object = form.save(commit=False)
-        self.object.project = self.kwargs.get('project') or self.request.POST.get('project')
-        self.object.app = self.kwargs.get('app') or self.request.POST.get('app')
-        self.object.model = self.kwargs.get('model') or self.request.POST.get('model')
-        self.object.save()
-        status_desc = MessageStatusDesc.objects.get(desc='Unread')
-        MessageStatus.objects.create(message_desc=status_desc, message=self.object)
-        if self.request.is_ajax:
-            return {"success": str(self.object.token)}
-        else:
-            super().form_valid(form)
-            return {"success": str(self.object.token)}
+        self.object = send_message(
+            self.request.user, form.cleaned_data['receiver'], form.cleaned_data['subject'], form.cleaned_data['text'],
+            project=self.kwargs.get('project') or self.request.POST.get('project'),
+            app=self.kwargs.get('app') or self.request.POST.get('app'),
+            model=self.kwargs.get('model') or self.request.POST.get('model'),
+        )
+        return {"success": str(self.object.token)}
 
     def form_invalid(self, form):
         return {"error": form.errors}
@@ -59,6 +78,27 @@ class MessageCreateView(LoginRequiredMixin, CreateView):
     def render_to_response(self, context, **response_kwargs):
         return super().render_to_response(context, **response_kwargs)
 
+class MessageBroadcastView(LoginRequiredMixin, View):
+    """Broadcasting needs the qmessages.broadcast_message permission."""
+    form_class = MessageBroadcastForm
+
+    def post(self, request, *args, **kwargs):
+        if not request.user.has_perm('qmessages.broadcast_message'):
+            return JsonResponse({"error": 'You are not allowed to broadcast messages'}, status=403)
+        form = self.form_class(data=request.POST, user=request.user)
+        if not form.is_valid():
+            return JsonResponse({"error": form.errors}, safe=False)
+        tokens = broadcast_message(
+            request.user,
+            form.cleaned_data['receivers'],
+            form.cleaned_data['subject'],
+            form.cleaned_data['text'],
+            project=form.cleaned_data['project'],
+            app=form.cleaned_data['app'],
+            model=form.cleaned_data['model'],
+        )
+        return JsonResponse({"success": [str(token) for token in tokens]}, safe=False)
+
 class MessageUpdateView(LoginRequiredMixin, UpdateView):
     model = Message
     form_class = MessageForm
@@ -107,11 +147,28 @@ class MessageDetailView(LoginRequiredMixin, DetailView):
         uuid_token = check_token([token])
         return Message.objects.get(token=uuid_token[0])
 
+    def get(self, request, *args, **kwargs):
+        token = kwargs.get('token', None) or request.GET.get('token', None)
+        threads = Message.objects.filter(token__in=check_token([token]))
+        etag, last_modified = thread_validators(threads, request.user.pk, request.is_ajax, kwargs.get('parent_reply'))
+        response = not_modified_response(request, etag, last_modified)
+        if response is None:
+            response = super().get(request, *args, **kwargs)
+        return set_validators(response, etag, last_modified)
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        replies = get_reply_tree(self.object)
+        parent_reply = self.kwargs.get('parent_reply', None)
+        if parent_reply is not None:
+            reply = find_reply(replies, parent_reply)
+            replies = [reply] if reply else []
+        context['replies'] = replies
+        return context
+
     def render_to_response(self, context, **response_kwargs):
         if self.request.is_ajax:
-            message_data_dict = model_to_dict(self.object)
-            message_data_dict['token'] = str(self.object.token)
-            return JsonResponse(message_data_dict, safe=False)
+            return JsonResponse(serialize_threads([self.object.pk])[0], safe=False)
         else:
             return super().render_to_response(context, **response_kwargs)
 
@@ -119,108 +176,85 @@ class MessageListView(LoginRequiredMixin, ListView):
     model = Message
     paginate_by = 5
     max_paginate_by = 100
+    max_stream_paginate_by = 10000
+    stream_chunk_size = 200
+    kendo_fields = {
+        'id': 'id',
+        'project': 'project',
+        'app': 'app',
+        'model': 'model',
+        'sender': 'sender__email',
+        'receiver': 'receiver',
+        'subject': 'subject',
+        'text': 'text',
+        'status': 'current_status__desc',
+        'created_at': 'created_at',
+        'updated_at': 'updated_at',
+        'reply_count': 'reply_count',
+        'last_reply_at': 'last_reply_at',
+        'last_activity': 'last_activity',
+    }
 
     def get_paginate_by(self, queryset):
-        if 'pageSize' not in self.request.GET:
-            self.paginate_by = self.max_paginate_by
-            return self.paginate_by
-        return self.request.GET.get('pageSize', self.paginate_by)
+        return clamp_page_size(self.request.GET.get('pageSize'), self.max_paginate_by, self.max_paginate_by)
     
     def get_queryset(self, request, *args, **kwargs):
         uuid_tokens = check_token(self.tokens)
         queryset = Message.objects.filter(
             Q(token__in=uuid_tokens) & (Q(sender=self.request.user) | Q(receiver=self.request.user))
-        ).order_by('-created_at')
+        ).alias(last_activity=Coalesce('last_reply_at', 'created_at')).order_by('-created_at')
         
         if request.is_ajax:
-            if 'filter[filters][0][field]' in request.GET:
-                filters = get_filters_from_request(request)
-                new_filters = {}
-                operation = 'filter'
-                for k, v in filters.items():
-                    if 'exclude_' in k:
-                        operation = 'exclude'
-                        new_filters[k.replace('exclude_', '')] = v
-                    else:
-                        new_filters[k] = v
-
-                if operation == 'exclude':
-                    queryset = queryset.exclude(**new_filters)
-                else:
-                    queryset = queryset.filter(**new_filters)
-                
-            return queryset
-        else:
-            return queryset
+            query, ordering = compile_kendo_query(request.GET, self.kendo_fields)
+            try:
+                queryset = queryset.filter(query)
+            except (FieldError, ValidationError, ValueError):
+                # A lookup the field doesn't support (text operators on `receiver`) or a value it can't take.
+                raise KendoQueryError('Invalid filter')
+            if ordering:
+                queryset = queryset.order_by(*ordering, '-created_at', '-id')
+
+        return thread_queryset(queryset)
     
     def get(self, request, *args, **kwargs):
-        self.tokens = kwargs.get('tokens', None) or request.GET.get('tokens', None)
-        self.object_list = self.get_queryset(request, *args, **kwargs)
+        self.tokens = kwargs.get('tokens', None) or split_tokens(request.GET.getlist('tokens'))
+        try:
+            self.object_list = self.get_queryset(request, *args, **kwargs)
+        except KendoQueryError as e:
+            return JsonResponse({"error": str(e)}, status=400)
+
+        etag, last_modified = self.get_validators(request)
+        response = not_modified_response(request, etag, last_modified)
+        if response is None:
+            response = self.get_page_response(request, **kwargs)
+        return set_validators(response, etag, last_modified)
+
+    def get_validators(self, request):
+        if request.is_ajax and 'summary' in request.GET:
+            return summary_validators(self.object_list, request.user.pk, self.tokens, sorted(request.GET.lists()))
+        return thread_validators(self.object_list, request.user.pk, request.is_ajax, self.tokens, sorted(request.GET.lists()))
+
+    def get_page_response(self, request, **kwargs):
+        if request.is_ajax and 'cursor' in request.GET:
+            return self.get_cursor_response(request)
+        if request.is_ajax and 'stream' in request.GET:
+            return self.get_stream_response(request)
+
         context = self.get_context_data(**kwargs)
 
         if request.is_ajax:
-            if not context['page_obj'].object_list.exists():
+            page_obj = context['page_obj']
+            if 'summary' in request.GET:
+                # The summary lives on the messages, so the replies aren't read at all.
+                threads = serialize_summaries(page_obj.object_list)
+            else:
+                # Only the ids come from the page; the threads come from the cache.
+                threads = serialize_threads(list(page_obj.object_list.values_list('pk', flat=True)))
+            if not threads:
                 return JsonResponse({"error": 'No data found for this token'}, status=404)
 
-            message_data_list = []
-
-            for message in context['page_obj']:
-                message_dict = model_to_dict(message)
-                message_dict['token'] = str(message.token)
-                message_dict['sender'] = message.sender.email
-                message_dict['created_at'] = message.created_at
-                message_dict['updated_at'] = message.updated_at
-
-                # Get the latest status of the message
-                message_status = MessageStatus.objects.filter(message=message).order_by('-created_at').first()
-                if message_status:
-                    message_dict['status'] = message_status.message_desc.desc
-
-                top_level_replies = MessageReply.objects.filter(message=message, parent_reply__isnull=True)
-                reply_list = []
-
-                for reply in top_level_replies:
-                    reply_dict = model_to_dict(reply)
-                    reply_dict['created_at'] = reply.created_at
-                    reply_dict['updated_at'] = reply.updated_at
-                    reply_dict['replier'] = reply.replier.email
-
-                    # Get the latest status of the reply
-                    reply_status = MessageReplyStatus.objects.filter(message_reply=reply).order_by('-created_at').first()
-                    if reply_status:
-                        reply_dict['status'] = reply_status.message_desc.desc
-
-                    nested_replies = MessageReply.objects.filter(parent_reply=reply)
-                    nested_reply_list = []
-
-                    for nested_reply in nested_replies:
-                        nested_reply_dict = model_to_dict(nested_reply)
-                        nested_reply_dict['created_at'] = nested_reply.created_at
-                        nested_reply_dict['updated_at'] = nested_reply.updated_at
-                        nested_reply_dict['replier'] = nested_reply.replier.email
-
-                        # Get the latest status of the nested reply
-                        nested_reply_status = MessageReplyStatus.objects.filter(message_reply=nested_reply).order_by('-created_at').first()
-                        if nested_reply_status:
-                            nested_reply_dict['status'] = nested_reply_status.message_desc.desc
-
-                        nested_reply_list.append(nested_reply_dict)
-
-                    reply_dict['replies'] = nested_reply_list
-                    reply_list.append(reply_dict)
-
-                message_dict['replies'] = reply_list
-                message_data_list.append(message_dict)
-
-            # Convert the flat list to a hierarchical structure
-            message_data_dict = {}
-            for message_dict in message_data_list:
-                message_data_dict[message_dict['id']] = message_dict
-
-            hierarchical_data_list = list(message_data_dict.values())
-
             data = {
-                'data': hierarchical_data_list,
+                'data': threads,
                 'pagination': {
                     'page': context['page_obj'].number,
                     'total_pages': context['page_obj'].paginator.num_pages,
@@ -233,8 +267,354 @@ class MessageListView(LoginRequiredMixin, ListView):
             return JsonResponse(data, safe=False)
 
         else:
+            page_obj = context['page_obj']
+            page_obj.object_list = context['object_list'] = attach_reply_trees(list(page_obj.object_list))
             return render(request, 'message_list.html', context)
 
+    def get_cursor_response(self, request):
+        page_size = self.get_paginate_by(self.object_list)
+        try:
+            messages, pagination = paginate_by_cursor(self.object_list.prefetch_related(None), request.GET.get('cursor'), page_size)
+        except ValueError:
+            return JsonResponse({"error": 'Invalid cursor'}, status=400)
+        if not messages:
+            return JsonResponse({"error": 'No data found for this token'}, status=404)
+
+        count_mode = request.GET.get('count')
+        if count_mode == 'exact':
+            pagination['count'] = self.object_list.count()
+        elif count_mode == 'estimate':
+            pagination['count'] = estimate_count(self.object_list)
+        else:
+            pagination['count'] = None
+
+        data = {
+            'data': serialize_threads([message.pk for message in messages]),
+            'pagination': pagination,
+        }
+        return JsonResponse(data, safe=False)
+
+    def get_stream_response(self, request):
+        """
+        Write the page as it is read: values() rows are fetched in chunks of
+        `stream_chunk_size` and encoded one thread at a time, so large pages
+        don't have to fit in memory. No count is made; `has_next` comes from
+        reading one row past the page.
+        """
+        try:
+            page_number, page_size, rows = self.get_stream_rows(request)
+        except ValueError:
+            return JsonResponse({"error": 'Invalid page'}, status=400)
+        rows = rows.iterator(chunk_size=self.stream_chunk_size)
+
+        def stream():
+            yield '{"data": ['
+            has_next = False
+            for position, thread in enumerate(iter_thread_dicts(rows, self.stream_chunk_size)):
+                if position == page_size:
+                    has_next = True
+                    break
+                yield (',' if position else '') + json.dumps(thread, cls=DjangoJSONEncoder)
+            yield self.stream_tail(page_number, page_size, has_next)
+
+        return StreamingHttpResponse(stream(), content_type='application/json')
+
+    def get_stream_rows(self, request):
+        """Return the page number, the page size and the values() rows of the page plus one."""
+        page_size = clamp_page_size(request.GET.get('pageSize'), self.max_paginate_by, self.max_stream_paginate_by)
+        page_number = max(int(request.GET.get(self.page_kwarg) or 1), 1)
+        offset = (page_number - 1) * page_size
+        return page_number, page_size, thread_values(self.object_list)[offset:offset + page_size + 1]
+
+    def stream_tail(self, page_number, page_size, has_next):
+        pagination = {'page': page_number, 'page_size': page_size, 'has_next': has_next, 'has_previous': page_number > 1}
+        return '], "pagination": ' + json.dumps(pagination) + '}'
+
+
+class MessageExportView(LoginRequiredMixin, View):
+    """
+    Download the user's messages with reply trees and status history as
+    NDJSON or CSV, optionally gzipped. Staff may export another user's
+    messages with `user`. The file is written while it is read from the database.
+    """
+    content_types = {export.NDJSON: 'application/x-ndjson', export.CSV: 'text/csv'}
+    chunk_size = 500
+
+    def get(self, request, *args, **kwargs):
+        export_format = request.GET.get('format', export.NDJSON)
+        if export_format not in export.FORMATS:
+            return JsonResponse({"error": 'Invalid format'}, status=400)
+        try:
+            since = export.parse_export_date(request.GET.get('since'))
+            until = export.parse_export_date(request.GET.get('until'))
+        except ValueError as e:
+            return JsonResponse({"error": str(e)}, status=400)
+
+        user = request.user.pk
+        if request.user.is_staff and request.GET.get('user'):
+            try:
+                user = int(request.GET.get('user'))
+            except ValueError:
+                return JsonResponse({"error": 'Invalid user'}, status=400)
+        queryset = export.export_queryset(
+            user=user, project=request.GET.get('project'), app=request.GET.get('app'), model=request.GET.get('model'),
+            since=since, until=until,
+        )
+        lines = export.export_lines(export.iter_export_records(queryset, chunk_size=self.chunk_size), export_format)
+
+        filename = f'messages.{export_format}'
+        if request.GET.get('gzip'):
+            response = StreamingHttpResponse(export.gzip_chunks(lines), content_type='application/gzip')
+            filename += '.gz'
+        else:
+            response = StreamingHttpResponse(lines, content_type=self.content_types[export_format])
+        response['Content-Disposition'] = f'attachment; filename="{filename}"'
+        return response
+
+class AttachedView(LoginRequiredMixin, View):
+    """
+    Count the messages and notes attached to a batch of host records. Send
+    one `project` and `app` with a list of `model` values, or a JSON body
+    `{"keys": [[project, app, model], ...]}` for keys that don't share them.
+    Every key comes back, in order, with its counts and latest tokens.
+    """
+    max_keys = 1000
+
+    def get(self, request, *args, **kwargs):
+        return self.lookup(request, request.GET)
+
+    def post(self, request, *args, **kwargs):
+        if request.content_type == 'application/json':
+            try:
+                keys = [tuple(key) for key in json.loads(request.body)['keys']]
+            except (ValueError, KeyError, TypeError):
+                return JsonResponse({"error": 'Invalid keys'}, status=400)
+            return self.get_response(request, keys)
+        return self.lookup(request, request.POST)
+
+    def lookup(self, request, params):
+        keys = attached.make_keys(params.get('project'), params.get('app'), params.getlist('model'))
+        return self.get_response(request, keys)
+
+    def get_response(self, request, keys):
+        if not keys or any(len(key) != 3 or not all(isinstance(part, str) for part in key) for key in keys):
+            return JsonResponse({"error": 'Invalid keys'}, status=400)
+        if len(keys) > self.max_keys:
+            return JsonResponse({"error": f'At most {self.max_keys} keys per request'}, status=400)
+
+        messages = attached.attached_messages(request.user, keys)
+        notes = attached.attached_notes(keys)
+        empty_messages = {'count': 0, 'latest_at': None, 'latest_token': None, 'unread': 0}
+        empty_notes = {'count': 0, 'latest_at': None, 'latest_token': None}
+        data = [
+            {
+                'project': key[0], 'app': key[1], 'model': key[2],
+                'messages': messages.get(key, empty_messages), 'notes': notes.get(key, empty_notes),
+            }
+            for key in keys
+        ]
+        return JsonResponse({"success": data})
+
+class MessageResolveView(LoginRequiredMixin, View):
+    """
+    Resolve a large set of message tokens in one request. Send them as a
+    JSON body, `{"tokens": [...]}` or `{"tokens_b64": ...}` with the UUIDs
+    packed as 16 bytes each, as a raw application/octet-stream body of
+    packed UUIDs, or as form `tokens`. The summaries of the user's messages
+    come back keyed by token; unknown, other users' and malformed tokens
+    are listed under `missing`, `forbidden` and `invalid`.
+    """
+    max_tokens = 10000
+
+    def post(self, request, *args, **kwargs):
+        try:
+            tokens = self.get_tokens(request)
+        except (ValueError, KeyError, TypeError, binascii.Error):
+            return JsonResponse({"error": 'Invalid tokens'}, status=400)
+        if len(tokens) > self.max_tokens:
+            return JsonResponse({"error": f'At most {self.max_tokens} tokens per request'}, status=400)
+
+        uuid_tokens, invalid = {}, []
+        for token in tokens:
+            if isinstance(token, uuid.UUID):
+                uuid_tokens.setdefault(token, None)
+                continue
+            uuid_token = check_token([token]) if isinstance(token, str) else []
+            if uuid_token:
+                uuid_tokens.setdefault(uuid_token[0], None)
+            else:
+                invalid.append(token)
+
+        found, missing, forbidden = services.resolve_tokens(request.user, list(uuid_tokens))
+        return JsonResponse({"success": found, "missing": missing, "forbidden": forbidden, "invalid": invalid})
+
+    def get_tokens(self, request):
+        if request.content_type == 'application/octet-stream':
+            return decode_binary_tokens(request.body)
+        if request.content_type == 'application/json':
+            body = json.loads(request.body)
+            if 'tokens_b64' in body:
+                return decode_binary_tokens(base64.b64decode(body['tokens_b64'], validate=True))
+            if not isinstance(body['tokens'], list):
+                raise TypeError('tokens must be a list')
+            return body['tokens']
+        return split_tokens(request.POST.getlist('tokens'))
+
+class UnreadCountView(LoginRequiredMixin, View):
+
+    def get(self, request, *args, **kwargs):
+        return JsonResponse({"unread": get_unread_count(request.user.pk)})
+
+class MessageStreamView(LoginRequiredMixin, View):
+    """
+    Push the user's message, reply and status events. EventSource clients get
+    a Server-Sent Events stream that ends after `stream_timeout` seconds and
+    is resumed with the Last-Event-ID header; other clients long-poll and get
+    a JSON list of events, or an empty list after `poll_timeout` seconds.
+    Bulk writes send a single `inbox` event instead of one per message.
+
+    Under ASGI both the stream and the long-poll wait are async generators,
+    so waiting clients don't hold a worker thread; under WSGI every open
+    stream or poll holds a worker thread.
+    """
+    heartbeat_interval = 15
+
+    @property
+    def stream_timeout(self):
+        return getattr(settings, 'QMESSAGES_STREAM_TIMEOUT', 300)
+
+    @property
+    def poll_timeout(self):
+        return getattr(settings, 'QMESSAGES_POLL_TIMEOUT', 25)
+
+    def get(self, request, *args, **kwargs):
+        last_event_id = request.headers.get('Last-Event-ID') or request.GET.get('last_event_id')
+        bus = events.get_event_bus()
+        if last_event_id is None:
+            # A fresh client only wants what happens from now on.
+            last_event_id = bus.last_id
+        try:
+            last_event_id = int(last_event_id)
+        except ValueError:
+            return JsonResponse({"error": 'Invalid event id'}, status=400)
+
+        if 'text/event-stream' in request.headers.get('Accept', ''):
+            # A sync iterator would be read to the end before anything is sent under ASGI.
+            stream = self.astream if isinstance(request, ASGIRequest) else self.stream
+            response = StreamingHttpResponse(stream(bus, request.user.pk, last_event_id), content_type='text/event-stream')
+            response['Cache-Control'] = 'no-cache'
+            response['X-Accel-Buffering'] = 'no'
+            return response
+
+        if bus.is_expired(last_event_id):
+            return JsonResponse({'reset': True, 'events': [], 'last_event_id': bus.last_id})
+        if isinstance(request, ASGIRequest):
+            # Blocking here would stall the one thread every sync view shares under ASGI.
+            return StreamingHttpResponse(self.apoll(bus, request.user.pk, last_event_id), content_type='application/json')
+        event_list = bus.wait(request.user.pk, last_event_id, self.poll_timeout)
+        return JsonResponse(self.poll_data(event_list, last_event_id))
+
+    async def apoll(self, bus, user_id, last_event_id):
+        event_list = await bus.await_events(user_id, last_event_id, self.poll_timeout)
+        yield json.dumps(self.poll_data(event_list, last_event_id), cls=DjangoJSONEncoder)
+
+    def poll_data(self, event_list, last_event_id):
+        return {
+            'reset': False,
+            'events': [{'id': event.id, 'type': event.type, 'data': event.data} for event in event_list],
+            'last_event_id': event_list[-1].id if event_list else last_event_id,
+        }
+
+    def stream(self, bus, user_id, last_event_id):
+        if bus.is_expired(last_event_id):
+            # Events were lost; the client has to reload before following the stream.
+            last_event_id = bus.last_id
+            yield self.reset_message(last_event_id)
+        deadline = time.monotonic() + self.stream_timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            event_list = bus.wait(user_id, last_event_id, min(self.heartbeat_interval, remaining))
+            if not event_list:
+                yield ': keepalive\n\n'
+            for event in event_list:
+                last_event_id = event.id
+                yield self.event_message(event)
+
+    async def astream(self, bus, user_id, last_event_id):
+        if bus.is_expired(last_event_id):
+            last_event_id = bus.last_id
+            yield self.reset_message(last_event_id)
+        deadline = time.monotonic() + self.stream_timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            event_list = await bus.await_events(user_id, last_event_id, min(self.heartbeat_interval, remaining))
+            if not event_list:
+                yield ': keepalive\n\n'
+            for event in event_list:
+                last_event_id = event.id
+                yield self.event_message(event)
+
+    def reset_message(self, last_event_id):
+        return f'id: {last_event_id}\nevent: reset\ndata: {{}}\n\n'
+
+    def event_message(self, event):
+        return f'id: {event.id}\nevent: {event.type}\ndata: {json.dumps(event.data)}\n\n'
+
+class SearchView(LoginRequiredMixin, View):
+    paginate_by = 20
+    max_paginate_by = 100
+    text_preview_length = 200
+
+    def get(self, request, *args, **kwargs):
+        query = request.GET.get('q', '').strip()
+        if not query:
+            return JsonResponse({"error": 'Missing search query'}, status=400)
+        try:
+            page = max(int(request.GET.get('page', 1)), 1)
+            page_size = min(max(int(request.GET.get('pageSize', self.paginate_by)), 1), self.max_paginate_by)
+        except ValueError:
+            return JsonResponse({"error": 'Invalid page'}, status=400)
+
+        # Notes have no owner, so they are only searched inside a project scope.
+        project = request.GET.get('project')
+        kinds = [search.MESSAGE, search.REPLY, search.NOTE] if project else [search.MESSAGE, search.REPLY]
+        results, count = search.get_search_backend().search(
+            query,
+            user_id=request.user.pk,
+            kinds=kinds,
+            project=project,
+            app=request.GET.get('app'),
+            model=request.GET.get('model'),
+            offset=(page - 1) * page_size,
+            limit=page_size,
+        )
+
+        total_pages = max(math.ceil(count / page_size), 1)
+        data = {
+            'data': [
+                {
+                    'kind': result['kind'],
+                    'id': result['object_id'],
+                    'token': result['token'],
+                    'title': result['title'],
+                    'text': result['body'][:self.text_preview_length],
+                    'score': result['score'],
+                }
+                for result in results
+            ],
+            'pagination': {
+                'page': page,
+                'total_pages': total_pages,
+                'has_next': page < total_pages,
+                'has_previous': page > 1,
+                'count': count,
+            }
+        }
+        return JsonResponse(data, safe=False)
 
 class MessageDeleteView(LoginRequiredMixin, DeleteView):
     model = Message
@@ -266,45 +646,36 @@ class MessageDeleteView(LoginRequiredMixin, DeleteView):
                 return HttpResponse("You are not the owner of this message")
          
 class MessageStatusUpdateView(LoginRequiredMixin, View):
-    model = Message
-    form_class = MessageForm
-    base_template = "base.html"
-  
-    def get_context_data(self, **kwargs):
-        context = {'base_template': self.base_template}
-        return context
+    """
+    Change the status of many messages at once. Send the messages as
+    `tokens` (or a single `token`) and the target as `status`; without a
+    status every message moves to its next one. `all=1` instead of tokens
+    applies the status to every message the user received ("mark all").
+    """
 
     def post(self, request, *args, **kwargs):
-        token = [request.POST.get('token', None) or kwargs.get('token', None)]
-        valid_uuid_token, invalid_uuid_tokens = check_token(token)
-        if valid_uuid_token:
-            message_data = Message.objects.get(token=valid_uuid_token[0])
-            message_status = message_data.message_status.order_by('-created_on').first()
-            if not message_data:
-                return {'error': 'No data found for this token'}
-            if message_status:
-                message_status.next_status()
-                return {'success': f"Message received a new status: {message_status.message_desc.desc}"}
-            else:
-                return {'error': 'This message has no status'}
-        else:
-            return {'error': 'Invalid token'}
-        
+        tokens = request.POST.getlist('tokens') or request.POST.getlist('token') or ([kwargs['token']] if kwargs.get('token') else [])
+        return self.update_status(request, tokens, request.POST.get('status'), request.POST.get('all'))
+
     def get(self, request, *args, **kwargs):
-        token = [kwargs.get('token', None) or request.GET.get('token', None)]
-        valid_uuid_token, invalid_uuid_tokens = check_token(token)
-        if valid_uuid_token:
-            message_data = Message.objects.get(token=valid_uuid_token[0])
-            message_status = message_data.message_status.order_by('-created_on').first()
-            if not message_data:
-                return {'error': 'No data found for this token'}
-            if message_status:
-                message_status.next_status()
-                return {'success': f"Message received a new status: {message_status.message_desc.desc}"}
-            else:
-                return {'error': 'This message has no status'}
+        tokens = [kwargs.get('token', None) or request.GET.get('token', None)]
+        return self.update_status(request, [token for token in tokens if token], request.GET.get('status'), None)
+
+    def update_status(self, request, tokens, status, update_all):
+        try:
+            status_desc = status_registry.get(status) if status else None
+        except MessageStatusDesc.DoesNotExist:
+            return JsonResponse({"error": 'Invalid status'}, status=400)
+        if update_all:
+            if status_desc is None:
+                return JsonResponse({"error": 'A status is required to update all messages'}, status=400)
+            results = bulk_set_status(request.user, None, status_desc)
         else:
-            return {'error': 'Invalid token'}
+            if not check_token(tokens):
+                return JsonResponse({"error": 'Invalid token'}, status=400)
+            results = bulk_set_status(request.user, tokens, status_desc)
+        updated = sum(1 for result in results.values() if result == services.UPDATED)
+        return JsonResponse({"success": results, "updated": updated})
 
 class MessageReplyCreateView(LoginRequiredMixin, CreateView):
     model = MessageReply
@@ -322,36 +693,25 @@ class MessageReplyCreateView(LoginRequiredMixin, CreateView):
         return context
 
     def form_valid(self, form):
-        self.object = form.save(commit=False)
-        self.token = self.kwargs.get('token', None) or self.request.POST.get('token', None)
-        uuid_token = check_token([self.token])
-        self.object.message = Message.objects.get(token=uuid_token[0])
-        parent_reply_id = self.object.parent_reply_id or self.kwargs.get('parent_reply', None) or self.request.POST.get('parent_reply', None)
-        
-        if parent_reply_id is not None and parent_reply_id != '':
-            self.object.parent_reply = MessageReply.objects.get(id=parent_reply_id)
-        
-        self.object.replier = self.request.user
-        self.object.save()
-        status_desc_reply = MessageStatusDesc.objects.get(desc='Replied')
-        status_desc_unread = MessageStatusDesc.objects.get(desc='Unread')
-
-        if self.object.parent_reply:
-            MessageReplyStatus.objects.create(message_desc=status_desc_reply, message_reply=self.object.parent_reply)
-            MessageReplyStatus.objects.create(message_desc=status_desc_unread, message_reply=self.object)
-        else:
-            MessageStatus.objects.create(message_desc=status_desc_unread, message=self.object.message)
-            MessageReplyStatus.objects.create(message_desc=status_desc_unread, message_reply=self.object)
-        
-        if MessageStatus.objects.filter(message=self.object.message).order_by('-created_at').first().message_desc.desc == 'Unread':
-            MessageStatus.objects.create(message=self.object.message, message_desc=status_desc_reply)
-        else:
-            MessageStatus.objects.create(message=self.object.message, message_desc=status_desc_unread)
+        token = self.kwargs.get('token', None) or self.request.POST.get('token', None)
+        uuid_token = check_token([token])
+        if not uuid_token:
+            return JsonResponse({"error": 'Invalid token'}, status=400)
+        parent_reply_id = self.kwargs.get('parent_reply', None) or self.request.POST.get('parent_reply', None)
+        try:
+            parent_reply_id = int(parent_reply_id) if parent_reply_id else None
+        except ValueError:
+            return JsonResponse({"error": 'Invalid parent reply'}, status=400)
+        try:
+            self.object = post_reply(uuid_token[0], self.request.user, form.cleaned_data['text'], parent_reply_id)
+        except (Message.DoesNotExist, MessageReply.DoesNotExist):
+            return JsonResponse({"error": 'No data found for this token'}, status=404)
 
         if self.request.is_ajax:
-            return JsonResponse({"success": str(self.object.token)}, safe=False)
+            return JsonResponse({"success": str(self.object.pk)}, safe=False)
         else:
-            return super().form_valid(form)
+            # The reply is saved already; ModelFormMixin.form_valid would save the form's own instance.
+            return HttpResponseRedirect(self.get_success_url())
 
     def form_invalid(self, form):
         return JsonResponse({"error": form.errors}, safe=False)
@@ -374,14 +734,14 @@ class MessageReplyUpdateView(LoginRequiredMixin, UpdateView):
         if self.request.is_ajax:
             return JsonResponse({"success": str(self.object.pk)}, safe=False)
         else:
-            return super().form_valid(form)
+            # The reply is saved already; ModelFormMixin.form_valid would save the form's own instance.
+            return HttpResponseRedirect(self.get_success_url())
 
     def form_invalid(self, form):
         return JsonResponse({"error": form.errors}, safe=False)
 
     def render_to_response(self, context, **response_kwargs):
-        status_desc_read = MessageStatusDesc.objects.get(desc='Read')
-        MessageReplyStatus.objects.create(message_reply=self.object, message_desc=status_desc_read)
+        MessageReplyStatus.record(self.object, status_registry.get(READ))
         return super().render_to_response(context, **response_kwargs)
 
 class MessageReplyDetailView(LoginRequiredMixin, DetailView):
@@ -396,8 +756,7 @@ class MessageReplyDetailView(LoginRequiredMixin, DetailView):
             message_reply_data_dict['pk'] = str(self.object.pk)
             return JsonResponse(message_reply_data_dict, safe=False)
         else:
-            status_desc_read = MessageStatusDesc.objects.get(desc='Read')
-            MessageReplyStatus.objects.create(message_reply=self.object, message_desc=status_desc_read)
+            MessageReplyStatus.record(self.object, status_registry.get(READ))
             return super().render_to_response(context, **response_kwargs)
 
 class MessageReplyDeleteView(LoginRequiredMixin, DeleteView):
@@ -454,4 +813,74 @@ class NoteCreateView(LoginRequiredMixin, View):
     def get(self, request, *args, **kwargs):
         context = self.get_context_data(**kwargs)
         context['form'] = self.form_class()
-        return render(request, 'note_create.html', context)
\ No newline at end of file
+        return render(request, 'note_create.html', context)
+
+class NoteScopeMixin:
+    """Notes have no owner, so they are only read inside a project scope."""
+
+    def get_note_queryset(self, params):
+        project = self.kwargs.get('project') or params.get('project')
+        if not project:
+            return None
+        queryset = Note.objects.filter(project=project)
+        for field in ('app', 'model'):
+            value = self.kwargs.get(field) or params.get(field)
+            if value:
+                queryset = queryset.filter(**{field: value})
+        return queryset
+
+class NoteListView(LoginRequiredMixin, NoteScopeMixin, View):
+    """
+    Page through the notes of a project, newest first, with keyset cursors.
+    `text` is left unloaded and every note carries a `preview` of its first
+    `preview_length` characters; fetch whole notes with NoteDetailView.
+    """
+    paginate_by = 20
+    max_paginate_by = 100
+    preview_length = 200
+
+    def get(self, request, *args, **kwargs):
+        queryset = self.get_note_queryset(request.GET)
+        if queryset is None:
+            return JsonResponse({"error": 'A project is required'}, status=400)
+        page_size = clamp_page_size(request.GET.get('pageSize'), self.paginate_by, self.max_paginate_by)
+        try:
+            notes, pagination = paginate_by_cursor(
+                note_preview_queryset(queryset, self.preview_length), request.GET.get('cursor'), page_size
+            )
+        except ValueError:
+            return JsonResponse({"error": 'Invalid cursor'}, status=400)
+        data = {
+            'data': [serialize_note(note, preview=True) for note in notes],
+            'pagination': pagination,
+        }
+        return JsonResponse(data, safe=False)
+
+class NoteDetailView(LoginRequiredMixin, NoteScopeMixin, View):
+    """
+    Fetch whole notes of a project by token: one note from the URL, or a
+    batch of up to `max_tokens` sent as `tokens`, returned in the order
+    asked for. Unknown tokens are left out.
+    """
+    max_tokens = 100
+
+    def get(self, request, *args, **kwargs):
+        queryset = self.get_note_queryset(request.GET)
+        if queryset is None:
+            return JsonResponse({"error": 'A project is required'}, status=400)
+        if kwargs.get('token'):
+            uuid_tokens = check_token([kwargs['token']])
+            if not uuid_tokens:
+                return JsonResponse({"error": 'Invalid token'}, status=400)
+            note = queryset.filter(token=uuid_tokens[0]).first()
+            if note is None:
+                return JsonResponse({"error": 'No data found for this token'}, status=404)
+            return JsonResponse(serialize_note(note), safe=False)
+
+        uuid_tokens = check_token(split_tokens(request.GET.getlist('tokens')))
+        if not uuid_tokens:
+            return JsonResponse({"error": 'Invalid token'}, status=400)
+        if len(uuid_tokens) > self.max_tokens:
+            return JsonResponse({"error": f'At most {self.max_tokens} tokens per request'}, status=400)
+        notes = {note.token: note for note in queryset.filter(token__in=uuid_tokens)}
+        return JsonResponse({'data': [serialize_note(notes[token]) for token in uuid_tokens if token in notes]}, safe=False)